@@ -36,12 +36,215 @@
 from __future__ import division, absolute_import, print_function, unicode_literals
 import os
 import sys
+import glob
+import mmap
+import time
+import shlex
+import shutil
+import json
 import struct
+import hashlib
 import optparse
 import binascii
+import collections
+import multiprocessing
 from io import BytesIO
 
 
+CRC64_WE_MASK = 0xFFFFFFFFFFFFFFFF
+CRC64_WE_POLY = 0x42F0E1EBA9EA3693
+CRC64_WE_WINDOW_SIZE = 64 * 1024
+
+
+def _make_crc64_we_tables():
+    # Table 0 is the classic byte-at-a-time table; table K advances a byte through K additional zero bytes,
+    # which is what slicing-by-8 needs to fold eight input bytes into the register per iteration.
+    table = []
+    for index in range(256):
+        crc = index << 56
+        for _ in range(8):
+            if crc & (1 << 63):
+                crc = ((crc << 1) & CRC64_WE_MASK) ^ CRC64_WE_POLY
+            else:
+                crc <<= 1
+        table.append(crc)
+    tables = [table]
+    for _ in range(7):
+        prev = tables[-1]
+        tables.append([((x << 8) & CRC64_WE_MASK) ^ table[x >> 56] for x in prev])
+    return tables
+
+_CRC64_WE_TABLES = _make_crc64_we_tables()
+
+
+def crc64_we(data, init=0):
+    """
+    CRC-64-WE (poly 0x42F0E1EBA9EA3693, initial value and output XOR all ones, not reflected).
+    The init argument is the CRC of the preceding data, so that crc64_we(b, crc64_we(a)) == crc64_we(a + b),
+    similarly to binascii.crc32(). Accepts any object supporting the buffer protocol.
+    """
+    t7, t6, t5, t4, t3, t2, t1, t0 = reversed(_CRC64_WE_TABLES)
+    crc = init ^ CRC64_WE_MASK
+    data = memoryview(data)
+    words = len(data) // 8
+    # The words are unpacked window by window, so that the tuple of unpacked words stays small for large images
+    window_words = CRC64_WE_WINDOW_SIZE // 8
+    for window_start in range(0, words, window_words):
+        window_length = min(window_words, words - window_start)
+        for word in struct.unpack_from(">%dQ" % window_length, data, window_start * 8):
+            x = crc ^ word
+            crc = (t7[x >> 56] ^ t6[(x >> 48) & 0xFF] ^ t5[(x >> 40) & 0xFF] ^ t4[(x >> 32) & 0xFF] ^
+                   t3[(x >> 24) & 0xFF] ^ t2[(x >> 16) & 0xFF] ^ t1[(x >> 8) & 0xFF] ^ t0[x & 0xFF])
+    for byte in bytearray(data[words * 8:]):
+        crc = t0[(crc >> 56) ^ byte] ^ ((crc << 8) & CRC64_WE_MASK)
+    return crc ^ CRC64_WE_MASK
+
+
+def _gf2_matrix_times(matrix, vector):
+    result = 0
+    index = 0
+    while vector:
+        if vector & 1:
+            result ^= matrix[index]
+        vector >>= 1
+        index += 1
+    return result
+
+
+def _gf2_matrix_square(matrix):
+    return [_gf2_matrix_times(matrix, column) for column in matrix]
+
+# Element K is a GF(2) operator that advances the CRC register through 2**K zero bytes; extended on demand.
+_CRC64_WE_ZERO_OPERATORS = []
+
+
+def _crc64_we_zero_operator(power):
+    operators = _CRC64_WE_ZERO_OPERATORS
+    if not operators:
+        # One zero bit shifts the register left, folding the polynomial in when the MSB falls out
+        operator = [1 << (n + 1) for n in range(63)] + [CRC64_WE_POLY]
+        for _ in range(3):
+            operator = _gf2_matrix_square(operator)
+        operators.append(operator)
+    while len(operators) <= power:
+        operators.append(_gf2_matrix_square(operators[-1]))
+    return operators[power]
+
+
+def crc64_we_combine(crc1, crc2, length2):
+    """
+    Given crc1 = crc64_we(A), crc2 = crc64_we(B) and length2 = len(B), returns crc64_we(A + B)
+    without touching the data, similarly to zlib's crc32_combine(). Runs in O(log(length2)).
+    """
+    power = 0
+    while length2:
+        if length2 & 1:
+            crc1 = _gf2_matrix_times(_crc64_we_zero_operator(power), crc1)
+        length2 >>= 1
+        power += 1
+    return crc1 ^ crc2
+
+
+CRC64_WE_PARALLEL_CHUNK_SIZE = 1024 * 1024
+
+
+def _crc64_we_chunk(data):
+    return crc64_we(data), len(data)
+
+
+def crc64_we_parallel(buffers, jobs=None, chunk_size=CRC64_WE_PARALLEL_CHUNK_SIZE):
+    """
+    Computes CRC-64-WE of the concatenation of the buffers, split into chunks of chunk_size bytes that are
+    processed by a pool of jobs worker processes (default is one per CPU). Partial CRC are merged with
+    crc64_we_combine(), so the result is identical to the serial computation.
+    """
+    def chunks():
+        for buf in buffers:
+            buf = memoryview(buf)
+            for offset in range(0, len(buf), chunk_size):
+                yield buf[offset:offset + chunk_size].tobytes()
+
+    # The number of chunks in flight is bounded, so that only a few chunks are copied at any moment
+    jobs = jobs or multiprocessing.cpu_count()
+    crc = 0
+    pool = multiprocessing.Pool(jobs)
+    try:
+        pending = collections.deque()
+        for chunk in chunks():
+            pending.append(pool.apply_async(_crc64_we_chunk, (chunk,)))
+            if len(pending) >= 2 * jobs:
+                crc = crc64_we_combine(crc, *pending.popleft().get())
+        while pending:
+            crc = crc64_we_combine(crc, *pending.popleft().get())
+    finally:
+        pool.close()
+        pool.join()
+    return crc
+
+
+class CRCCache(object):
+    """
+    On-disk cache of CRC-64-WE of fixed-size data blocks, keyed by the SHA-256 of the block contents.
+    When an image is re-signed, only the blocks that were not seen before (and the short unaligned pieces
+    around the descriptor window and the padding) are processed by the CRC engine; the cached block CRC
+    are merged with crc64_we_combine(), so the result is always equal to a full recompute.
+    The least recently used entries are evicted once the number of entries exceeds max_entries.
+    """
+
+    BLOCK_SIZE = 4096
+    DEFAULT_MAX_ENTRIES = 65536
+
+    def __init__(self, path, max_entries=DEFAULT_MAX_ENTRIES):
+        self.path = path
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        self._entries = collections.OrderedDict()
+        try:
+            with open(path) as f:
+                state = json.load(f)
+            if state["block_size"] == self.BLOCK_SIZE:
+                self._entries.update((digest, crc) for digest, crc in state["entries"])
+        except (IOError, OSError, ValueError, KeyError, TypeError):
+            self._entries.clear()  # Missing or corrupted cache is not an error, it will be rebuilt
+
+    def _block_crc(self, block):
+        digest = hashlib.sha256(block).hexdigest()
+        crc = self._entries.pop(digest, None)
+        if crc is None:
+            self.misses += 1
+            crc = crc64_we(block)
+        else:
+            self.hits += 1
+        self._entries[digest] = crc
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+        return crc
+
+    def crc(self, buffers):
+        """
+        Computes CRC-64-WE of the concatenation of the buffers. Blocks are aligned to the beginning of each buffer.
+        """
+        crc = 0
+        for buf in buffers:
+            buf = memoryview(buf)
+            full_length = len(buf) - len(buf) % self.BLOCK_SIZE
+            for offset in range(0, full_length, self.BLOCK_SIZE):
+                crc = crc64_we_combine(crc, self._block_crc(buf[offset:offset + self.BLOCK_SIZE]), self.BLOCK_SIZE)
+            crc = crc64_we(buf[full_length:], crc)
+        return crc
+
+    def save(self):
+        state = {
+            "block_size": self.BLOCK_SIZE,
+            "entries": list(self._entries.items())
+        }
+        tmp_path = self.path + ".tmp"
+        with open(tmp_path, "w") as f:
+            json.dump(state, f)
+        os.rename(tmp_path, self.path)
+
+
 class AppDescriptor(object):
     """
     UAVCAN firmware image descriptor format:
@@ -97,8 +300,15 @@ class AppDescriptor(object):
                 self.reserved == AppDescriptor.RESERVED)
 
 
+# Slicing a memory map without copying requires memoryview support for mmap, which appeared in Python 3
+MMAP_SUPPORTED = sys.version_info[0] >= 3
+
+
 class FirmwareImage(object):
-    def __init__(self, path_or_file, mode="r"):
+    # Images smaller than that are always processed serially, because spawning the pool is not worth it
+    PARALLEL_CRC_THRESHOLD = 2 * CRC64_WE_PARALLEL_CHUNK_SIZE
+
+    def __init__(self, path_or_file, mode="r", jobs=1, use_mmap=False):
         if getattr(path_or_file, "read", None):
             self._file = path_or_file
             self._do_close = False
@@ -108,7 +318,17 @@ class FirmwareImage(object):
             self._do_close = True
             self._padding = 4
 
-        if "r" in mode:
+        # Memory-mapped images are accessed in place: descriptor writes go
+        # directly to the file, and the CRC is computed without copying.
+        self._mapped = use_mmap
+        if use_mmap:
+            if not MMAP_SUPPORTED:
+                raise ValueError("Memory-mapped images require Python 3")
+            if "r" not in mode:
+                raise ValueError("Memory-mapped images must be opened for reading")
+            access = mmap.ACCESS_WRITE if "+" in mode else mmap.ACCESS_READ
+            self._contents = mmap.mmap(self._file.fileno(), 0, access=access)
+        elif "r" in mode:
             self._contents = BytesIO(self._file.read())
         else:
             self._contents = BytesIO()
@@ -119,6 +339,11 @@ class FirmwareImage(object):
         self._descriptor_bytes = None
         self._descriptor = None
 
+        # Number of worker processes used for CRC computation; None means one per CPU
+        self.jobs = jobs
+        # Optional CRCCache; takes precedence over parallel computation
+        self.crc_cache = None
+
     def __enter__(self):
         return self
 
@@ -131,7 +356,12 @@ class FirmwareImage(object):
         return iter(self._contents)
 
     def __exit__(self, *args):
-        if self._do_write:
+        if self._mapped:
+            self._contents.close()
+            if self._do_write and self._padding:
+                self._file.seek(0, os.SEEK_END)
+                self._file.write(b'\xff' * self._padding)
+        elif self._do_write:
             if getattr(self._file, "seek", None):
                 self._file.seek(0)
             self._file.write(self._contents.getvalue())
@@ -141,6 +371,13 @@ class FirmwareImage(object):
         if self._do_close:
             self._file.close()
 
+    def _content(self):
+        # The whole image as a sliceable and searchable buffer; memory-mapped
+        # images are returned as is, without copying.
+        if self._mapped:
+            return self._contents
+        return self._contents.getvalue()
+
     def _write_descriptor_raw(self):
         # Seek to the appropriate location, write the serialized
         # descriptor, and seek back.
@@ -148,6 +385,8 @@ class FirmwareImage(object):
         self._contents.seek(self._descriptor_offset)
         self._contents.write(self._descriptor.pack())
         self._contents.seek(prev_offset)
+        if self._mapped:
+            self._do_write = True
 
     def write_descriptor(self):
         # Set the descriptor's length and CRC to the values required for
@@ -163,28 +402,33 @@ class FirmwareImage(object):
 
         self._write_descriptor_raw()
 
+    def _crc_buffers(self, start=0, end=None, padding=None):
+        # The image CRC is computed with the image_crc field in the app
+        # descriptor zeroed out and with the padding appended. The image
+        # can also be a part of the file, e.g. of a compound image.
+        crc_offset = self.app_descriptor_offset + len(AppDescriptor.SIGNATURE)
+        if padding is None:
+            padding = self._padding
+        content = memoryview(self._content())[:end]
+        buffers = [content[start:crc_offset], b"\x00" * 8, content[crc_offset + 8:]]
+        if padding:
+            buffers.append(b"\xff" * padding)
+        return buffers
+
     @property
     def crc(self):
-        MASK = 0xFFFFFFFFFFFFFFFF
-        POLY = 0x42F0E1EBA9EA3693
+        return self._compute_crc(self._crc_buffers())
 
-        # Calculate the image CRC with the image_crc field in the app
-        # descriptor zeroed out.
-        crc_offset = self.app_descriptor_offset + len(AppDescriptor.SIGNATURE)
-        content = bytearray(self._contents.getvalue())
-        content[crc_offset:crc_offset + 8] = bytearray(b"\x00" * 8)
-        if self._padding:
-            content += bytearray(b"\xff" * self._padding)
-        val = MASK
-        for byte in content:
-            val ^= (byte << 56) & MASK
-            for bit in range(8):
-                if val & (1 << 63):
-                    val = ((val << 1) & MASK) ^ POLY
-                else:
-                    val <<= 1
-
-        return (val & MASK) ^ MASK
+    def _compute_crc(self, buffers):
+        if self.crc_cache is not None:
+            return self.crc_cache.crc(buffers)
+        if self.jobs != 1 and self.length >= self.PARALLEL_CRC_THRESHOLD:
+            return crc64_we_parallel(buffers, self.jobs)
+
+        val = 0
+        for buf in buffers:
+            val = crc64_we(buf, val)
+        return val
 
     @property
     def length(self):
@@ -203,27 +447,34 @@ class FirmwareImage(object):
 
         return self._length
 
+    @property
+    def app_descriptor_offsets(self):
+        # Only the locations where the signature occurs are checked for a
+        # valid descriptor; the signature is searched for in a single pass.
+        content = self._content()
+        last_offset = len(content) - AppDescriptor.LENGTH
+        offsets = []
+        offset = content.find(AppDescriptor.SIGNATURE)
+        while 0 <= offset <= last_offset:
+            try:
+                AppDescriptor(content[offset:offset + AppDescriptor.LENGTH])
+            except ValueError:
+                pass
+            else:
+                offsets.append(offset)
+            offset = content.find(AppDescriptor.SIGNATURE, offset + 1)
+        return offsets
+
     @property
     def app_descriptor_offset(self):
-        if not self._descriptor_offset:
-            # Save the current position
-            prev_offset = self._contents.tell()
-            # Check each byte in the file to see if a valid descriptor starts
-            # at that location. Slow, but not slow enough to matter.
-            offset = 0
-            while offset < self.length - AppDescriptor.LENGTH:
-                self._contents.seek(offset)
-                try:
-                    # If this throws an exception, there isn't a valid
-                    # descriptor at this offset
-                    AppDescriptor(self._contents.read(AppDescriptor.LENGTH))
-                except Exception:
-                    offset += 1
-                else:
-                    self._descriptor_offset = offset
-                    break
-            # Go back to the previous position
-            self._contents.seek(prev_offset)
+        if self._descriptor_offset is None:
+            offsets = self.app_descriptor_offsets
+            if not offsets:
+                raise ValueError("App descriptor not found")
+            if len(offsets) > 1:
+                raise ValueError("Multiple app descriptors found at offsets {0}".format(
+                                 ", ".join("0x{0:08X}".format(x) for x in offsets)))
+            self._descriptor_offset = offsets[0]
 
         return self._descriptor_offset
 
@@ -246,35 +497,398 @@ class FirmwareImage(object):
         self._descriptor = value
 
 
-if __name__ == "__main__":
-    parser = optparse.OptionParser(usage="usage: %prog [options] <input binary> <node name> <hardware version string>")
-    parser.add_option("--also-patch-descriptor-in", dest="also_patch_descriptor_in", default=[], action='append',
-                      help="file where the descriptor will be updated too (e.g. ELF)", metavar="PATH")
-    parser.add_option("-v", "--verbose", dest="verbose", action="store_true",
-                      help="show additional firmware information on stdout")
+ELF_MAGIC = b"\x7fELF"
+ELF_SHT_NOBITS = 8
+ELF_SHF_ALLOC = 0x2
+
+
+def _elf_loaded_section_ranges(content):
+    # Returns (offset, size) of every ELF section that has contents in the file and is loaded into the target.
+    # Debug info is not loaded, so it is skipped, which keeps the search short even for large debug builds.
+    ei_class, ei_data = bytearray(content[4:6])
+    if ei_class not in (1, 2) or ei_data not in (1, 2):
+        raise ValueError("Unsupported ELF class/encoding: {0}/{1}".format(ei_class, ei_data))
+    endian = "<" if ei_data == 1 else ">"
+    if ei_class == 1:
+        (shoff,) = struct.unpack_from(endian + "L", content, 0x20)
+        shentsize, shnum = struct.unpack_from(endian + "HH", content, 0x2E)
+        header_format = endian + "LLLLLL"
+    else:
+        (shoff,) = struct.unpack_from(endian + "Q", content, 0x28)
+        shentsize, shnum = struct.unpack_from(endian + "HH", content, 0x3A)
+        header_format = endian + "LLQQQQ"
+
+    ranges = []
+    for index in range(shnum):
+        _name, sh_type, sh_flags, _addr, sh_offset, sh_size = struct.unpack_from(header_format, content,
+                                                                                 shoff + index * shentsize)
+        if sh_flags & ELF_SHF_ALLOC and sh_type != ELF_SHT_NOBITS:
+            ranges.append((sh_offset, sh_size))
+    return ranges
+
+
+def patch_descriptor(path, old_descriptor, new_descriptor):
+    """
+    Replaces the packed descriptor old_descriptor with new_descriptor in the file at path, writing only the
+    descriptor bytes in place. The descriptor is searched for in the loaded sections of an ELF file, or in the
+    whole file otherwise. Raises ValueError unless the old descriptor is found exactly once.
+    """
+    assert len(old_descriptor) == len(new_descriptor) == AppDescriptor.LENGTH
+    with open(path, "r+b") as f:
+        content = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_WRITE)
+        try:
+            if content[:len(ELF_MAGIC)] == ELF_MAGIC:
+                ranges = _elf_loaded_section_ranges(content)
+            else:
+                ranges = [(0, len(content))]
+            offsets = []
+            for start, size in ranges:
+                found = content.find(old_descriptor, start, start + size)
+                while found >= 0:
+                    offsets.append(found)
+                    found = content.find(old_descriptor, found + 1, start + size)
+
+            if len(offsets) != 1:
+                raise ValueError("Expected to find the descriptor exactly once in {0}, found at offsets [{1}]".format(
+                                 path, ", ".join("0x{0:08X}".format(x) for x in offsets)))
+
+            content[offsets[0]:offsets[0] + AppDescriptor.LENGTH] = new_descriptor
+            content.flush()
+        finally:
+            content.close()
+
+
+def verify_image(path):
+    """
+    Checks image_crc and image_size of a signed image, which can be either a standalone application image
+    (*.uavcan.bin) or an application image preceded by the bootloader (*.compound.bin).
+    Returns a JSON-serializable dict; the key "ok" is True if the image is correct.
+    """
+    result = {"path": path, "ok": False}
+    try:
+        with FirmwareImage(path, "rb", use_mmap=MMAP_SUPPORTED) as image:
+            file_size = len(image._content())
+            descriptor_offset = image.app_descriptor_offset
+            descriptor = image.app_descriptor
+            result.update(file_size=file_size,
+                          image_size=descriptor.image_size,
+                          image_crc="0x{0:016X}".format(descriptor.image_crc),
+                          version="{0}.{1}".format(descriptor.version_major, descriptor.version_minor),
+                          vcs_commit="{0:08x}".format(descriptor.vcs_commit))
+            if not descriptor.valid:
+                raise ValueError("Image is not signed")
+
+            # The application occupies the end of the file. It is written to
+            # the compound image without padding, so there can be up to two
+            # possible application lengths for the given image_size.
+            size = descriptor.image_size
+            for length in range(max(size - 3, 0), size + 1):
+                start = file_size - length
+                if ((length == size or length + length % 4 == size) and
+                        0 <= start <= descriptor_offset and descriptor_offset + AppDescriptor.LENGTH <= file_size):
+                    crc = image._compute_crc(image._crc_buffers(start, padding=size - length))
+                    if crc == descriptor.image_crc:
+                        result.update(ok=True, app_offset=start, kind="compound" if start else "image")
+                        break
+            else:
+                raise ValueError("image_crc or image_size mismatch")
+    except Exception as ex:
+        result["error"] = str(ex) or repr(ex)
+    return result
+
+
+def _expand_image_paths(patterns):
+    for pattern in patterns:
+        if os.path.isdir(pattern):
+            for root, dirs, files in os.walk(pattern):
+                dirs.sort()
+                for name in sorted(files):
+                    if name.endswith(".uavcan.bin") or name.endswith(".compound.bin"):
+                        yield os.path.join(root, name)
+        else:
+            # Non-existent paths are passed through, so that they are reported as failed
+            for path in sorted(glob.glob(pattern)) or [pattern]:
+                yield path
+
+
+def verify_main(argv):
+    parser = optparse.OptionParser(usage="usage: %prog verify [options] <directory, image, or glob>...",
+                                   description="Verifies signed images in parallel, reporting one JSON object "
+                                               "per image on stdout. Directories are searched recursively for "
+                                               "*.uavcan.bin and *.compound.bin.")
+    parser.add_option("-j", "--jobs", dest="jobs", type="int", default=0,
+                      help="number of worker processes; 0 means one per CPU", metavar="N")
+
+    options, args = parser.parse_args(argv)
+    if not args:
+        parser.error("Invalid usage")
+
+    num_images, num_failed, num_bytes = 0, 0, 0
+    started_at = time.time()
+    pool = multiprocessing.Pool(options.jobs or None)
+    try:
+        for result in pool.imap_unordered(verify_image, _expand_image_paths(args)):
+            print(json.dumps(result, sort_keys=True))
+            sys.stdout.flush()
+            num_images += 1
+            num_failed += 0 if result["ok"] else 1
+            num_bytes += result.get("file_size", 0)
+    finally:
+        pool.close()
+        pool.join()
+    elapsed = max(time.time() - started_at, 1e-6)
+
+    sys.stderr.write("Verified {0} images, {1} failed; {2:.1f} MB in {3:.2f} s ({4:.1f} MB/s)\n".format(
+                     num_images, num_failed, num_bytes / 1e6, elapsed, num_bytes / 1e6 / elapsed))
+    return 1 if num_failed else 0
+
+
+class ImageDelta(object):
+    """
+    Block-level difference between two signed application images, identified by their app descriptors.
+    Serialized format (little endian):
+        uint8_t magic[8] ('APDelta0')
+        uint8_t source_descriptor[32]
+        uint8_t target_descriptor[32]
+        uint32_t block_size
+        uint32_t num_operations
+        operations: uint8_t kind, uint32_t source_offset, uint32_t length, followed by length bytes of
+                    literal data if kind is DATA; COPY takes length bytes from the source image at source_offset.
+    """
+
+    MAGIC = b"APDelta0"
+    HEADER_FORMAT = "<8s32s32sLL"
+    OPERATION_FORMAT = "<BLL"
+    COPY = 0
+    DATA = 1
+    DEFAULT_BLOCK_SIZE = 256
+
+    def __init__(self, source_descriptor, target_descriptor, block_size=DEFAULT_BLOCK_SIZE):
+        self.source_descriptor = source_descriptor
+        self.target_descriptor = target_descriptor
+        self.block_size = block_size
+        self.operations = []        # (kind, source_offset, length, data)
+
+    def _append(self, kind, source_offset, data):
+        # Adjacent operations of the same kind are merged
+        if self.operations:
+            last_kind, last_offset, last_length, last_data = self.operations[-1]
+            if kind == last_kind == ImageDelta.DATA:
+                self.operations[-1] = (kind, 0, last_length + len(data), last_data + data)
+                return
+            if kind == last_kind == ImageDelta.COPY and last_offset + last_length == source_offset:
+                self.operations[-1] = (kind, last_offset, last_length + len(data), b"")
+                return
+        self.operations.append((kind, source_offset if kind == ImageDelta.COPY else 0, len(data),
+                                b"" if kind == ImageDelta.COPY else data))
+
+    @staticmethod
+    def _weak_checksum(data):
+        # rsync-style checksum of a block, which can be rolled forward by one byte in constant time
+        a = sum(data) & 0xFFFF
+        b = sum((len(data) - index) * byte for index, byte in enumerate(data)) & 0xFFFF
+        return a, b
+
+    @staticmethod
+    def make(source, target, block_size=DEFAULT_BLOCK_SIZE):
+        """
+        Source and target are complete signed images. The target is scanned byte by byte with a rolling checksum,
+        so that a block of the source (at any block-aligned offset) is found at any offset of the target, e.g.
+        after an insertion that has shifted the rest of the image. Unmatched bytes are included as literal data.
+        """
+        source_image = FirmwareImage(BytesIO(source))
+        target_image = FirmwareImage(BytesIO(target))
+        delta = ImageDelta(source_image.app_descriptor, target_image.app_descriptor, block_size)
+
+        source_blocks = {}
+        source_checksums = set()
+        for offset in range(0, len(source) - block_size + 1, block_size):
+            block = source[offset:offset + block_size]
+            if block not in source_blocks:
+                source_blocks[block] = offset
+                source_checksums.add(ImageDelta._weak_checksum(bytearray(block)))
+
+        values = bytearray(target)
+        literal_start = 0
+        offset = 0
+        if len(target) >= block_size:
+            a, b = ImageDelta._weak_checksum(values[:block_size])
+        while offset + block_size <= len(target):
+            if (a, b) in source_checksums:
+                block = target[offset:offset + block_size]
+                source_offset = source_blocks.get(block)
+                if source_offset is not None:
+                    if literal_start < offset:
+                        delta._append(ImageDelta.DATA, 0, target[literal_start:offset])
+                    delta._append(ImageDelta.COPY, source_offset, block)
+                    offset += block_size
+                    literal_start = offset
+                    if offset + block_size <= len(target):
+                        a, b = ImageDelta._weak_checksum(values[offset:offset + block_size])
+                    continue
+
+            # Roll the checksum one byte forward
+            if offset + block_size < len(target):
+                removed, added = values[offset], values[offset + block_size]
+                a = (a - removed + added) & 0xFFFF
+                b = (b - block_size * removed + a) & 0xFFFF
+            offset += 1
+
+        if literal_start < len(target):
+            delta._append(ImageDelta.DATA, 0, target[literal_start:])
+        return delta
 
-    options, args = parser.parse_args()
+    def apply(self, source):
+        """
+        Rebuilds the target image from the source image. Raises ValueError if the source image is not the one
+        the delta was made for, or if the rebuilt image does not match the target image_crc and image_size.
+        """
+        source_image = FirmwareImage(BytesIO(source))
+        if source_image.app_descriptor.pack() != self.source_descriptor.pack():
+            raise ValueError("The delta does not apply to this source image")
+
+        out = BytesIO()
+        for kind, source_offset, length, data in self.operations:
+            if kind == ImageDelta.COPY:
+                if source_offset + length > len(source):
+                    raise ValueError("Copy operation is out of the source image bounds")
+                out.write(source[source_offset:source_offset + length])
+            else:
+                out.write(data)
+        target = out.getvalue()
+
+        target_image = FirmwareImage(BytesIO(target))
+        if target_image.app_descriptor.pack() != self.target_descriptor.pack():
+            raise ValueError("Rebuilt image has an unexpected app descriptor")
+        if len(target) != self.target_descriptor.image_size or target_image.crc != self.target_descriptor.image_crc:
+            raise ValueError("Rebuilt image does not match the target image_crc or image_size")
+        return target
+
+    def pack(self):
+        out = BytesIO()
+        out.write(struct.pack(ImageDelta.HEADER_FORMAT, ImageDelta.MAGIC, self.source_descriptor.pack(),
+                              self.target_descriptor.pack(), self.block_size, len(self.operations)))
+        for kind, source_offset, length, data in self.operations:
+            out.write(struct.pack(ImageDelta.OPERATION_FORMAT, kind, source_offset, length))
+            out.write(data)
+        return out.getvalue()
+
+    @staticmethod
+    def unpack(data):
+        header_length = struct.calcsize(ImageDelta.HEADER_FORMAT)
+        operation_length = struct.calcsize(ImageDelta.OPERATION_FORMAT)
+        magic, source_descriptor, target_descriptor, block_size, num_operations = \
+            struct.unpack_from(ImageDelta.HEADER_FORMAT, data)
+        if magic != ImageDelta.MAGIC:
+            raise ValueError("Not an image delta")
+
+        delta = ImageDelta(AppDescriptor(source_descriptor), AppDescriptor(target_descriptor), block_size)
+        offset = header_length
+        for _ in range(num_operations):
+            kind, source_offset, length = struct.unpack_from(ImageDelta.OPERATION_FORMAT, data, offset)
+            offset += operation_length
+            if kind == ImageDelta.DATA:
+                delta.operations.append((kind, 0, length, data[offset:offset + length]))
+                offset += length
+            elif kind == ImageDelta.COPY:
+                delta.operations.append((kind, source_offset, length, b""))
+            else:
+                raise ValueError("Invalid delta operation {0}".format(kind))
+        return delta
+
+
+def _describe_image(descriptor):
+    return "{0}.{1}.{2:08x} (image_crc 0x{3:016X})".format(descriptor.version_major, descriptor.version_minor,
+                                                          descriptor.vcs_commit, descriptor.image_crc)
+
+
+def delta_main(argv):
+    parser = optparse.OptionParser(usage="usage: %prog delta [options] <source image> <target image> <output delta>\n"
+                                         "       %prog delta --apply <source image> <delta> <output image>")
+    parser.add_option("--apply", dest="apply", action="store_true",
+                      help="rebuild the target image from the source image and the delta, and verify its CRC")
+    parser.add_option("--block-size", dest="block_size", type="int", default=ImageDelta.DEFAULT_BLOCK_SIZE,
+                      help="delta block size in bytes", metavar="BYTES")
+
+    options, args = parser.parse_args(argv)
     if len(args) != 3:
         parser.error("Invalid usage")
 
-    with FirmwareImage(args[0], "rb") as in_image:
-        out_file = '%s-%s-%s.%s.%x.uavcan.bin' % (args[1], args[2],
+    with open(args[0], "rb") as f:
+        source = f.read()
+
+    if options.apply:
+        with open(args[1], "rb") as f:
+            delta_data = f.read()
+        delta = ImageDelta.unpack(delta_data)
+        target = delta.apply(source)
+        output = target
+    else:
+        with open(args[1], "rb") as f:
+            target = f.read()
+        delta = ImageDelta.make(source, target, options.block_size)
+        delta_data = delta.pack()
+        output = delta_data
+
+    with open(args[2], "wb") as f:
+        f.write(output)
+
+    copied = sum(length for kind, _, length, _ in delta.operations if kind == ImageDelta.COPY)
+    sys.stderr.write("{0} -> {1}: {2} operations, {3} of {4} bytes copied from the source, "
+                     "delta is {5} bytes ({6:.1f}% of the target image)\n".format(
+                         _describe_image(delta.source_descriptor), _describe_image(delta.target_descriptor),
+                         len(delta.operations), copied, len(target), len(delta_data),
+                         100.0 * len(delta_data) / len(target)))
+    return 0
+
+
+def write_compound_image(path, bootloader, bootloader_size, application):
+    """
+    Writes the bootloader padded with 0xFF up to bootloader_size, followed by the application image.
+    """
+    if len(bootloader) > bootloader_size:
+        raise ValueError("Bootloader is larger than {0} bytes".format(bootloader_size))
+    with open(path, "wb") as f:
+        f.write(bootloader)
+        f.write(b"\xff" * (bootloader_size - len(bootloader)))
+        f.write(application)
+
+
+def sign_image(input_path, node_name, hardware_version, also_patch_descriptor_in=(), compound_image=None,
+               bootloader=None, bootloader_size=None, jobs=1, use_mmap=False, crc_cache=None, verbose=False):
+    """
+    Writes the signed image <node name>-<hardware version>-<major>.<minor>.<vcs commit>.uavcan.bin into the
+    current directory, patches the descriptor in the other files, and optionally writes the compound image.
+    crc_cache is an optional CRCCache instance, which can be shared between calls; it is not saved here.
+    Returns the path of the signed image.
+    """
+    with FirmwareImage(input_path, "rb", use_mmap=use_mmap) as in_image:
+        out_file = '%s-%s-%s.%s.%x.uavcan.bin' % (node_name, hardware_version,
                                                   in_image.app_descriptor.version_major,
                                                   in_image.app_descriptor.version_minor,
                                                   in_image.app_descriptor.vcs_commit)
-        with FirmwareImage(out_file, "wb") as out_image:
-            image = in_image.read()
-            out_image.write(image)
+        if use_mmap:
+            shutil.copyfile(input_path, out_file)
+            out_image = FirmwareImage(out_file, "r+b", jobs=jobs, use_mmap=True)
+        else:
+            out_image = FirmwareImage(out_file, "wb", jobs=jobs)
+        out_image.crc_cache = crc_cache
+        with out_image:
+            if not use_mmap:
+                image = in_image.read()
+                out_image.write(image)
             out_image.write_descriptor()
 
-            for patchee in options.also_patch_descriptor_in:
-                with open(patchee, "rb") as im:
-                    also_image = im.read()
-                also_image = also_image.replace(in_image.app_descriptor.pack(), out_image.app_descriptor.pack())
-                with open(patchee, "wb") as im:
-                    im.write(also_image)
+            for patchee in also_patch_descriptor_in:
+                patch_descriptor(patchee, in_image.app_descriptor.pack(), out_image.app_descriptor.pack())
+
+            if compound_image:
+                with open(bootloader, "rb") as f:
+                    bootloader_image = f.read()
+                # The application is written without padding, exactly as it is placed in flash
+                write_compound_image(compound_image, bootloader_image, bootloader_size, out_image._content())
 
-            if options.verbose:
+            if verbose:
                 sys.stderr.write("""
 Application descriptor located at offset 0x{0.app_descriptor_offset:08X}
 
@@ -303,3 +917,155 @@ version_minor       uint8             {2.version_minor:d}
 reserved            uint8[6]          {2.reserved!r}
 
 """.format(in_image, in_image.app_descriptor, out_image.app_descriptor))
+
+    return out_file
+
+
+def _make_sign_parser():
+    parser = optparse.OptionParser(usage="usage: %prog [options] <input binary> <node name> <hardware version string>\n"
+                                         "       %prog verify [options] <directory, image, or glob>...\n"
+                                         "       %prog delta [options] <source image> <target image> <output delta>\n"
+                                         "       %prog batch [options] <manifest>")
+    parser.add_option("--also-patch-descriptor-in", dest="also_patch_descriptor_in", default=[], action='append',
+                      help="file where the descriptor will be updated too (e.g. ELF)", metavar="PATH")
+    parser.add_option("-v", "--verbose", dest="verbose", action="store_true",
+                      help="show additional firmware information on stdout")
+    parser.add_option("-j", "--jobs", dest="jobs", type="int", default=1,
+                      help="number of processes used to compute the CRC of large images; 0 means one per CPU",
+                      metavar="N")
+    parser.add_option("--mmap", dest="mmap", action="store_true",
+                      help="sign a copy of the input file in place via mmap instead of reading it into memory")
+    parser.add_option("--compound-image", dest="compound_image",
+                      help="also write the signed image combined with the bootloader into this file", metavar="PATH")
+    parser.add_option("--bootloader", dest="bootloader",
+                      help="bootloader binary for the compound image", metavar="PATH")
+    parser.add_option("--bootloader-size", dest="bootloader_size", type="int",
+                      help="size reserved for the bootloader in the compound image", metavar="BYTES")
+    parser.add_option("--crc-cache", dest="crc_cache",
+                      help="file where CRC of image blocks are cached to speed up re-signing of similar images",
+                      metavar="PATH")
+    return parser
+
+
+def _parse_sign_args(parser, argv):
+    options, args = parser.parse_args(argv)
+    if len(args) != 3:
+        parser.error("Invalid usage")
+    if options.compound_image and (not options.bootloader or not options.bootloader_size):
+        parser.error("--compound-image requires --bootloader and --bootloader-size")
+    return options, args
+
+
+def _sign_with_options(options, args, crc_cache=None):
+    return sign_image(args[0], args[1], args[2],
+                      also_patch_descriptor_in=options.also_patch_descriptor_in,
+                      compound_image=options.compound_image,
+                      bootloader=options.bootloader,
+                      bootloader_size=options.bootloader_size,
+                      jobs=options.jobs or None,
+                      use_mmap=options.mmap,
+                      crc_cache=crc_cache,
+                      verbose=options.verbose)
+
+
+def sign_main(argv):
+    options, args = _parse_sign_args(_make_sign_parser(), argv)
+    crc_cache = CRCCache(options.crc_cache) if options.crc_cache else None
+    _sign_with_options(options, args, crc_cache)
+    if crc_cache is not None:
+        crc_cache.save()
+    return 0
+
+
+def _file_state(path):
+    try:
+        st = os.stat(path)
+        return st.st_mtime, st.st_size
+    except OSError:
+        return None
+
+
+def batch_main(argv):
+    parser = optparse.OptionParser(usage="usage: %prog batch [options] <manifest>",
+                                   description="Signs several images in one process. Each non-empty line of the "
+                                               "manifest holds the arguments of a regular invocation, e.g. "
+                                               "'app.bin com.example.node 1.0 --also-patch-descriptor-in=app.elf'; "
+                                               "lines starting with # are ignored. Use - to read stdin.")
+    parser.add_option("--crc-cache", dest="crc_cache",
+                      help="CRC cache shared by all images of the batch", metavar="PATH")
+    parser.add_option("--watch", dest="watch", action="store_true",
+                      help="keep running and re-sign every image as soon as its input binary changes")
+    parser.add_option("--interval", dest="interval", type="float", default=0.5,
+                      help="input polling interval in watch mode, in seconds", metavar="SECONDS")
+
+    options, args = parser.parse_args(argv)
+    if len(args) != 1:
+        parser.error("Invalid usage")
+
+    if args[0] == "-":
+        lines = sys.stdin.readlines()
+    else:
+        with open(args[0]) as f:
+            lines = f.readlines()
+
+    sign_parser = _make_sign_parser()
+    jobs = []
+    for line in lines:
+        if line.strip() and not line.strip().startswith("#"):
+            jobs.append(_parse_sign_args(sign_parser, shlex.split(line)))
+
+    crc_cache = CRCCache(options.crc_cache) if options.crc_cache else None
+
+    def sign(job_options, job_args):
+        try:
+            out_file = _sign_with_options(job_options, job_args, crc_cache)
+        except Exception as ex:
+            sys.stderr.write("FAILED {0}: {1}\n".format(job_args[0], ex))
+            return False
+        sys.stderr.write("Signed {0} -> {1}\n".format(job_args[0], out_file))
+        return True
+
+    if not options.watch:
+        num_failed = 0
+        for job_options, job_args in jobs:
+            num_failed += 0 if sign(job_options, job_args) else 1
+        if crc_cache is not None:
+            crc_cache.save()
+        return 1 if num_failed else 0
+
+    # An image is re-signed once its input has stopped changing for one polling interval,
+    # so that the files that are still being written by the build system are not picked up.
+    signed_states = [None] * len(jobs)
+    seen_states = [_file_state(job_args[0]) for _, job_args in jobs]
+    while True:
+        updated = False
+        for index, (job_options, job_args) in enumerate(jobs):
+            state = _file_state(job_args[0])
+            if state is not None and state == seen_states[index] and state != signed_states[index]:
+                signed_states[index] = state
+                sign(job_options, job_args)
+                updated = True
+            seen_states[index] = state
+
+        if updated and crc_cache is not None:
+            crc_cache.save()
+        time.sleep(options.interval)
+
+
+def main(argv=None):
+    argv = sys.argv[1:] if argv is None else argv
+    commands = {
+        "verify": verify_main,
+        "delta": delta_main,
+        "batch": batch_main,
+    }
+    if argv and argv[0] in commands:
+        return commands[argv[0]](argv[1:])
+    return sign_main(argv)
+
+
+if __name__ == "__main__":
+    try:
+        sys.exit(main())
+    except KeyboardInterrupt:
+        sys.exit(1)
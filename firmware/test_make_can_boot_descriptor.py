@@ -0,0 +1,401 @@
+#!/usr/bin/env python
+#
+# Tests of make_can_boot_descriptor.py: the CRC-64-WE engine, image deltas, descriptor patching, signing.
+# Run with "python -m unittest test_make_can_boot_descriptor" or with pytest from this directory.
+#
+
+from __future__ import division, absolute_import, print_function, unicode_literals
+import os
+import sys
+import random
+import shutil
+import hashlib
+import struct
+import tempfile
+import unittest
+from io import BytesIO
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from make_can_boot_descriptor import crc64_we, crc64_we_combine, crc64_we_parallel, CRCCache, AppDescriptor, \
+    FirmwareImage, ImageDelta, patch_descriptor, sign_image, \
+    verify_image
+from benchmark_crc64 import reference_crc64_we
+
+
+def random_bytes(rng, size):
+    return bytes(bytearray(rng.getrandbits(8) for _ in range(size)))
+
+
+def make_image(rng, size, descriptor_offset):
+    """
+    Random unsigned application image with an empty app descriptor at the specified offset.
+    """
+    descriptor = struct.pack("<8sQLLBB6s", AppDescriptor.SIGNATURE, 0, 0, 0x12345678, 1, 2, AppDescriptor.RESERVED)
+    image = bytearray(random_bytes(rng, size))
+    image[descriptor_offset:descriptor_offset + AppDescriptor.LENGTH] = descriptor
+    return bytes(image)
+
+
+class TestCRC64WE(unittest.TestCase):
+    def test_check_value(self):
+        self.assertEqual(crc64_we(b"123456789"), 0x62EC59E3F1A4F00A)
+        self.assertEqual(crc64_we(b""), 0)
+
+    def test_matches_reference(self):
+        rng = random.Random(1)
+        for size in list(range(20)) + [255, 1000, 4099]:
+            data = random_bytes(rng, size)
+            self.assertEqual(crc64_we(data), reference_crc64_we(data), size)
+
+    def test_chaining(self):
+        rng = random.Random(2)
+        data = random_bytes(rng, 3000)
+        for split in [0, 1, 7, 8, 9, 1500, 2999, 3000]:
+            self.assertEqual(crc64_we(data[split:], crc64_we(data[:split])), crc64_we(data), split)
+
+
+class TestCRC64WECombine(unittest.TestCase):
+    def test_random_split_points(self):
+        rng = random.Random(3)
+        for size in [1, 2, 17, 1000, 65537]:
+            data = random_bytes(rng, size)
+            expected = crc64_we(data)
+            for split in [0, size] + [rng.randint(0, size) for _ in range(10)]:
+                a, b = data[:split], data[split:]
+                self.assertEqual(crc64_we_combine(crc64_we(a), crc64_we(b), len(b)), expected, (size, split))
+
+    def test_many_parts(self):
+        rng = random.Random(4)
+        data = random_bytes(rng, 20000)
+        splits = sorted(rng.randint(0, len(data)) for _ in range(30))
+        crc = 0
+        for start, end in zip([0] + splits, splits + [len(data)]):
+            crc = crc64_we_combine(crc, crc64_we(data[start:end]), end - start)
+        self.assertEqual(crc, crc64_we(data))
+
+
+class TestCRC64WEParallel(unittest.TestCase):
+    def setUp(self):
+        handle, self.path = tempfile.mkstemp(suffix=".bin")
+        os.close(handle)
+
+    def tearDown(self):
+        os.remove(self.path)
+
+    def test_matches_serial(self):
+        rng = random.Random(5)
+        data = random_bytes(rng, 100000)
+        expected = crc64_we(data)
+        for chunk_size in [7, 4096, rng.randint(100, 50000), 100000, 200000]:
+            self.assertEqual(crc64_we_parallel([data], 2, chunk_size), expected, chunk_size)
+
+    def test_random_buffer_boundaries(self):
+        rng = random.Random(6)
+        data = random_bytes(rng, 50000)
+        for _ in range(5):
+            splits = sorted(rng.randint(0, len(data)) for _ in range(rng.randint(1, 6)))
+            buffers = [data[start:end] for start, end in zip([0] + splits, splits + [len(data)])]
+            self.assertEqual(crc64_we_parallel(buffers, 3, rng.randint(1000, 20000)), crc64_we(data), splits)
+
+    def test_zeroed_descriptor_window(self):
+        # The image CRC is computed over the image with the image_crc field zeroed out and with the padding
+        # appended; the buffers of FirmwareImage must give the same CRC in serial and in parallel.
+        rng = random.Random(7)
+        for size, descriptor_offset in [(30001, 0), (30002, 1000), (40003, rng.randint(0, 40003 - 32))]:
+            with open(self.path, "wb") as f:
+                f.write(make_image(rng, size, descriptor_offset))
+            with FirmwareImage(self.path, "rb") as image:
+                padding = image.length - size
+                buffers = image._crc_buffers()
+                crc = image.crc
+                content = bytearray(image._content())
+            crc_offset = descriptor_offset + len(AppDescriptor.SIGNATURE)
+
+            content[crc_offset:crc_offset + 8] = b"\x00" * 8
+            content += b"\xff" * padding
+            expected = reference_crc64_we(content)
+
+            self.assertEqual(crc, expected)
+            for chunk_size in [4096, rng.randint(1, 5000), crc_offset, crc_offset + 3]:
+                self.assertEqual(crc64_we_parallel(buffers, 2, chunk_size), expected,
+                                 (size, descriptor_offset, chunk_size))
+
+
+class TestCRCCache(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.image_path = os.path.join(self.directory, "app.bin")
+        self.cache_path = os.path.join(self.directory, "crc_cache.json")
+        # The descriptor is not aligned to the cache blocks
+        self.image = bytearray(make_image(random.Random(11), 10 * CRCCache.BLOCK_SIZE + 123, 5000))
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def crc(self, cache=None):
+        with open(self.image_path, "wb") as f:
+            f.write(self.image)
+        with FirmwareImage(self.image_path, "rb") as image:
+            image.crc_cache = cache
+            return image.crc
+
+    def check(self, cache):
+        # The CRC computed with the cache must always be equal to a full recompute
+        self.assertEqual(self.crc(cache), self.crc())
+
+    def test_cold_and_warm(self):
+        cache = CRCCache(self.cache_path)
+        self.check(cache)
+        self.assertEqual(cache.hits, 0)
+        self.assertGreater(cache.misses, 0)
+        cache.save()
+
+        # One block is changed, the other ones are taken from the cache
+        self.image[8 * CRCCache.BLOCK_SIZE + 7] ^= 0xFF
+        cache = CRCCache(self.cache_path)
+        self.check(cache)
+        self.assertEqual(cache.misses, 1)
+        self.assertGreater(cache.hits, 0)
+
+    def test_descriptor_window_in_cached_block(self):
+        # The blocks around the descriptor are cached with another image_crc, which is zeroed for the CRC,
+        # and with another image_size, which is not
+        cache = CRCCache(self.cache_path)
+        self.check(cache)
+        self.image[5008:5020] = struct.pack("<QL", 0x5555555555555555, 1234)
+        self.check(cache)
+        self.assertGreater(cache.hits, 0)
+        self.image[5008:5020] = struct.pack("<QL", 0xAAAAAAAAAAAAAAAA, 1234)
+        self.check(cache)
+
+    def test_eviction(self):
+        cache = CRCCache(self.cache_path, max_entries=3)
+        self.check(cache)
+        self.assertEqual(len(cache._entries), 3)
+        cache.save()
+
+        # The least recently used blocks have been evicted, only the last ones are left; blocks are aligned to the
+        # beginning of the part of the image after the zeroed image_crc
+        tail = bytes(self.image[5016:])
+        last_blocks = [tail[offset:offset + CRCCache.BLOCK_SIZE]
+                       for offset in range(0, len(tail) - CRCCache.BLOCK_SIZE + 1, CRCCache.BLOCK_SIZE)][-3:]
+        cache = CRCCache(self.cache_path, max_entries=3)
+        self.assertEqual(list(cache._entries.keys()), [hashlib.sha256(x).hexdigest() for x in last_blocks])
+        self.check(cache)
+        self.assertEqual(len(cache._entries), 3)
+
+    def test_corrupted_cache_file(self):
+        cache = CRCCache(self.cache_path)
+        self.check(cache)
+        cache.save()
+        with open(self.cache_path, "rb") as f:
+            content = f.read()
+        for corrupted in [content[:len(content) // 2], b"", b"[]", b'{"block_size": 4096, "entries": 5}',
+                          content.replace(b"4096", b"512")]:
+            with open(self.cache_path, "wb") as f:
+                f.write(corrupted)
+            cache = CRCCache(self.cache_path)
+            self.check(cache)
+            self.assertEqual(cache.hits, 0, corrupted)
+
+
+def sign(image):
+    image = FirmwareImage(BytesIO(image))
+    image.write_descriptor()
+    return image._content()
+
+
+class TestImageDelta(unittest.TestCase):
+    def setUp(self):
+        rng = random.Random(8)
+        self.body = random_bytes(rng, 100000)
+        self.source = sign(make_image(rng, 64, 16) + self.body)
+        self.header = self.source[:64]
+
+    def check(self, target, max_delta_size):
+        target = sign(target)
+        delta = ImageDelta.unpack(ImageDelta.make(self.source, target).pack())
+        self.assertEqual(delta.apply(self.source), target)
+        self.assertLessEqual(len(delta.pack()), max_delta_size)
+
+    def test_identical(self):
+        self.check(self.source, 400)
+
+    def test_unaligned_insertion(self):
+        # The rest of the image is shifted by 4 bytes, which is not a multiple of the block size
+        self.check(self.header + self.body[:1000] + b"\x01\x02\x03\x04" + self.body[1000:], 1000)
+
+    def test_unaligned_deletion(self):
+        self.check(self.header + self.body[:5001] + self.body[5004:], 1000)
+
+    def test_unrelated(self):
+        self.check(self.header + random_bytes(random.Random(9), 3000), 3200)
+
+
+def make_elf(sections, elf_class=1, endian="<"):
+    """
+    Minimal ELF file with the specified sections, a list of (type, flags, contents); there are no segments.
+    """
+    header_format, section_format = {
+        1: ("16sHHLLLLLHHHHHH", "LLLLLLLLLL"),
+        2: ("16sHHLQQQLHHHHHH", "LLQQQQLLQQ"),
+    }[elf_class]
+    header_length = struct.calcsize(endian + header_format)
+    section_length = struct.calcsize(endian + section_format)
+
+    body = b""
+    headers = [struct.pack(endian + section_format, *([0] * 10))]      # The null section
+    for sh_type, sh_flags, contents in sections:
+        offset = header_length + len(body)
+        headers.append(struct.pack(endian + section_format, 0, sh_type, sh_flags, 0, offset, len(contents),
+                                   0, 0, 1, 0))
+        if sh_type != 8:        # NOBITS sections have no contents in the file
+            body += contents
+    ident = b"\x7fELF" + bytearray([elf_class, 1 if endian == "<" else 2, 1]) + b"\x00" * 9
+    header = struct.pack(endian + header_format, ident, 2, 40, 1, 0, 0, header_length + len(body), 0,
+                         header_length, 0, 0, section_length, len(headers), 0)
+    return header + body + b"".join(headers)
+
+
+class TestPatchDescriptor(unittest.TestCase):
+    OLD = struct.pack("<8sQLLBB6s", AppDescriptor.SIGNATURE, 0, 0, 0x12345678, 1, 2, AppDescriptor.RESERVED)
+    NEW = struct.pack("<8sQLLBB6s", AppDescriptor.SIGNATURE, 0x1122334455667788, 1000, 0x12345678, 1, 2,
+                      AppDescriptor.RESERVED)
+    PROGBITS, NOBITS, ALLOC = 1, 8, 2
+
+    def setUp(self):
+        handle, self.path = tempfile.mkstemp(suffix=".elf")
+        os.close(handle)
+
+    def tearDown(self):
+        os.remove(self.path)
+
+    def patch(self, content):
+        with open(self.path, "wb") as f:
+            f.write(content)
+        patch_descriptor(self.path, self.OLD, self.NEW)
+        with open(self.path, "rb") as f:
+            return f.read()
+
+    def test_elf_loaded_section_only(self):
+        # The descriptor is also present in the debug info, which is not loaded, so it is not patched there
+        text = b"\x00" * 100 + self.OLD + b"\x00" * 30
+        for elf_class, endian in [(1, "<"), (2, "<"), (2, ">")]:
+            elf = make_elf([(self.PROGBITS, self.ALLOC, text), (self.PROGBITS, 0, self.OLD)], elf_class, endian)
+            patched = self.patch(elf)
+            self.assertEqual(patched, elf.replace(self.OLD, self.NEW, 1), (elf_class, endian))
+
+    def test_elf_not_found(self):
+        elf = make_elf([(self.PROGBITS, self.ALLOC, b"\x00" * 100), (self.PROGBITS, 0, self.OLD),
+                        (self.NOBITS, self.ALLOC, self.OLD)])
+        with self.assertRaises(ValueError) as context:
+            self.patch(elf)
+        self.assertIn("found at offsets []", str(context.exception))
+
+    def test_elf_found_several_times(self):
+        elf = make_elf([(self.PROGBITS, self.ALLOC, self.OLD), (self.PROGBITS, self.ALLOC, b"\x00" + self.OLD)])
+        with self.assertRaises(ValueError) as context:
+            self.patch(elf)
+        self.assertIn("exactly once", str(context.exception))
+        with open(self.path, "rb") as f:
+            self.assertEqual(f.read(), elf)
+
+    def test_binary(self):
+        binary = b"\xff" * 77 + self.OLD + b"\xff" * 3
+        self.assertEqual(self.patch(binary), b"\xff" * 77 + self.NEW + b"\xff" * 3)
+        with self.assertRaises(ValueError):
+            self.patch(binary + self.OLD)
+
+
+class TestSignImage(unittest.TestCase):
+    BOOTLOADER_SIZE = 4096
+
+    def setUp(self):
+        # Signed images are written into the current directory
+        self.cwd = os.getcwd()
+        self.directory = tempfile.mkdtemp()
+        os.chdir(self.directory)
+        rng = random.Random(10)
+        self.bootloader = random_bytes(rng, 3001)
+        self.application = make_image(rng, 20003, 1024)
+        for name, content in [("bootloader.bin", self.bootloader), ("app.bin", self.application),
+                              ("app.elf", make_elf([(1, 2, self.application)]))]:
+            with open(name, "wb") as f:
+                f.write(content)
+
+    def tearDown(self):
+        os.chdir(self.cwd)
+        shutil.rmtree(self.directory)
+
+    def read(self, name):
+        with open(name, "rb") as f:
+            return f.read()
+
+    def sign(self, **kwargs):
+        return sign_image("app.bin", "com.example.node", "1.0", also_patch_descriptor_in=["app.elf"],
+                          compound_image="app.compound.bin", bootloader="bootloader.bin",
+                          bootloader_size=self.BOOTLOADER_SIZE, **kwargs)
+
+    def test_compound_image_matches_the_makefile_pipeline(self):
+        out_file = self.sign()
+        signed = self.read(out_file)
+        unsigned_descriptor = self.application[1024:1024 + AppDescriptor.LENGTH]
+        signed_descriptor = signed[1024:1024 + AppDescriptor.LENGTH]
+
+        # The compound image used to be made by the Makefile: the bootloader padded with 0xFF, followed by the
+        # unsigned application, where the descriptor was then replaced with the signed one
+        padded_bootloader = self.bootloader + b"\xff" * (self.BOOTLOADER_SIZE - len(self.bootloader))
+        expected = (padded_bootloader + self.application).replace(unsigned_descriptor, signed_descriptor)
+        self.assertEqual(self.read("app.compound.bin"), expected)
+        self.assertEqual(self.read("app.elf"),
+                         make_elf([(1, 2, self.application)]).replace(unsigned_descriptor, signed_descriptor))
+
+        # The signed image itself is the application with the signed descriptor and the padding
+        self.assertEqual(signed[:len(self.application)], expected[self.BOOTLOADER_SIZE:])
+        self.assertEqual(signed[len(self.application):], b"\xff" * (len(signed) - len(self.application)))
+
+    def test_mmap_gives_the_same_output(self):
+        outputs = []
+        for use_mmap in [False, True]:
+            with open("app.elf", "wb") as f:
+                f.write(make_elf([(1, 2, self.application)]))
+            out_file = self.sign(use_mmap=use_mmap)
+            outputs.append([self.read(x) for x in (out_file, "app.compound.bin", "app.elf")])
+            os.remove(out_file)
+        self.assertEqual(outputs[0], outputs[1])
+        self.assertEqual(self.read("app.bin"), self.application)
+
+    def test_verify_image(self):
+        for size in [20003, 20004]:
+            self.application = make_image(random.Random(size), size, 1024)
+            for name, content in [("app.bin", self.application), ("app.elf", make_elf([(1, 2, self.application)]))]:
+                with open(name, "wb") as f:
+                    f.write(content)
+            out_file = self.sign()
+
+            result = verify_image(out_file)
+            self.assertTrue(result["ok"], result)
+            self.assertEqual((result["kind"], result["app_offset"]), ("image", 0))
+            result = verify_image("app.compound.bin")
+            self.assertTrue(result["ok"], result)
+            self.assertEqual((result["kind"], result["app_offset"]), ("compound", self.BOOTLOADER_SIZE))
+
+            # Any modification outside of the descriptor is detected
+            for name in [out_file, "app.compound.bin"]:
+                content = bytearray(self.read(name))
+                content[-size // 2] ^= 1
+                with open(name, "wb") as f:
+                    f.write(content)
+                result = verify_image(name)
+                self.assertFalse(result["ok"], result)
+                self.assertIn("mismatch", result["error"])
+
+        result = verify_image("app.bin")
+        self.assertFalse(result["ok"])
+        self.assertIn("not signed", result["error"])
+        self.assertFalse(verify_image("nonexistent.bin")["ok"])
+
+
+if __name__ == "__main__":
+    unittest.main()
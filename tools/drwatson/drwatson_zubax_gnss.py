@@ -19,21 +19,39 @@
 import os
 import sys
 sys.path.insert(1, os.path.join(sys.path[0], 'pyuavcan'))
+sys.path.insert(1, os.path.join(sys.path[0], '..', '..', 'firmware'))
 
-from drwatson import init, run, make_api_context_with_user_provided_credentials, execute_shell_command,\
-    info, error, input, CLIWaitCursor, download, abort, glob_one, download_newest, open_serial_port,\
-    enforce, SerialCLI, catch, BackgroundSpinner, fatal, warning, BackgroundDelay, imperative
+import drwatson
+from drwatson import init, run, make_api_context_with_user_provided_credentials,\
+    info, error, input, CLIWaitCursor, download, abort, glob_one, open_serial_port,\
+    enforce, catch, fatal, warning, BackgroundDelay, imperative
 import numpy
 import tempfile
 import logging
+import threading
 import time
 import yaml
 import binascii
+import hashlib
+import asyncio
+import contextvars
+import re
+import subprocess
+import json
 import uavcan  # @UnusedImport
 import uavcan.monitors
+from make_can_boot_descriptor import FirmwareImage, verify_image
+from gnss_qualifier import Thresholds, qualify
+from station_timing import StationTiming, format_report
+from gdb_session import GDBSession
+from firmware_cache import FirmwareCache
+from signature_prefetcher import SignaturePrefetcher
 from base64 import b64decode, b64encode
+from io import BytesIO
 from contextlib import closing, contextmanager
 from functools import partial
+from collections import namedtuple, deque, defaultdict
+from concurrent.futures import ThreadPoolExecutor, Future
 
 
 PRODUCT_NAME = 'com.zubax.gnss'
@@ -49,6 +67,31 @@ BOOT_TIMEOUT = 9
 GNSS_FIX_TIMEOUT = 60 * 10
 GNSS_MIN_SAT_TIMEOUT = 60 * 15
 GNSS_MIN_SAT_NUM = 6
+GNSS_QUALIFIER_INTERVAL = 1
+# Sensor noise is characterized over this many seconds of samples against the variance declared by the firmware
+SENSOR_STATS_WINDOW = 10
+SENSOR_OUTLIER_SIGMAS = 5
+SENSOR_MAX_OUTLIER_RATE = 0.01
+SENSOR_MAX_DRIFT_SIGMAS = 3
+# The variance estimated from a short window scatters around the true one, so some margin over the declared is allowed
+SENSOR_MAX_VARIANCE_RATIO = 2
+CACHE_DIR = os.path.join(os.environ.get('XDG_CACHE_HOME', os.path.expanduser('~/.cache')), 'drwatson_zubax_gnss')
+ELF_CACHE_DIR = os.path.join(CACHE_DIR, 'elf')
+FIRMWARE_CACHE_DIR = os.path.join(CACHE_DIR, 'firmware')
+HTTP_TIMEOUT = 10
+ELF_CACHE_MAX_SIZE = 50 * 1024 * 1024
+TELEMETRY_DIR = os.path.join(os.environ.get('XDG_DATA_HOME', os.path.expanduser('~/.local/share')),
+                             'drwatson_zubax_gnss', 'telemetry')
+TELEMETRY_CAPACITY = 2 ** 18
+NODE_SPIN_SLICE = 0.01
+PARAM_REQUEST_TIMEOUT = 1
+PARAM_REQUEST_RETRIES = 2
+SIGNATURE_REQUEST_ATTEMPTS = 5
+SIGNATURE_RETRY_BASE_DELAY = 1
+CLI_PROMPT = b'ch> '
+CLI_COMMAND_TIMEOUT = 2
+# Maximum number of boards that are being tested at once in the pipelined mode
+PIPELINE_DEPTH = 3
 
 
 logger = logging.getLogger('main')
@@ -57,11 +100,188 @@ logger = logging.getLogger('main')
 args = init('''Zubax GNSS production testing application.
 If you're a licensed manufacturer, you should have received usage
 instructions with the manufacturing doc pack.''',
-            lambda p: p.add_argument('iface', help='CAN interface or device path, e.g. "can0", "/dev/ttyACM0", etc.'),
+            lambda p: p.add_argument('iface', nargs='?',
+                                     help='CAN interface or device path, e.g. "can0", "/dev/ttyACM0", etc.'),
             lambda p: p.add_argument('--firmware', '-f', help='location of the firmware file (if not provided, ' +
-                                     'the firmware will be downloaded from Zubax Robotics file server)'),
+                                     'the firmware will be downloaded from Zubax Robotics file server); HTTP URL ' +
+                                     'may contain wildcards, in which case the newest matching file is used'),
+            lambda p: p.add_argument('--fixtures', help='YAML file describing several test fixtures that will be '
+                                     'tested concurrently; if provided, the iface argument is ignored'),
+            lambda p: p.add_argument('--gdb-per-board', action='store_true',
+                                     help='start a new GDB process for every board instead of keeping one '
+                                     'debugger session open'),
+            lambda p: p.add_argument('--pipeline', action='store_true',
+                                     help='overlap test stages of consecutive boards, e.g. flash the next board '
+                                     'while the previous one is waiting for GNSS fix'),
+            lambda p: p.add_argument('--gnss-thresholds', metavar='YAML',
+                                     help='thresholds of the statistical GNSS qualifier, see gnss_qualifier.py'),
+            lambda p: p.add_argument('--telemetry-dir', default=TELEMETRY_DIR,
+                                     help='directory where the messages received from every board during the GNSS '
+                                     'test are saved, default: %(default)s'),
+            lambda p: p.add_argument('--timing-log', default='drwatson_timing.jsonl',
+                                     help='file where the durations of the test stages of every board are appended '
+                                     'as JSON lines, default: %(default)s; see station_timing.py'),
+            lambda p: p.add_argument('--param-requests-in-flight', type=int, default=8, metavar='N',
+                                     help='maximum number of concurrent parameter read/write requests to the node'),
             require_root=True)
 
+
+class Fixture:
+    """
+    Set of interfaces that connect this station to one device under test.
+    Every fixture has its own debugger probe, CAN interface, and USB port.
+    """
+
+    def __init__(self, name, iface, gdb_port_glob=DEBUGGER_PORT_GDB_GLOB, cli_port_glob=DEBUGGER_PORT_CLI_GLOB,
+                 usb_glob=USB_CDC_ACM_GLOB, slcan_iface_name='slcan0'):
+        self.name = name
+        self.iface = iface
+        self.gdb_port_glob = gdb_port_glob
+        self.cli_port_glob = cli_port_glob
+        self.usb_glob = usb_glob
+        self.slcan_iface_name = slcan_iface_name
+        self.num_passed = 0
+        self.num_failed = 0
+
+    def __repr__(self):
+        return 'Fixture(%r, iface=%r, gdb=%r, cli=%r, usb=%r)' % (self.name, self.iface, self.gdb_port_glob,
+                                                                  self.cli_port_glob, self.usb_glob)
+
+
+def load_fixtures():
+    """
+    The fixture file is a YAML list, where every entry contains the keys name, iface, gdb_port, cli_port, usb_port;
+    the port values are globs, like the defaults DEBUGGER_PORT_GDB_GLOB etc.
+    """
+    if not args.fixtures:
+        if not args.iface:
+            fatal('Either the CAN interface or the fixture file must be provided')
+        return [Fixture('default', args.iface)]
+
+    with open(args.fixtures) as f:
+        entries = yaml.safe_load(f)
+
+    fixtures = []
+    for index, e in enumerate(entries):
+        fixtures.append(Fixture(str(e['name']), e['iface'],
+                                gdb_port_glob=e['gdb_port'],
+                                cli_port_glob=e['cli_port'],
+                                usb_glob=e['usb_port'],
+                                slcan_iface_name='slcan%d' % index))
+    if len(set(x.name for x in fixtures)) != len(fixtures):
+        fatal('Fixture names must be unique')
+    return fixtures
+
+
+fixtures = load_fixtures()
+multi_fixture = len(fixtures) > 1
+if multi_fixture and args.pipeline:
+    fatal('Pipelined testing is supported with one fixture only')
+
+gnss_thresholds = Thresholds.load(args.gnss_thresholds, min_sats=GNSS_MIN_SAT_NUM) if args.gnss_thresholds else \
+    Thresholds(min_sats=GNSS_MIN_SAT_NUM)
+
+timing = StationTiming(args.timing_log)
+
+
+def execute_shell_command(fmt, *fmt_args, **kwargs):
+    with timing.span('shell ' + fmt.split()[0]):
+        return drwatson.execute_shell_command(fmt, *fmt_args, **kwargs)
+
+
+def report_timing():
+    summary = timing.summary()
+    logger.info('Station timing:\n%s', format_report(summary))
+    info('Station: %d boards (%d passed), %.1f boards/hour (%.1f with serial execution); the slowest stage is %r',
+         summary['boards'], summary['passed'], summary['boards_per_hour'], summary['serial_boards_per_hour'],
+         summary['slowest_stage'])
+
+
+# Name of the fixture and number of the board that the current thread or task is working on. Threads do not inherit
+# the context, so the work that is delegated to other threads is started in a copy of the context of the fixture.
+current_fixture = contextvars.ContextVar('current_fixture', default=None)
+current_board = contextvars.ContextVar('current_board', default=None)
+
+
+def run_in_fixture_context(fixture, function, *a):
+    context = contextvars.copy_context()
+    context.run(current_fixture.set, fixture.name)
+    return context.run(function, *a)
+
+
+class PromptQueue:
+    """
+    Operator prompts of the boards that are tested concurrently. Every prompt is printed as soon as it is asked,
+    tagged with the key of its board; the operator answers any pending prompt by typing the key followed by the answer,
+    e.g. "B y". If only one prompt is pending, the key can be omitted. The console is locked only while a prompt is
+    being printed, so a prompt that waits for the operator to insert a board does not block the other boards.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._pending = {}          # key -> (text, yes_no, default_answer, future)
+        self._reader = None
+
+    def ask(self, key, text, yes_no=False, default_answer=False):
+        future = Future()
+        with self._lock:
+            assert key not in self._pending, 'Only one prompt per board can be pending'
+            self._pending[key] = text, yes_no, default_answer, future
+            self._show(key)
+            if self._reader is None:
+                self._reader = threading.Thread(target=self._read, name='operator-console', daemon=True)
+                self._reader.start()
+        return future.result()
+
+    def _show(self, key):
+        text, yes_no, default_answer, _ = self._pending[key]
+        if yes_no:
+            text += ' (%s)' % ('Y/n' if default_answer else 'y/N')
+        others = sorted(k for k in self._pending if k != key)
+        hint = ('\nType "%s <answer>" to answer; also waiting for: %s' % (key, ', '.join(others))) if others else ''
+        imperative('[%s] %s%s' % (key, text, hint))
+
+    def _match(self, line):
+        for key in sorted(self._pending, key=len, reverse=True):
+            if line == key or line.startswith(key + ' '):
+                return key, line[len(key):].strip()
+        if len(self._pending) == 1:
+            return next(iter(self._pending)), line
+        return None, line
+
+    def _read(self):
+        while True:
+            line = sys.stdin.readline()
+            if not line:
+                return
+            with self._lock:
+                key, answer = self._match(line.strip())
+                if key is None:
+                    if self._pending:
+                        warning('Several prompts are pending, start the answer with one of: %s',
+                                ', '.join(sorted(self._pending)))
+                    continue
+                _, yes_no, default_answer, future = self._pending[key]
+                if yes_no:
+                    if answer.lower() not in ('', 'y', 'yes', 'n', 'no'):
+                        self._show(key)
+                        continue
+                    answer = answer.lower().startswith('y') if answer else default_answer
+                del self._pending[key]
+            future.set_result(answer)
+
+
+# Boards tested concurrently share the console, so their prompts are answered via the queue
+prompts = PromptQueue() if multi_fixture or args.pipeline else None
+
+
+def fixture_input(fixture, fmt, *a, **kw):
+    with timing.span('operator'):
+        if prompts is None:
+            return input(fmt, *a, **kw)
+        key = fixture.name if multi_fixture else str(current_board.get())
+        return prompts.ask(key, fmt % a if a else fmt, **kw)
+
 info('''
 Usage instructions:
 
@@ -80,36 +300,132 @@ Usage instructions:
 ''')
 
 
+def get_firmware_descriptor(firmware_data):
+    """
+    Returns the offset of the application descriptor in the firmware image and the descriptor itself.
+    """
+    image = FirmwareImage(BytesIO(firmware_data))
+    descriptor = image.app_descriptor
+    if not descriptor.valid:
+        raise ValueError('Firmware image is not signed')
+    return image.app_descriptor_offset, descriptor
+
+
 def get_firmware():
-    if args.firmware:
-        img = download(args.firmware)
+    source = args.firmware or DEFAULT_FIRMWARE_GLOB
+    if not re.match(r'^https?://', source):
+        img = download(source)
+        with tempfile.NamedTemporaryFile(suffix='.bin') as f:
+            f.write(img)
+            f.flush()
+            result = verify_image(f.name)
     else:
-        img = download_newest(DEFAULT_FIRMWARE_GLOB)
+        cache = FirmwareCache(FIRMWARE_CACHE_DIR, HTTP_TIMEOUT, warning)
+        source = cache.resolve_newest(source) if '*' in source or '?' in source else source
+        img = cache.get(source)
+        info('Using firmware %s', source)
+        result = verify_image(cache.path_of(source))
+
+    logger.info('Firmware verification: %r', result)
+    if not result['ok']:
+        fatal('Firmware image %s is invalid: %s', source, result.get('error'))
+
     assert 30 < (len(img) / 1024) <= 240, 'Invalid firmware size'
     return img
 
 
-def load_firmware(firmware_data):
-    with tempfile.TemporaryDirectory('-drwatson') as tmpdir:
-        logger.debug('Executable scratchpad directory: %r', tmpdir)
-        fn = lambda x: os.path.join(tmpdir, x)
-        runtc = lambda fmt, *a, **kw: execute_shell_command(TOOLCHAIN_PREFIX + fmt, *a, **kw)
+elf_cache_lock = threading.Lock()
+
+
+def get_flashable_elf(firmware_data):
+    """
+    Converts the firmware binary into an ELF that can be loaded with GDB. The result is kept in an on-disk cache
+    keyed by the hash of the firmware and of the conversion parameters, so that the toolchain is invoked only
+    once per firmware. The least recently used files are removed once the cache exceeds ELF_CACHE_MAX_SIZE.
+    Returns the path to the ELF file.
+    """
+    key = hashlib.sha256(firmware_data + ('%s %s' % (FLASH_OFFSET, TOOLCHAIN_PREFIX)).encode()).hexdigest()
+    elf_path = os.path.join(ELF_CACHE_DIR, key + '.elf')
+
+    with elf_cache_lock:
+        if os.path.exists(elf_path):
+            logger.debug('Using cached ELF %r', elf_path)
+            os.utime(elf_path)
+            return elf_path
+
+        # The scratchpad is created inside the cache, so that the result can be moved into it with a rename
+        os.makedirs(ELF_CACHE_DIR, exist_ok=True)
+        with tempfile.TemporaryDirectory('-drwatson', dir=ELF_CACHE_DIR) as tmpdir:
+            logger.debug('Executable scratchpad directory: %r', tmpdir)
+            fn = lambda x: os.path.join(tmpdir, x)
+            runtc = lambda fmt, *a, **kw: execute_shell_command(TOOLCHAIN_PREFIX + fmt, *a, **kw)
+
+            # Generating ELF from the downloaded binary
+            with open(fn('fw.bin'), 'wb') as f:
+                f.write(firmware_data)
+
+            with open(fn('link.ld'), 'w') as f:
+                f.write('SECTIONS { . = %s; .text : { *(.text) } }' % FLASH_OFFSET)
+
+            runtc('ld -b binary -r -o %s %s', fn('tmp.elf'), fn('fw.bin'))
+            runtc('objcopy --rename-section .data=.text --set-section-flags .data=alloc,code,load %s', fn('tmp.elf'))
+            runtc('ld %s -T %s -o %s', fn('tmp.elf'), fn('link.ld'), fn('output.elf'))
+
+            # Moving into the cache atomically, so that an interrupted build never leaves a broken file there
+            os.replace(fn('output.elf'), elf_path)
 
-        # Generating ELF from the downloaded binary
-        with open(fn('fw.bin'), 'wb') as f:
-            f.write(firmware_data)
+        entries = [os.path.join(ELF_CACHE_DIR, x) for x in os.listdir(ELF_CACHE_DIR) if x.endswith('.elf')]
+        entries.sort(key=lambda x: os.stat(x).st_mtime, reverse=True)
+        total_size = 0
+        for path in entries:
+            total_size += os.path.getsize(path)
+            if total_size > ELF_CACHE_MAX_SIZE and path != elf_path:
+                logger.debug('Evicting cached ELF %r', path)
+                os.unlink(path)
 
-        with open(fn('link.ld'), 'w') as f:
-            f.write('SECTIONS { . = %s; .text : { *(.text) } }' % FLASH_OFFSET)
+        return elf_path
 
-        runtc('ld -b binary -r -o %s %s', fn('tmp.elf'), fn('fw.bin'))
-        runtc('objcopy --rename-section .data=.text --set-section-flags .data=alloc,code,load %s', fn('tmp.elf'))
-        runtc('ld %s -T %s -o %s', fn('tmp.elf'), fn('link.ld'), fn('output.elf'))
+
+gdb_sessions = {}
+
+
+def get_gdb_target(fixture):
+    # Host:port targets are used for testing against GDB stub servers
+    if re.match(r'^[\w.-]*:\d+$', fixture.gdb_port_glob):
+        return fixture.gdb_port_glob
+    return glob_one(fixture.gdb_port_glob)
+
+
+def load_firmware(firmware_data, fixture, skip_if_present=False):
+    """
+    Returns True if the firmware was loaded. If skip_if_present is set, the app descriptor is read from the
+    target first; if it matches the descriptor of the firmware (which contains the image CRC) and the flash
+    contents are verified, the board is left running and False is returned.
+    This is only supported with persistent debugger sessions.
+    """
+    elf_path = get_flashable_elf(firmware_data)
+
+    if not args.gdb_per_board:
+        target = get_gdb_target(fixture)
+        session = gdb_sessions.get(fixture.name)
+        if session is None or session.target != target:
+            if session is not None:
+                session.close()
+            session = gdb_sessions[fixture.name] = GDBSession(target, TOOLCHAIN_PREFIX + 'gdb')
+
+        skip_if_memory_matches = None
+        if skip_if_present:
+            offset, descriptor = get_firmware_descriptor(firmware_data)
+            skip_if_memory_matches = FLASH_OFFSET + offset, descriptor.pack()
+        return session.flash(elf_path, skip_if_memory_matches)
+
+    with tempfile.TemporaryDirectory('-drwatson') as tmpdir:
+        script_path = os.path.join(tmpdir, 'script.gdb')
 
         # Loading the ELF onto the target
-        with open(fn('script.gdb'), 'w') as f:
+        with open(script_path, 'w') as f:
             f.write('\n'.join([
-                'target extended-remote %s' % glob_one(DEBUGGER_PORT_GDB_GLOB),
+                'target extended-remote %s' % get_gdb_target(fixture),
                 'mon swdp_scan',
                 'attach 1',
                 'load',
@@ -118,21 +434,33 @@ def load_firmware(firmware_data):
                 'quit 0'
             ]))
 
-        runtc('gdb %s --batch -x %s -return-child-result -silent', fn('output.elf'), fn('script.gdb'))
+        execute_shell_command(TOOLCHAIN_PREFIX + 'gdb %s --batch -x %s -return-child-result -silent',
+                              elf_path, script_path)
+    return True
 
 
-def wait_for_boot():
+def wait_for_boot(fixture):
     deadline = time.monotonic() + BOOT_TIMEOUT
+    hung = threading.Event()
+    ports = []
 
     def handle_serial_port_hanging():
-        fatal('DRWATSON HAS DETECTED A PROBLEM WITH CONNECTED HARDWARE AND NEEDS TO TERMINATE.\n'
-              'A serial port operation has timed out. This usually indicates a problem with the connected '
-              'hardware or its drivers. Please disconnect all USB devices currently connected to this computer, '
-              "then connect them back and restart Drwatson. If you're using a virtual machine, please reboot it.",
-              use_abort=True)
-
-    with BackgroundDelay(BOOT_TIMEOUT * 5, handle_serial_port_hanging):
-        with open_serial_port(DEBUGGER_PORT_CLI_GLOB, timeout=BOOT_TIMEOUT) as p:
+        if not multi_fixture:
+            fatal('DRWATSON HAS DETECTED A PROBLEM WITH CONNECTED HARDWARE AND NEEDS TO TERMINATE.\n'
+                  'A serial port operation has timed out. This usually indicates a problem with the connected '
+                  'hardware or its drivers. Please disconnect all USB devices currently connected to this computer, '
+                  "then connect them back and restart Drwatson. If you're using a virtual machine, please reboot it.",
+                  use_abort=True)
+        # The other fixtures keep testing; closing the port interrupts the blocked read of this fixture
+        error('[%s] A serial port operation has timed out. Please reconnect the debugger of this fixture; if that '
+              'does not help, restart Drwatson once the other fixtures have finished their boards.', fixture.name)
+        hung.set()
+        for p in ports:
+            p.close()
+
+    with BackgroundDelay(BOOT_TIMEOUT * 5, partial(contextvars.copy_context().run, handle_serial_port_hanging)):
+        with open_serial_port(fixture.cli_port_glob, timeout=BOOT_TIMEOUT) as p:
+            ports.append(p)
             try:
                 for line in p:
                     if b'Zubax GNSS' in line:
@@ -143,7 +471,11 @@ def wait_for_boot():
             except IOError:
                 logging.info('Boot error', exc_info=True)
             finally:
-                p.flushInput()
+                if not hung.is_set():
+                    p.flushInput()
+
+    if hung.is_set():
+        abort('The serial port of the debugger has hung')
 
     warning("The board did not report to CLI with a correct boot message, but we're going "
             "to continue anyway. Possible reasons for this warning:\n"
@@ -154,11 +486,401 @@ def wait_for_boot():
             'adapter (disconnect from USB and from the board!) or reboot the VM.')
 
 
-def test_uavcan():
+class AsyncNode:
+    """
+    Asyncio wrapper around a UAVCAN node.
+    The node is spun by a background task of the event loop, and the coroutines await service responses and
+    received messages instead of spinning the node in fixed intervals.
+    """
+
+    def __init__(self, node, spin):
+        self.node = node
+        self.loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self.loop)
+        self._spin = spin
+        self._message_waiters = {}
+
+    def close(self):
+        self.loop.close()
+
+    async def _spinner(self):
+        while True:
+            self._spin(NODE_SPIN_SLICE)
+            await asyncio.sleep(0)
+
+    def run(self, coro):
+        spinner = self.loop.create_task(self._spinner())
+        try:
+            return self.loop.run_until_complete(coro)
+        finally:
+            spinner.cancel()
+            self.loop.run_until_complete(asyncio.gather(spinner, return_exceptions=True))
+
+    def request(self, payload, node_id, timeout=None):
+        """
+        Returns a future of the response. The future fails with asyncio.TimeoutError if the request times out.
+        """
+        future = self.loop.create_future()
+        started_at = time.monotonic()
+
+        def callback(e):
+            timing.record('request ' + uavcan.get_uavcan_data_type(payload).full_name, started_at, bool(e))
+            if future.done():       # Cancelled by the caller
+                return
+            if e:
+                future.set_result(e.response)
+            else:
+                future.set_exception(asyncio.TimeoutError())
+
+        kwargs = {'timeout': timeout} if timeout is not None else {}
+        self.node.request(payload, node_id, callback, **kwargs)
+        return future
+
+    def next_message(self, *data_types):
+        """
+        Returns a future of the next received message of any of the specified types.
+        """
+        future = self.loop.create_future()
+        for dt in data_types:
+            if dt not in self._message_waiters:
+                self._message_waiters[dt] = []
+                self.node.add_handler(dt, partial(self._on_message, dt))
+            self._message_waiters[dt] = [f for f in self._message_waiters[dt] if not f.done()] + [future]
+        return future
+
+    def _on_message(self, data_type, e):
+        waiters, self._message_waiters[data_type] = self._message_waiters[data_type], []
+        for f in waiters:
+            if not f.done():
+                f.set_result(e)
+
+    async def wait_until(self, predicate, *data_types, timeout=None):
+        """
+        Waits until the predicate is true; it is re-evaluated every time a message of any of the specified types
+        is received. Returns False if the timeout has expired first.
+        """
+        async def waiter():
+            while not predicate():
+                await self.next_message(*data_types)
+
+        try:
+            await asyncio.wait_for(waiter(), timeout)
+        except asyncio.TimeoutError:
+            return False
+        return True
+
+    async def deadline(self, timeout, coro, error_fmt, *args):
+        """
+        Aborts the test if the coroutine does not complete in time.
+        """
+        try:
+            return await asyncio.wait_for(coro, timeout)
+        except asyncio.TimeoutError:
+            abort(error_fmt, *args)
+
+
+def mean_variance(covariance):
+    """
+    Mean of the diagonal of a covariance matrix in the UAVCAN representation, where the matrix can be empty,
+    scalar, diagonal, upper-right triangle, or full. Returns NaN if the covariance is unknown.
+    """
+    c = list(covariance)
+    diagonal = {
+        0: [],
+        1: c,
+        3: c,
+        6: c[0:1] + c[3:4] + c[5:6],
+        9: c[0:1] + c[4:5] + c[8:9]
+    }.get(len(c), [])
+    return sum(diagonal) / len(diagonal) if diagonal else float('nan')
+
+
+def telemetry_channels():
+    """
+    Returns the list of (channel name, data type, [(column name, extractor)]) recorded during the GNSS test.
+    """
+    return [
+        ('fix', uavcan.equipment.gnss.Fix, [                                            # @UndefinedVariable
+            ('status', lambda m: m.status),
+            ('sats_used', lambda m: m.sats_used),
+            ('pdop', lambda m: m.pdop),
+            ('latitude_deg', lambda m: m.latitude_deg_1e8 * 1e-8),
+            ('longitude_deg', lambda m: m.longitude_deg_1e8 * 1e-8),
+            ('height_msl_m', lambda m: m.height_msl_mm * 1e-3),
+            ('position_variance', lambda m: mean_variance(m.position_covariance)),
+        ]),
+        ('aux', uavcan.equipment.gnss.Auxiliary, [                                      # @UndefinedVariable
+            ('sats_visible', lambda m: m.sats_visible),
+            ('sats_used', lambda m: m.sats_used),
+            ('gdop', lambda m: m.gdop),
+            ('pdop', lambda m: m.pdop),
+            ('hdop', lambda m: m.hdop),
+            ('vdop', lambda m: m.vdop),
+        ]),
+        ('mag', uavcan.equipment.ahrs.MagneticFieldStrength, [                          # @UndefinedVariable
+            ('x_ga', lambda m: m.magnetic_field_ga[0]),
+            ('y_ga', lambda m: m.magnetic_field_ga[1]),
+            ('z_ga', lambda m: m.magnetic_field_ga[2]),
+        ]),
+        ('pressure', uavcan.equipment.air_data.StaticPressure, [                        # @UndefinedVariable
+            ('pressure_pa', lambda m: m.static_pressure),
+            ('variance', lambda m: m.static_pressure_variance),
+        ]),
+        ('temperature', uavcan.equipment.air_data.StaticTemperature, [                  # @UndefinedVariable
+            ('temperature_k', lambda m: m.static_temperature),
+            ('variance', lambda m: m.static_temperature_variance),
+        ]),
+    ]
+
+
+class TelemetryChannel:
+    """
+    Preallocated ring buffer of samples of one message type. Every row contains the reception time followed by
+    the values of the columns; once the buffer is full, the oldest samples are overwritten.
+    """
+
+    def __init__(self, name, columns, capacity):
+        self.name = name
+        self.column_names = ['time'] + [c[0] for c in columns]
+        self._extractors = [c[1] for c in columns]
+        self._data = numpy.empty((capacity, len(self.column_names)), dtype=numpy.float64)
+        self.count = 0
+
+    def append(self, timestamp, message):
+        row = self._data[self.count % len(self._data)]
+        row[0] = timestamp
+        for index, extract in enumerate(self._extractors, 1):
+            row[index] = extract(message)
+        self.count += 1
+
+    def columns(self):
+        return dict(zip(self.column_names, self.samples().T))
+
+    def samples(self):
+        """
+        Returns the stored samples in the chronological order.
+        """
+        if self.count <= len(self._data):
+            return self._data[:self.count]
+        split = self.count % len(self._data)
+        return numpy.concatenate((self._data[split:], self._data[:split]))
+
+
+class TelemetryRecorder:
+    """
+    Records the messages published by the node into one TelemetryChannel per message type.
+    The recording is saved into a directory that contains one .npy file per column, named channel.column.npy,
+    so that the columns of many boards can be memory-mapped with numpy.load(path, mmap_mode='r').
+    """
+
+    def __init__(self, node, node_id, capacity=TELEMETRY_CAPACITY):
+        self._node_id = node_id
+        self._started_at = time.monotonic()
+        self._channels = []
+        self._handles = []
+        for name, data_type, columns in telemetry_channels():
+            channel = TelemetryChannel(name, columns, capacity)
+            self._channels.append(channel)
+            self._handles.append(node.add_handler(data_type, partial(self._on_message, channel)))
+
+    def now(self):
+        return time.monotonic() - self._started_at
+
+    def channel(self, name):
+        return next(ch for ch in self._channels if ch.name == name)
+
+    def _on_message(self, channel, e):
+        if e.transfer.source_node_id == self._node_id:
+            channel.append(self.now(), e.message)
+
+    def close(self):
+        for h in self._handles:
+            h.remove()
+        self._handles = []
+
+    def save(self, directory):
+        try:
+            os.makedirs(directory, exist_ok=True)
+            meta = {'node_id': self._node_id, 'channels': {}}
+            for ch in self._channels:
+                samples = ch.samples()
+                for index, column in enumerate(ch.column_names):
+                    numpy.save(os.path.join(directory, '%s.%s.npy' % (ch.name, column)),
+                               numpy.ascontiguousarray(samples[:, index]))
+                meta['channels'][ch.name] = {
+                    'columns': ch.column_names,
+                    'received': ch.count,
+                    'stored': len(samples)
+                }
+            with open(os.path.join(directory, 'meta.json'), 'w') as f:
+                json.dump(meta, f, indent=1)
+            logger.info('Telemetry saved to %r: %r', directory, meta)
+        except Exception:
+            logger.error('Could not save telemetry to %r', directory, exc_info=True)
+            warning('Could not save telemetry')
+
+
+def characterize_sensor(name, t, values, declared_variance, detect_frozen=True):
+    """
+    Computes the statistics of the samples of one sensor, where values is an array (samples x axes), and checks
+    them against the measurement variance declared by the firmware: the variance around the linear trend,
+    the drift over the window, and the rate of outliers. The variance may exceed the declared one by the factor of
+    SENSOR_MAX_VARIANCE_RATIO. Returns the list of detected problems.
+    The output is reported as frozen if it does not change at all, unless detect_frozen is False.
+    """
+    if len(t) < 10:
+        return ['%s: only %d samples received' % (name, len(t))]
+
+    dt = t - t.mean()
+    mean = values.mean(axis=0)
+    drift_rate = dt.dot(values - mean) / dt.dot(dt)
+    residuals = values - mean - numpy.outer(dt, drift_rate)
+    variance = (residuals ** 2).sum(axis=0) / (len(t) - 2)
+    drift = numpy.abs(drift_rate) * (t[-1] - t[0])
+    sigma = numpy.sqrt(declared_variance)
+    outlier_rate = (numpy.abs(residuals) > SENSOR_OUTLIER_SIGMAS * sigma).mean(axis=0)
+
+    logger.info('%s: %d samples, mean %r, variance %r (declared %r), drift %r, outlier rate %r', name, len(t),
+                mean.tolist(), variance.tolist(), declared_variance, drift.tolist(), outlier_rate.tolist())
+
+    problems = []
+    for axis in range(values.shape[1]):
+        label = name if values.shape[1] == 1 else '%s axis %d' % (name, axis)
+        if detect_frozen and variance[axis] == 0:
+            problems.append('%s: output is frozen at %.6g' % (label, mean[axis]))
+        if variance[axis] > SENSOR_MAX_VARIANCE_RATIO * declared_variance:
+            problems.append('%s: variance %.3g exceeds declared %.3g' % (label, variance[axis], declared_variance))
+        if drift[axis] > SENSOR_MAX_DRIFT_SIGMAS * sigma:
+            problems.append('%s: drift %.3g over %.0f s' % (label, drift[axis], t[-1] - t[0]))
+        if outlier_rate[axis] > SENSOR_MAX_OUTLIER_RATE:
+            problems.append('%s: %.1f%% of samples are outliers' % (label, outlier_rate[axis] * 100))
+    return problems
+
+
+def characterize_sensors(recorder, params):
+    """
+    Characterizes the noise of the air data sensors and the magnetometer over the last SENSOR_STATS_WINDOW seconds
+    of the telemetry; params is the mapping of the node's parameters, which contains the declared variances.
+    """
+    # The temperature is transferred as float16, which has the resolution of 0.25 K at room temperature; that is
+    # much coarser than the noise of the sensor, so a healthy sensor normally reports a constant value.
+    problems = []
+    for channel, columns, variance_param, detect_frozen in [
+            ('pressure', ['pressure_pa'], 'pres.variance', True),
+            ('temperature', ['temperature_k'], 'temp.variance', False),
+            ('mag', ['x_ga', 'y_ga', 'z_ga'], 'mag.variance', True)]:
+        if variance_param not in params:
+            warning('The node does not report the parameter %r, %s noise is not characterized', variance_param,
+                    channel)
+            continue
+        data = recorder.channel(channel).columns()
+        selection = data['time'] >= recorder.now() - SENSOR_STATS_WINDOW
+        problems += characterize_sensor(channel, data['time'][selection],
+                                        numpy.column_stack([data[c][selection] for c in columns]),
+                                        params[variance_param], detect_frozen)
+    if problems:
+        abort('Sensor characterization has failed. Check the sensors.\n%s', '\n'.join(problems))
+
+
+class ParamClient:
+    """
+    Batched client of the service uavcan.protocol.param.GetSet.
+    Up to max_in_flight requests are kept pending at once; every response is matched to its request by the
+    future it was issued with. Timed out requests are re-sent up to PARAM_REQUEST_RETRIES times.
+    """
+
+    def __init__(self, async_node, node_id, max_in_flight=None):
+        self._node = async_node
+        self._node_id = node_id
+        self.max_in_flight = max(1, max_in_flight or args.param_requests_in_flight)
+
+    async def _call(self, req):
+        for attempt in range(PARAM_REQUEST_RETRIES + 1):
+            if attempt:
+                logger.info('Retrying param request %r, attempt %d', req, attempt)
+            try:
+                return await self._node.request(req, self._node_id, timeout=PARAM_REQUEST_TIMEOUT)
+            except asyncio.TimeoutError:
+                pass
+        abort('Param request has timed out %d times: %r', PARAM_REQUEST_RETRIES + 1, req)
+
+    async def _execute(self, requests, until=None):
+        """
+        Returns the responses in the order of requests.
+        If until is provided, requests are not issued past the first response for which until(response) is true;
+        this response is the last one returned.
+        """
+        requests = iter(requests)
+        window = deque()
+        responses = []
+        try:
+            while True:
+                while len(window) < self.max_in_flight:
+                    req = next(requests, None)
+                    if req is None:
+                        break
+                    window.append(self._node.loop.create_task(self._call(req)))
+
+                if not window:
+                    return responses
+
+                r = await window.popleft()
+                responses.append(r)
+                if until is not None and until(r):
+                    return responses
+        finally:
+            for t in window:
+                t.cancel()
+
+    async def dump(self):
+        """
+        Returns the list of (name, value) of all parameters, in the order of their indexes.
+        """
+        requests = (uavcan.protocol.param.GetSet.Request(index=index)  # @UndefinedVariable
+                    for index in range(10000))
+        responses = await self._execute(requests, until=lambda r: not r.name)
+        return [(r.name.decode(), getattr(r.value, r.value.union_field)) for r in responses if r.name]
+
+    async def apply(self, params):
+        """
+        Sets the parameters from the list of (name, value) or (name, value, union_field); every new value is
+        verified against the value reported back by the node.
+        """
+        requests = []
+        for entry in params:
+            name, value = entry[:2]
+            union_field = entry[2] if len(entry) > 2 else {
+                int: 'integer_value',
+                float: 'real_value',
+                bool: 'boolean_value',
+                str: 'string_value'
+            }[type(value)]
+            logger.info('Setting parameter %r field %r value %r', name, union_field, value)
+            req = uavcan.protocol.param.GetSet.Request()                            # @UndefinedVariable
+            req.name.encode(name)
+            setattr(req.value, union_field, value)
+            requests.append((name, union_field, value, req))
+
+        responses = await self._execute(req for _, _, _, req in requests)
+        for (name, union_field, value, _), r in zip(requests, responses):
+            enforce(r.name.decode() == name,
+                    'Param set response for %r refers to another parameter %r', name, r.name.decode())
+            enforce(r.value.union_field == union_field,
+                    'Union field mismatch in param set response for %r', name)
+            enforce(getattr(r.value, union_field) == value,
+                    'The node refused to set parameter %r', name)
+
+
+def test_uavcan(fixture, debug_cli=True):
+    """
+    If debug_cli is False, the debug UART is not used to detect node restarts, because the debugger may be
+    connected to another board at the same time.
+    """
     node_info = uavcan.protocol.GetNodeInfo.Response()  # @UndefinedVariable
     node_info.name.encode('com.zubax.drwatson.zubax_gnss')
 
-    iface = init_can_iface()
+    with timing.span('init_can_iface'):
+        iface = init_can_iface(fixture)
 
     with closing(uavcan.make_node(iface, bitrate=CAN_BITRATE, node_id=127,
                                   mode=uavcan.protocol.NodeStatus().MODE_OPERATIONAL)) as n:  # @UndefinedVariable
@@ -172,130 +894,141 @@ def test_uavcan():
             except uavcan.UAVCANException:
                 logger.error('Node spin failure', exc_info=True)
 
-        @contextmanager
-        def time_limit(timeout, error_fmt, *args):
-            aborter = n.defer(timeout, partial(abort, error_fmt, *args))
-            yield
-            aborter.remove()
-
         # Dynamic node ID allocation
-        try:
-            nsmon = uavcan.monitors.NodeStatusMonitor(n)
-            alloc = uavcan.monitors.DynamicNodeIDServer(n, nsmon)  # @UnusedVariable
-
-            with time_limit(10, 'The node did not show up in time. Probably CAN bus interface is not working.'):
-                while True:
-                    safe_spin(1)
-                    target_nodes = list(nsmon.find_all(lambda e: e.info and e.info.name.decode() == PRODUCT_NAME))
-                    if len(target_nodes) == 1:
-                        break
-                    if len(target_nodes) > 1:
-                        abort('Expected to find exactly one target node, found more: %r', target_nodes)
+        nsmon = uavcan.monitors.NodeStatusMonitor(n)
+        alloc = uavcan.monitors.DynamicNodeIDServer(n, nsmon)  # @UnusedVariable
+
+        node_status_type = uavcan.protocol.NodeStatus                                   # @UndefinedVariable
+        operational = uavcan.protocol.NodeStatus().MODE_OPERATIONAL                     # @UndefinedVariable
+
+        # Restarts are counted per node. The uptime of a restarted node is reset, but if the node is restarted within
+        # the first second after boot, it reports zero uptime both before and after the restart; in that case the
+        # restart is detected from the transfer ID, which starts from zero again instead of continuing the sequence.
+        last_node_status = {}
+        node_restarts = defaultdict(int)
+
+        def on_node_status(e):
+            nid = e.transfer.source_node_id
+            uptime, transfer_id = e.message.uptime_sec, e.transfer.transfer_id
+            if nid in last_node_status:
+                prev_uptime, prev_transfer_id = last_node_status[nid]
+                # Transfer IDs are 5 bits wide
+                if uptime < prev_uptime or (uptime == prev_uptime and transfer_id != (prev_transfer_id + 1) % 32):
+                    logger.info('Node %r has restarted', nid)
+                    node_restarts[nid] += 1
+            last_node_status[nid] = uptime, transfer_id
+
+        n.add_handler(node_status_type, on_node_status)
+
+        async def run_test(anode):
+            def find_target_nodes():
+                return list(nsmon.find_all(lambda e: e.info and e.info.name.decode() == PRODUCT_NAME))
+
+            with timing.span('node discovery'):
+                await anode.deadline(10, anode.wait_until(find_target_nodes, node_status_type),
+                                     'The node did not show up in time. Probably CAN bus interface is not working.')
+            target_nodes = find_target_nodes()
+            if len(target_nodes) > 1:
+                abort('Expected to find exactly one target node, found more: %r', target_nodes)
 
             node_id = target_nodes[0].node_id
+            unique_id = bytes(target_nodes[0].info.hardware_version.unique_id)
+            timing.annotate(unique_id=binascii.hexlify(unique_id).decode())
             info('Node %r initialized', node_id)
             for nd in target_nodes:
                 logger.info('Discovered node %r', nd)
 
-            def request(what, fire_and_forget=False):
-                response_event = None
-
-                def cb(e):
-                    nonlocal response_event
-                    if not e:
-                        abort('Request has timed out: %r', what)
-                    response_event = e  # @UnusedVariable
-
-                if fire_and_forget:
-                    n.request(what, node_id, lambda _: None)
-                    safe_spin(0.1)
-                else:
-                    n.request(what, node_id, cb)
-                    while response_event is None:
-                        safe_spin(0.1)
-                    return response_event.response
+            async def request(what):
+                try:
+                    return await anode.request(what, node_id)
+                except asyncio.TimeoutError:
+                    abort('Request has timed out: %r', what)
 
             # Starting the node and checking its self-reported diag outputs
-            def wait_for_init():
-                with time_limit(10, 'The node did not complete initialization in time'):
-                    while True:
-                        safe_spin(1)
-                        if nsmon.exists(node_id) and nsmon.get(node_id).status.mode == \
-                                uavcan.protocol.NodeStatus().MODE_OPERATIONAL:              # @UndefinedVariable
-                            break
+            async def wait_for_init():
+                await anode.deadline(10, anode.wait_until(
+                    lambda: nsmon.exists(node_id) and nsmon.get(node_id).status.mode == operational,
+                    node_status_type), 'The node did not complete initialization in time')
 
             def check_status():
                 status = nsmon.get(node_id).status
-                enforce(status.mode == uavcan.protocol.NodeStatus().MODE_OPERATIONAL,   # @UndefinedVariable
-                        'Unexpected operating mode')
+                enforce(status.mode == operational, 'Unexpected operating mode')
                 enforce(status.health == uavcan.protocol.NodeStatus().HEALTH_OK,        # @UndefinedVariable
                         'Bad node health')
 
             info('Waiting for the node to complete initialization...')
-            wait_for_init()
+            await wait_for_init()
             check_status()
 
             info('Reconfiguring the node...')
 
-            def log_all_params():
-                for index in range(10000):
-                    r = request(uavcan.protocol.param.GetSet.Request(index=index))  # @UndefinedVariable
-                    if not r.name:
-                        break
-                    logger.info('Param %-30r %r' % (r.name.decode(), getattr(r.value, r.value.union_field)))
-
-            def set_param(name, value, union_field=None):
-                union_field = union_field or {
-                    int: 'integer_value',
-                    float: 'real_value',
-                    bool: 'boolean_value',
-                    str: 'string_value'
-                }[type(value)]
-                logger.info('Setting parameter %r field %r value %r', name, union_field, value)
-                req = uavcan.protocol.param.GetSet.Request()                            # @UndefinedVariable
-                req.name.encode(name)
-                setattr(req.value, union_field, value)
-                r = request(req)
-                enforce(r.value.union_field == union_field,
-                        'Union field mismatch in param set response for %r', name)
-                enforce(getattr(r.value, union_field) == value,
-                        'The node refused to set parameter %r', name)
-
-            set_param('uavcan.pubp-time', 10000)
-            set_param('uavcan.pubp-stat', 2000)
-            set_param('uavcan.pubp-pres', 10000)
-            set_param('uavcan.pubp-mag', 20000)
-            set_param('uavcan.pubp-fix', 66666)
-            set_param('uavcan.pubp-aux', 100000)
-
-            enforce(request(uavcan.protocol.param.ExecuteOpcode.Request(                # @UndefinedVariable
-                opcode=uavcan.protocol.param.ExecuteOpcode.Request().OPCODE_SAVE)).ok,  # @UndefinedVariable
-                'Could not save configuration')
-
-            request(uavcan.protocol.RestartNode.Request(                                # @UndefinedVariable
-                magic_number=uavcan.protocol.RestartNode.Request().MAGIC_NUMBER),       # @UndefinedVariable
-                fire_and_forget=True)
-
-            # Don't tell anybody I wrote this. I'm ashamed of this shit and too tired to redesign it. :(
-            with BackgroundSpinner(safe_spin, 0.1):
-                wait_for_boot()
-
-            wait_for_init()
+            params = ParamClient(anode, node_id)
+
+            async def log_all_params():
+                with timing.span('param dump'):
+                    dump = await params.dump()
+                for name, value in dump:
+                    logger.info('Param %-30r %r' % (name, value))
+                return dict(dump)
+
+            with timing.span('param reconfiguration'):
+                await params.apply([
+                    ('uavcan.pubp-time', 10000),
+                    ('uavcan.pubp-stat', 2000),
+                    ('uavcan.pubp-pres', 10000),
+                    ('uavcan.pubp-mag', 20000),
+                    ('uavcan.pubp-fix', 66666),
+                    ('uavcan.pubp-aux', 100000),
+                ])
+
+                enforce((await request(uavcan.protocol.param.ExecuteOpcode.Request(     # @UndefinedVariable
+                    opcode=uavcan.protocol.param.ExecuteOpcode.Request().OPCODE_SAVE))).ok,  # @UndefinedVariable
+                    'Could not save configuration')
+
+            async def restart_node():
+                with timing.span('restart'):
+                    await restart_node_impl()
+
+            async def restart_node_impl():
+                restarts_before = node_restarts[node_id]
+                n.request(uavcan.protocol.RestartNode.Request(                          # @UndefinedVariable
+                    magic_number=uavcan.protocol.RestartNode.Request().MAGIC_NUMBER),   # @UndefinedVariable
+                    node_id, lambda _: None)
+
+                if debug_cli:
+                    # The event loop keeps spinning the node while the debug UART is being read
+                    await anode.loop.run_in_executor(None, contextvars.copy_context().run, wait_for_boot, fixture)
+
+                # The status monitor reports the mode of the node before the restart until the node publishes its
+                # status again, so the initialization is awaited only after the restart has been detected
+                await anode.deadline(BOOT_TIMEOUT * 2, anode.wait_until(
+                    lambda: node_restarts[node_id] > restarts_before, node_status_type),
+                    'The node did not restart in time')
+                await wait_for_init()
+
+            await restart_node()
             check_status()
-            log_all_params()
+            node_params = await log_all_params()
 
             def make_collector(data_type, timeout=0.1):
                 return uavcan.monitors.MessageCollector(n, data_type, timeout=timeout)
 
-            col_fix = make_collector(uavcan.equipment.gnss.Fix, 0.2)                    # @UndefinedVariable
-            col_aux = make_collector(uavcan.equipment.gnss.Auxiliary, 0.2)              # @UndefinedVariable
-            col_mag = make_collector(uavcan.equipment.ahrs.MagneticFieldStrength)       # @UndefinedVariable
-            col_pressure = make_collector(uavcan.equipment.air_data.StaticPressure)     # @UndefinedVariable
-            col_temp = make_collector(uavcan.equipment.air_data.StaticTemperature)      # @UndefinedVariable
+            fix_type = uavcan.equipment.gnss.Fix                                        # @UndefinedVariable
+            aux_type = uavcan.equipment.gnss.Auxiliary                                  # @UndefinedVariable
+            sensor_types = (uavcan.equipment.ahrs.MagneticFieldStrength,                # @UndefinedVariable
+                            uavcan.equipment.air_data.StaticPressure,                   # @UndefinedVariable
+                            uavcan.equipment.air_data.StaticTemperature)                # @UndefinedVariable
+
+            col_fix = make_collector(fix_type, 0.2)
+            col_aux = make_collector(aux_type, 0.2)
+            col_mag, col_pressure, col_temp = [make_collector(dt) for dt in sensor_types]
 
             def check_everything():
                 check_status()
 
+                if node_id not in col_fix or node_id not in col_aux:
+                    abort('GNSS measurements are not available. Check the receiver.')
+
                 try:
                     m = col_pressure[node_id].message
                 except KeyError:
@@ -322,92 +1055,199 @@ def test_uavcan():
                         abort('Invalid magnetic field strength reading: %d Gauss. Check the sensor.',
                               magnetic_field_scalar)
 
-            imperative('Testing GNSS performance. Place the device close to a window to ensure decent GNSS reception. '
-                       'Please note that this test is very crude, it can only detect whether GNSS circuit is working '
-                       'at all or not. If GNSS performance is degraded due to improper manufacturing process, '
-                       'this test may fail to detect it, so please double check that your manufacturing process '
-                       'adheres to the documentation.')
-            info('Waiting for GNSS fix...')
-            with time_limit(GNSS_FIX_TIMEOUT, 'GNSS fix timeout. Check the RF circuit, AFE, antenna, and receiver'):
-                while True:
-                    safe_spin(1)
-                    check_everything()
-                    sats_visible = col_aux[node_id].message.sats_visible
-                    sats_used = col_aux[node_id].message.sats_used
-                    sys.stdout.write('\rsat stats: visible %d, used %d   \r' % (sats_visible, sats_used))
-                    sys.stdout.flush()
-                    if col_fix[node_id].message.status >= 3:
-                        break
+            # The signature is requested while the GNSS test is running, so that it is ready for the USB test.
+            # This is not done earlier, so that signatures are not generated for boards that fail the basic checks.
+            signatures.prefetch(unique_id)
 
-            info('Waiting for %d satellites...', GNSS_MIN_SAT_NUM)
-            with time_limit(GNSS_MIN_SAT_TIMEOUT,
-                            'GNSS performance is degraded. Could be caused by incorrectly assembled RF circuit.'):
-                while True:
-                    safe_spin(0.5)
+            recorder = TelemetryRecorder(n, node_id)
+            try:
+                imperative('Testing GNSS performance. Place the device close to a window to ensure decent GNSS '
+                           'reception. Please note that this test is very crude, it can only detect whether GNSS '
+                           'circuit is working at all or not. If GNSS performance is degraded due to improper '
+                           'manufacturing process, this test may fail to detect it, so please double check that your '
+                           'manufacturing process adheres to the documentation.')
+
+                # Giving the node up to one second to publish every measurement; the missing ones are reported by
+                # check_everything(), which aborts the test
+                if not await anode.wait_until(lambda: all(node_id in c for c in (col_fix, col_aux, col_mag,
+                                                                                 col_pressure, col_temp)),
+                                              fix_type, aux_type, *sensor_types, timeout=1):
                     check_everything()
-                    num = col_fix[node_id].message.sats_used
-                    pos_cov = list(col_fix[node_id].message.position_covariance)
-                    sys.stdout.write('\r%d sats, pos covariance: %r      \r' % (num, pos_cov))
-                    sys.stdout.flush()
-                    if num >= GNSS_MIN_SAT_NUM:
-                        break
 
-            check_everything()
+                info('Waiting for GNSS fix...')
+                progress_prefix = ('[%s] ' % fixture.name) if multi_fixture else ''
+
+                # The qualifier ends the GNSS test as soon as its outcome is predicted with sufficient confidence
+                gnss_deadline = recorder.now() + GNSS_FIX_TIMEOUT + GNSS_MIN_SAT_TIMEOUT
+                qualified_at = 0
+
+                def qualify_gnss():
+                    nonlocal qualified_at
+                    if recorder.now() - qualified_at < GNSS_QUALIFIER_INTERVAL:
+                        return False
+                    qualified_at = recorder.now()
+                    verdict = qualify(recorder.channel('fix').columns(), recorder.channel('aux').columns(),
+                                      qualified_at, gnss_deadline, gnss_thresholds)
+                    logger.debug('GNSS qualifier verdict: %r', verdict)
+                    if verdict.passed is False:
+                        abort('GNSS performance is degraded (confidence %.1f%%: %s). '
+                              'Check the RF circuit, AFE, antenna, and receiver', verdict.confidence * 100,
+                              verdict.reason)
+                    if verdict.passed:
+                        info('GNSS qualified with confidence %.1f%%: %s', verdict.confidence * 100, verdict.reason)
+                    return bool(verdict.passed)
+
+                async def next_gnss_update():
+                    # Wakes up at least once a second, so that the checks keep running if the receiver goes silent
+                    try:
+                        await asyncio.wait_for(anode.next_message(fix_type, aux_type), 1)
+                    except asyncio.TimeoutError:
+                        pass
+
+                async def wait_for_fix():
+                    while True:
+                        await next_gnss_update()
+                        check_everything()
+                        sats_visible = col_aux[node_id].message.sats_visible
+                        sats_used = col_aux[node_id].message.sats_used
+                        sys.stdout.write('\r%ssat stats: visible %d, used %d   \r' % (progress_prefix, sats_visible,
+                                                                                     sats_used))
+                        sys.stdout.flush()
+                        if qualify_gnss():
+                            return True
+                        if col_fix[node_id].message.status >= 3:
+                            return False
+
+                async def wait_for_satellites():
+                    while True:
+                        await next_gnss_update()
+                        check_everything()
+                        num = col_fix[node_id].message.sats_used
+                        pos_cov = list(col_fix[node_id].message.position_covariance)
+                        sys.stdout.write('\r%s%d sats, pos covariance: %r      \r' % (progress_prefix, num, pos_cov))
+                        sys.stdout.flush()
+                        if num >= GNSS_MIN_SAT_NUM or qualify_gnss():
+                            break
 
-            info('Last sampled sensor measurements are provided below. They appear to be correct.')
-            info('GNSS fix: %r', col_fix[node_id].message)
-            info('GNSS aux: %r', col_aux[node_id].message)
-            info('Magnetic field [Ga]: %r', col_mag[node_id].message)
-            info('Pressure [Pa]: %r', col_pressure[node_id].message)
-            info('Temperature [K]: %r', col_temp[node_id].message)
+                with timing.span('gnss fix'):
+                    qualified = await anode.deadline(GNSS_FIX_TIMEOUT, wait_for_fix(),
+                                                     'GNSS fix timeout. Check the RF circuit, AFE, antenna, and '
+                                                     'receiver')
+
+                if not qualified:
+                    info('Waiting for %d satellites...', GNSS_MIN_SAT_NUM)
+                    with timing.span('gnss satellites'):
+                        await anode.deadline(GNSS_MIN_SAT_TIMEOUT, wait_for_satellites(),
+                                             'GNSS performance is degraded. '
+                                             'Could be caused by incorrectly assembled RF circuit.')
+
+                check_everything()
+
+                await anode.deadline(SENSOR_STATS_WINDOW * 2,
+                                     anode.wait_until(lambda: recorder.now() >= SENSOR_STATS_WINDOW, *sensor_types),
+                                     'Sensor measurements are not being received. Check the sensors.')
+                with timing.span('sensor characterization'):
+                    characterize_sensors(recorder, node_params)
+
+                info('Last sampled sensor measurements are provided below. They appear to be correct.')
+                info('GNSS fix: %r', col_fix[node_id].message)
+                info('GNSS aux: %r', col_aux[node_id].message)
+                info('Magnetic field [Ga]: %r', col_mag[node_id].message)
+                info('Pressure [Pa]: %r', col_pressure[node_id].message)
+                info('Temperature [K]: %r', col_temp[node_id].message)
+            finally:
+                recorder.close()
+                recorder.save(os.path.join(args.telemetry_dir, binascii.hexlify(unique_id).decode(),
+                                           time.strftime('%Y%m%d-%H%M%S')))
 
             # Finalizing the test
             info('Resetting the configuration to factory default...')
-            enforce(request(uavcan.protocol.param.ExecuteOpcode.Request(                # @UndefinedVariable
-                opcode=uavcan.protocol.param.ExecuteOpcode.Request().OPCODE_ERASE)).ok,  # @UndefinedVariable
+            enforce((await request(uavcan.protocol.param.ExecuteOpcode.Request(         # @UndefinedVariable
+                opcode=uavcan.protocol.param.ExecuteOpcode.Request().OPCODE_ERASE))).ok,  # @UndefinedVariable
                 'Could not erase configuration')
 
-            request(uavcan.protocol.RestartNode.Request(                                # @UndefinedVariable
-                magic_number=uavcan.protocol.RestartNode.Request().MAGIC_NUMBER),       # @UndefinedVariable
-                fire_and_forget=True)
-
-            with BackgroundSpinner(safe_spin, 0.1):
-                wait_for_boot()
-
-            wait_for_init()
+            await restart_node()
             check_status()
-            log_all_params()
+            await log_all_params()
+
+        try:
+            with closing(AsyncNode(n, safe_spin)) as anode:
+                anode.run(run_test(anode))
         except Exception:
             for nid in nsmon.get_all_node_id():
                 print('Node state: %r' % nsmon.get(nid))
             raise
 
     # Blocking questions are moved out of the node scope because blocking breaks CAN communications
-    if not input('Is the PPS LED blinking once per second?', yes_no=True, default_answer=True):
+    if not fixture_input(fixture, 'Is the PPS LED blinking once per second?', yes_no=True, default_answer=True):
         abort('PPS LED is not working')
 
-    if not input('Is the CAN1 LED blinking or glowing solid?', yes_no=True, default_answer=True):
+    if not fixture_input(fixture, 'Is the CAN1 LED blinking or glowing solid?', yes_no=True, default_answer=True):
         abort('CAN1 LED is not working (however the interface is fine)')
 
-    if not input('Is the STATUS LED blinking once per second?', yes_no=True, default_answer=True):
+    if not fixture_input(fixture, 'Is the STATUS LED blinking once per second?', yes_no=True, default_answer=True):
         abort('STATUS LED is not working')
 
     # Testing CAN2
-    input('1. Disconnect CAN1 and connect to CAN2\n'
-          '2. Terminate CAN2\n'
-          '3. Press ENTER')
-    if not input('Is the CAN2 LED blinking or glowing solid?', yes_no=True, default_answer=True):
+    fixture_input(fixture,
+                  '1. Disconnect CAN1 and connect to CAN2\n'
+                  '2. Terminate CAN2\n'
+                  '3. Press ENTER')
+    if not fixture_input(fixture, 'Is the CAN2 LED blinking or glowing solid?', yes_no=True, default_answer=True):
         abort('Either CAN2 or its LED are not working')
 
 
-def init_can_iface():
-    if '/' not in args.iface:
-        logger.debug('Using iface %r as SocketCAN', args.iface)
-        execute_shell_command('ifconfig %s down && ip link set %s up type can bitrate %d sample-point 0.875',
-                              args.iface, args.iface, CAN_BITRATE)
-        return args.iface
+def poll(predicate, timeout, interval=0.02):
+    """
+    Waits until the predicate is true; returns False if it did not become true in time.
+    """
+    deadline = time.monotonic() + timeout
+    while not predicate():
+        if time.monotonic() > deadline:
+            return False
+        time.sleep(interval)
+    return True
+
+
+def netdev_is_up(name):
+    try:
+        with open('/sys/class/net/%s/flags' % name) as f:
+            flags = int(f.read(), 16)
+        with open('/sys/class/net/%s/operstate' % name) as f:
+            operstate = f.read().strip()
+    except (OSError, ValueError):
+        return False
+    # SLCAN reports the operstate 'unknown'; SocketCAN reports 'down' while the bus is off
+    return bool(flags & 1) and operstate != 'down'
+
+
+def slcand_is_running(tty):
+    return subprocess.call(['pgrep', '-f', '^slcand %s( |$)' % tty], stdout=subprocess.DEVNULL) == 0
+
+
+# Fixture iface -> network interface name, for interfaces that have been configured by this process
+configured_can_ifaces = {}
+
+
+def init_can_iface(fixture):
+    """
+    Configures the CAN interface of the fixture unless it has been configured earlier and is still up.
+    """
+    iface_name = configured_can_ifaces.get(fixture.iface)
+    if iface_name and netdev_is_up(iface_name) and \
+            ('/' not in fixture.iface or slcand_is_running(os.path.realpath(fixture.iface).replace('/dev/', ''))):
+        logger.debug('CAN iface %r is already up', iface_name)
+        return iface_name
+
+    if '/' not in fixture.iface:
+        logger.debug('Using iface %r as SocketCAN', fixture.iface)
+        # The kernel restarts the interface automatically after bus off, so it does not need to be reconfigured
+        execute_shell_command('ip link set %s down && ip link set %s up type can bitrate %d sample-point 0.875 '
+                              'restart-ms 100', fixture.iface, fixture.iface, CAN_BITRATE)
+        configured_can_ifaces[fixture.iface] = fixture.iface
+        return fixture.iface
     else:
-        logger.debug('Using iface %r as SLCAN', args.iface)
+        logger.debug('Using iface %r as SLCAN', fixture.iface)
 
         speed_code = {
             1000000: 8,
@@ -417,45 +1257,57 @@ def init_can_iface():
             100000: 3
         }[CAN_BITRATE]
 
-        execute_shell_command('killall -INT slcand &> /dev/null', ignore_failure=True)
-        time.sleep(1)
-
-        tty = os.path.realpath(args.iface).replace('/dev/', '')
+        tty = os.path.realpath(fixture.iface).replace('/dev/', '')
         logger.debug('TTY %r', tty)
 
+        # Only the daemon that serves this fixture is stopped; other fixtures may be running their tests
+        execute_shell_command('pkill -INT -f "^slcand %s( |$)" &> /dev/null', tty, ignore_failure=True)
+        enforce(poll(lambda: not slcand_is_running(tty), 3), 'slcand on %r did not terminate', tty)
+
         execute_shell_command('slcan_attach -f -o -s%d /dev/%s', speed_code, tty)
-        execute_shell_command('slcand %s', tty)
+        execute_shell_command('slcand %s %s', tty, fixture.slcan_iface_name)
 
-        iface_name = 'slcan0'
-        time.sleep(1)
-        execute_shell_command('ifconfig %s up', iface_name)
-        execute_shell_command('ifconfig %s txqueuelen 1000', iface_name)
+        iface_name = fixture.slcan_iface_name
+        enforce(poll(lambda: os.path.exists('/sys/class/net/' + iface_name), 5),
+                'SLCAN interface %r did not appear', iface_name)
+        execute_shell_command('ip link set %s up txqueuelen 1000', iface_name)
 
+        configured_can_ifaces[fixture.iface] = iface_name
         return iface_name
 
 
 def check_interfaces():
-    ok = True
-
     def test_serial_port(glob, name):
         try:
-            with open_serial_port(DEBUGGER_PORT_GDB_GLOB):
+            with open_serial_port(glob):
                 info('%s port is OK', name)
                 return True
         except Exception:
             error('%s port is not working', name)
             return False
 
+    def test_can_iface(fx, name):
+        try:
+            init_can_iface(fx)
+            info('%s interface is OK', name)
+            return True
+        except Exception:
+            logging.debug('CAN check error', exc_info=True)
+            error('%s interface is not working', name)
+            return False
+
     info('Checking interfaces...')
-    ok = test_serial_port(DEBUGGER_PORT_GDB_GLOB, 'GDB') and ok
-    ok = test_serial_port(DEBUGGER_PORT_CLI_GLOB, 'CLI') and ok
-    try:
-        init_can_iface()
-        info('CAN interface is OK')
-    except Exception:
-        logging.debug('CAN check error', exc_info=True)
-        error('CAN interface is not working')
-        ok = False
+    # All interfaces are independent, so they are checked concurrently
+    with ThreadPoolExecutor(max_workers=len(fixtures) * 3) as executor:
+        checks = []
+        for fx in fixtures:
+            prefix = ('Fixture %s: ' % fx.name) if multi_fixture else ''
+            checks.append(executor.submit(run_in_fixture_context, fx, test_serial_port, fx.gdb_port_glob,
+                                          prefix + 'GDB'))
+            checks.append(executor.submit(run_in_fixture_context, fx, test_serial_port, fx.cli_port_glob,
+                                          prefix + 'CLI'))
+            checks.append(executor.submit(run_in_fixture_context, fx, test_can_iface, fx, prefix + 'CAN'))
+        ok = all([c.result() for c in checks])
 
     if not ok:
         fatal('Required interfaces are not available. Please check your hardware configuration. '
@@ -465,54 +1317,130 @@ def check_interfaces():
 check_interfaces()
 
 licensing_api = make_api_context_with_user_provided_credentials()
+signatures = SignaturePrefetcher(licensing_api, PRODUCT_NAME, SIGNATURE_REQUEST_ATTEMPTS, SIGNATURE_RETRY_BASE_DELAY)
 
 with CLIWaitCursor():
     print('Please wait...')
     firmware_data = get_firmware()
 
 
-def process_one_device():
-    out = input('1. Connect DroneCode Probe to the debug connector\n'
-                '2. Connect CAN to the first CAN1 connector on the device; terminate the other CAN1 connector\n'
-                '3. Connect USB to the device, and make sure that no other Zubax GNSS is connected\n'
-                '4. If you want to skip firmware upload, type F\n'
-                '5. Press ENTER')
+def flash_device(fixture):
+    info('Loading the firmware')
+    with CLIWaitCursor():
+        with timing.span('load_firmware'):
+            loaded = load_firmware(firmware_data, fixture, skip_if_present=True)
+    if loaded:
+        info('Waiting for the board to boot...')
+        with timing.span('wait_for_boot'):
+            wait_for_boot(fixture)
+    else:
+        info('The board is already running this firmware (image CRC 0x%016x), loading skipped',
+             get_firmware_descriptor(firmware_data)[1].image_crc)
+
+
+def process_one_device(fixture):
+    try:
+        with timing.board(fixture=fixture.name), signatures.board():
+            test_one_device(fixture)
+    finally:
+        report_timing()
+
+
+def test_one_device(fixture):
+    out = fixture_input(fixture,
+                        '1. Connect DroneCode Probe to the debug connector\n'
+                        '2. Connect CAN to the first CAN1 connector on the device; terminate the other CAN1 connector\n'
+                        '3. Connect USB to the device, and make sure that no other Zubax GNSS is connected\n'
+                        '4. If you want to skip firmware upload, type F\n'
+                        '5. Press ENTER')
 
     skip_fw_upload = 'f' in out.lower()
     if not skip_fw_upload:
-        info('Loading the firmware')
-        with CLIWaitCursor():
-            load_firmware(firmware_data)
-        info('Waiting for the board to boot...')
-        wait_for_boot()
+        flash_device(fixture)
     else:
         info('Firmware upload skipped')
 
     info('Testing UAVCAN interface...')
-    test_uavcan()
-
-    input("Now we're going to test USB. If this application is running on a virtual "
-          "machine, make sure that the corresponsing USB device is made available for "
-          "the VM, then press ENTER.")
+    test_uavcan(fixture)
+
+    fixture_input(fixture,
+                  "Now we're going to test USB. If this application is running on a virtual "
+                  "machine, make sure that the corresponsing USB device is made available for "
+                  "the VM, then press ENTER.")
+    test_usb(fixture)
+
+
+class PromptCLI:
+    """
+    Client of the firmware's command line shell, which echoes every command and prints the prompt once the command
+    has finished. The output of a command is complete as soon as the next prompt arrives, so no time is spent
+    waiting for read timeouts. Several commands can be sent at once; the shell executes them in order.
+    """
+
+    def __init__(self, io, timeout=CLI_COMMAND_TIMEOUT):
+        self._io = io
+        self._io.timeout = 0.01
+        self.timeout = timeout
+        self._buffer = b''
+
+    def _read_until_prompt(self, deadline):
+        while True:
+            pos = self._buffer.find(CLI_PROMPT)
+            if pos >= 0:
+                out, self._buffer = self._buffer[:pos], self._buffer[pos + len(CLI_PROMPT):]
+                return out
+            if time.monotonic() > deadline:
+                abort('CLI did not respond in time; received so far: %r', self._buffer)
+            self._buffer += self._io.read(max(1, self._io.inWaiting()))
+
+    def synchronize(self):
+        """
+        Discards all pending output, e.g. the boot banner, up to the prompt printed in response to an empty line.
+        """
+        self._io.flushInput()
+        self._buffer = b''
+        self._io.write(b'\r\n')
+        self._read_until_prompt(time.monotonic() + self.timeout)
+
+    def execute(self, *commands):
+        """
+        Sends the commands at once and returns the list of output lines of every command.
+        Aborts if a command is not recognized by the shell or does not complete in time.
+        """
+        self._io.write(b''.join(c.encode() + b'\r\n' for c in commands))
+        deadline = time.monotonic() + self.timeout * len(commands)
+        outputs = []
+        for command in commands:
+            lines = []
+            while not lines:        # Empty lines produce bare prompts, which are skipped
+                lines = [x.strip() for x in self._read_until_prompt(deadline).decode('utf8', 'replace').splitlines()]
+                lines = [x for x in lines if x]
+            enforce(lines[0] == command, 'Unexpected CLI echo %r, expected %r', lines[0], command)
+            enforce(lines[1:] != [command.split()[0] + ' ?'], 'Command not recognized by CLI: %r', command)
+            outputs.append(lines[1:])
+        return outputs
+
+
+def test_usb(fixture):
     info('Connecting via USB...')
-    with open_serial_port(USB_CDC_ACM_GLOB) as io:
+    with open_serial_port(fixture.usb_glob) as io:
         logger.info('USB CLI is on %r', io.port)
-        cli = SerialCLI(io, 0.1)
-        cli.flush_input(0.5)
-
-        out = cli.write_line_and_read_output_lines_until_timeout('systime')
+        cli = PromptCLI(io)
+        with timing.span('usb cli'):
+            cli.synchronize()
+            out, zubax_id = cli.execute('systime', 'zubax_id')
         enforce(len(out) == 1, 'Unexpected CLI output: %r', out)
         enforce(catch()(int)(out[0]) > 0, 'Expected integer, got this: %r', out[0])
 
-        zubax_id = cli.write_line_and_read_output_lines_until_timeout('zubax_id')
         zubax_id = yaml.load('\n'.join(zubax_id))
         logger.info('Zubax ID: %r', zubax_id)
 
         unique_id = b64decode(zubax_id['hw_unique_id'])
 
-        # Getting the signature
-        info('Requesting signature for unique ID %s', binascii.hexlify(unique_id).decode())
-        gensign_response = licensing_api.generate_signature(unique_id, PRODUCT_NAME)
+        # Getting the signature; normally it has been requested in the background during the GNSS test
+        info('Getting signature for unique ID %s', binascii.hexlify(unique_id).decode())
+        with timing.span('signing'):
+            gensign_response = signatures.get(unique_id)
         if gensign_response.new:
             info('New signature has been generated')
         else:
@@ -520,12 +1448,13 @@ def process_one_device():
         base64_signature = b64encode(gensign_response.signature).decode()
         logger.info('Generated signature in Base64: %s', base64_signature)
 
-        # Installing the signature; this may fail if the device has been signed earlier - the failure will be ignored
-        out = cli.write_line_and_read_output_lines_until_timeout('signature %s', base64_signature)
-        logger.debug('Signature installation response (may fail, which is OK): %r', out)
+        # Installing the signature and reading it back; the installation may fail if the device has been signed
+        # earlier - the failure will be ignored
+        with timing.span('signature installation'):
+            install_out, out = cli.execute('signature %s' % base64_signature, 'signature')
+        logger.debug('Signature installation response (may fail, which is OK): %r', install_out)
 
-        # Reading the signature back and verifying it
-        out = cli.write_line_and_read_output_lines_until_timeout('signature')
+        # Verifying the signature
         enforce(len(out) == 1, 'Could not read the signature back. Returned lines: %r', out)
         logger.info('Installed signature in Base64: %s', out[0])
         enforce(b64decode(out[0]) == gensign_response.signature,
@@ -533,4 +1462,201 @@ def process_one_device():
 
         info('Signature has been installed and verified')
 
-run(process_one_device)
+
+PipelineStage = namedtuple('PipelineStage', ['name', 'resources', 'function'])
+
+
+class PipelineScheduler:
+    """
+    Runs stages of consecutive boards concurrently. Every stage declares the station resources it occupies;
+    a stage starts once none of its resources is busy and no earlier board is still waiting for any of them,
+    so that a later board never overtakes an earlier one. Stages of the same board are executed in order.
+    """
+
+    def __init__(self):
+        self._condition = threading.Condition()
+        self._busy = set()
+        self._claims = []           # (board, stage index, resources), in board order
+
+    def register(self, board, stages):
+        with self._condition:
+            self._claims += [(board, index, set(st.resources)) for index, st in enumerate(stages)]
+
+    def cancel(self, board):
+        with self._condition:
+            self._claims = [c for c in self._claims if c[0] != board]
+            self._condition.notify_all()
+
+    def _resources(self, board, index):
+        return next(c[2] for c in self._claims if c[:2] == (board, index))
+
+    def _can_start(self, board, index):
+        resources = self._resources(board, index)
+        if self._busy & resources:
+            return False
+        for b, i, other_resources in self._claims:
+            if (b, i) == (board, index):
+                return True
+            if other_resources & resources:
+                return False
+
+    @contextmanager
+    def stage(self, board, index):
+        with self._condition:
+            self._condition.wait_for(lambda: self._can_start(board, index))
+            resources = self._resources(board, index)
+            self._busy |= resources
+        try:
+            yield
+        finally:
+            with self._condition:
+                self._busy -= resources
+                self._claims = [c for c in self._claims if c[:2] != (board, index)]
+                self._condition.notify_all()
+
+
+def make_pipeline_stages(fixture, board):
+    def flash():
+        out = fixture_input(fixture,
+                            'Board #%d:\n'
+                            '1. Connect DroneCode Probe to the debug connector\n'
+                            '2. If you want to skip firmware upload, type F\n'
+                            '3. Press ENTER', board)
+        if 'f' in out.lower():
+            info('Board #%d: firmware upload skipped', board)
+        else:
+            flash_device(fixture)
+
+    def can():
+        fixture_input(fixture,
+                      'Board #%d:\n'
+                      '1. Connect CAN to the first CAN1 connector on the device; terminate the other CAN1 connector\n'
+                      '2. Press ENTER', board)
+        info('Board #%d: testing UAVCAN interface...', board)
+        test_uavcan(fixture, debug_cli=False)
+
+    def usb():
+        fixture_input(fixture,
+                      'Board #%d:\n'
+                      '1. Connect USB to the device, and make sure that no other Zubax GNSS is connected\n'
+                      '2. Press ENTER', board)
+        test_usb(fixture)
+
+    # The sky view is used by the GNSS test, which is a part of the CAN test
+    return [
+        PipelineStage('flash', ['probe'], flash),
+        PipelineStage('can', ['can', 'sky'], can),
+        PipelineStage('usb', ['usb', 'licensing'], usb),
+    ]
+
+
+def run_pipeline(fixture):
+    """
+    Tests boards on the fixture, starting the next board as soon as the previous one has released the debugger.
+    """
+    scheduler = PipelineScheduler()
+    depth = threading.BoundedSemaphore(PIPELINE_DEPTH)
+
+    def process_board(board, first_stage_done):
+        current_board.set(board)
+        stages = make_pipeline_stages(fixture, board)
+        try:
+            with timing.board(fixture=fixture.name, board=board), signatures.board():
+                # The time when the stages of this board were executing, not waiting for the resources
+                busy = 0
+                try:
+                    for index, st in enumerate(stages):
+                        with scheduler.stage(board, index):
+                            started_at = time.monotonic()
+                            try:
+                                st.function()
+                            finally:
+                                busy += time.monotonic() - started_at
+                                logger.info('Board #%d stage %r finished in %.1f sec',
+                                            board, st.name, time.monotonic() - started_at)
+                        if index == 0:
+                            first_stage_done.set()
+                finally:
+                    timing.annotate(busy=round(busy, 4))
+            info('Board #%d: TEST PASSED', board)
+        except Exception as ex:
+            logger.info('Board #%d failure', board, exc_info=True)
+            error('Board #%d: TEST FAILED: %s', board, ex)
+        finally:
+            first_stage_done.set()
+            scheduler.cancel(board)
+            report_timing()
+            depth.release()
+
+    board = 0
+    while True:
+        board += 1
+        depth.acquire()
+        first_stage_done = threading.Event()
+        scheduler.register(board, make_pipeline_stages(fixture, board))
+        threading.Thread(target=contextvars.copy_context().run, args=(process_board, board, first_stage_done),
+                         daemon=True, name='%s-board-%d' % (threading.current_thread().name, board)).start()
+        first_stage_done.wait()
+
+
+class FixtureLogFilter(logging.Filter):
+    """
+    Passes the records that are logged while working on the fixture, including the work delegated to other threads.
+    """
+
+    def __init__(self, fixture):
+        super(FixtureLogFilter, self).__init__()
+        self.fixture_name = fixture.name
+
+    def filter(self, record):
+        return current_fixture.get() == self.fixture_name
+
+
+def fixture_thread_name(fixture):
+    return 'fixture-' + fixture.name
+
+
+def run_fixture(fixture):
+    """
+    Tests devices on the given fixture one after another, until the application is stopped.
+    Everything logged while working on the fixture also goes into a dedicated log file.
+    """
+    current_fixture.set(fixture.name)
+    handler = logging.FileHandler('drwatson_fixture_%s.log' % fixture.name)
+    handler.setLevel(logging.DEBUG)
+    handler.setFormatter(logging.Formatter('%(asctime)s %(levelname)-8s %(name)s: %(message)s'))
+    handler.addFilter(FixtureLogFilter(fixture))
+    logging.getLogger().addHandler(handler)
+
+    while True:
+        try:
+            process_one_device(fixture)
+        except Exception as ex:
+            fixture.num_failed += 1
+            logger.info('Fixture %r failure', fixture.name, exc_info=True)
+            error('[%s] TEST FAILED: %s', fixture.name, ex)
+        else:
+            fixture.num_passed += 1
+            info('[%s] TEST PASSED', fixture.name)
+        info('Fixture results: %s', ', '.join('%s %d passed %d failed' % (x.name, x.num_passed, x.num_failed)
+                                              for x in fixtures))
+
+
+if multi_fixture:
+    info('Testing %d fixtures concurrently: %s', len(fixtures), ', '.join(x.name for x in fixtures))
+    threads = [threading.Thread(target=run_fixture, args=(fx,), name=fixture_thread_name(fx), daemon=True)
+               for fx in fixtures]
+    for t in threads:
+        t.start()
+    try:
+        while any(t.is_alive() for t in threads):
+            time.sleep(1)
+    except KeyboardInterrupt:
+        info('Stopped')
+elif args.pipeline:
+    try:
+        run_pipeline(fixtures[0])
+    except KeyboardInterrupt:
+        info('Stopped')
+else:
+    run(partial(process_one_device, fixtures[0]))
@@ -0,0 +1,173 @@
+#
+# Copyright (C) 2015 Zubax Robotics <info@zubax.com>
+#
+# This program is free software: you can redistribute it and/or modify it under the terms of the
+# GNU General Public License as published by the Free Software Foundation, either version 3 of the License,
+# or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT ANY WARRANTY;
+# without even the implied warranty of MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.
+# See the GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along with this program.
+# If not, see <http://www.gnu.org/licenses/>.
+#
+
+"""
+Local cache of the firmware images that are downloaded from the file server, so that the station keeps working
+when the server is not reachable.
+"""
+
+import os
+import re
+import json
+import time
+import fnmatch
+import hashlib
+import logging
+import email.utils
+import urllib.error
+import urllib.parse
+import urllib.request
+
+
+logger = logging.getLogger(__name__)
+
+
+class FirmwareCache:
+    """
+    Local content-addressed cache of firmware images downloaded over HTTP.
+    Images are stored under the SHA-256 of their contents; the index maps every URL to the hash of its contents
+    and to the HTTP validators (ETag, Last-Modified), so that an unchanged file is never downloaded twice.
+    If the server is not reachable or fails with a server error, the cached contents are used; client errors
+    (e.g. 403, 404) are raised, because they mean that the configured URL is wrong.
+    Warnings about using the cached contents are reported via the callable warn.
+    """
+
+    def __init__(self, directory, timeout=10, warn=logger.warning):
+        self.directory = directory
+        self.timeout = timeout
+        self.warn = warn
+        self._index_path = os.path.join(directory, 'index.json')
+        try:
+            with open(self._index_path) as f:
+                self._index = json.load(f)
+        except (OSError, ValueError):
+            self._index = {}
+
+    def _blob_path(self, digest):
+        return os.path.join(self.directory, digest + '.bin')
+
+    def _load(self, url):
+        entry = self._index.get(url)
+        if not entry:
+            return None
+        try:
+            with open(self._blob_path(entry['sha256']), 'rb') as f:
+                data = f.read()
+        except OSError:
+            return None
+        if hashlib.sha256(data).hexdigest() != entry['sha256']:
+            logger.warning('Cached firmware for %r is corrupted', url)
+            return None
+        return data
+
+    def _store(self, url, data, headers):
+        digest = hashlib.sha256(data).hexdigest()
+        os.makedirs(self.directory, exist_ok=True)
+        if not os.path.exists(self._blob_path(digest)):
+            with open(self._blob_path(digest) + '.tmp', 'wb') as f:
+                f.write(data)
+            os.replace(self._blob_path(digest) + '.tmp', self._blob_path(digest))
+        self._index[url] = {
+            'sha256': digest,
+            'etag': headers.get('ETag'),
+            'last_modified': headers.get('Last-Modified'),
+            'fetched_at': time.time()
+        }
+        with open(self._index_path + '.tmp', 'w') as f:
+            json.dump(self._index, f, indent=1)
+        os.replace(self._index_path + '.tmp', self._index_path)
+
+    def path_of(self, url):
+        return self._blob_path(self._index[url]['sha256'])
+
+    def get(self, url):
+        cached = self._load(url)
+        request = urllib.request.Request(url)
+        if cached is not None:
+            entry = self._index[url]
+            if entry.get('etag'):
+                request.add_header('If-None-Match', entry['etag'])
+            if entry.get('last_modified'):
+                request.add_header('If-Modified-Since', entry['last_modified'])
+        try:
+            with urllib.request.urlopen(request, timeout=self.timeout) as response:
+                data = response.read()
+                self._store(url, data, response.headers)
+                logger.info('Downloaded %r, %d bytes', url, len(data))
+                return data
+        except urllib.error.HTTPError as ex:
+            if cached is None or (ex.code != 304 and ex.code < 500):
+                raise
+            if ex.code == 304:
+                logger.info('Cached firmware %r is up to date', url)
+            else:
+                self.warn('File server error %d, using the cached copy of %s', ex.code, url)
+            return cached
+        except (urllib.error.URLError, OSError):
+            if cached is None:
+                raise
+            self.warn('Could not reach the file server, using the cached copy of %s', url)
+            return cached
+
+    def _newest_cached(self, glob_url, reason):
+        cached = [u for u in self._index if fnmatch.fnmatch(u, glob_url)]
+        if not cached:
+            return None
+        url = max(cached, key=lambda u: self._index[u]['fetched_at'])
+        self.warn('%s, using the cached firmware %s', reason, url)
+        return url
+
+    def _modification_time(self, url):
+        request = urllib.request.Request(url, method='HEAD')
+        with urllib.request.urlopen(request, timeout=self.timeout) as response:
+            last_modified = response.headers.get('Last-Modified')
+        try:
+            return email.utils.parsedate_to_datetime(last_modified).timestamp()
+        except (TypeError, ValueError):
+            logger.warning('No valid Last-Modified for %r: %r', url, last_modified)
+            return 0
+
+    def resolve_newest(self, glob_url):
+        """
+        Returns the URL of the file matching the URL glob that was modified last on the server; the files are
+        listed from the server's directory index. If the server is not reachable or fails with a server error,
+        the most recently downloaded matching URL from the cache is returned.
+        """
+        directory_url, pattern = glob_url.rsplit('/', 1)
+        directory_url += '/'
+        try:
+            with urllib.request.urlopen(directory_url, timeout=self.timeout) as response:
+                listing = response.read().decode('utf8', 'ignore')
+        except urllib.error.HTTPError as ex:
+            url = self._newest_cached(glob_url, 'File server error %d' % ex.code) if ex.code >= 500 else None
+            if url is None:
+                raise
+            return url
+        except (urllib.error.URLError, OSError):
+            url = self._newest_cached(glob_url, 'Could not reach the file server')
+            if url is None:
+                raise
+            return url
+
+        urls = set()
+        for href in re.findall(r'href="([^"]+)"', listing):
+            name = urllib.parse.unquote(href.rstrip('/').rsplit('/', 1)[-1])
+            if fnmatch.fnmatch(name, pattern):
+                urls.add(urllib.parse.urljoin(directory_url, urllib.parse.quote(name)))
+        if not urls:
+            raise ValueError('No files match %r' % glob_url)
+
+        # The names contain git hashes, which are not ordered, so the files are ordered by the modification time
+        return max(urls, key=lambda u: (self._modification_time(u), u))
@@ -0,0 +1,176 @@
+#
+# Copyright (C) 2015 Zubax Robotics <info@zubax.com>
+#
+# This program is free software: you can redistribute it and/or modify it under the terms of the
+# GNU General Public License as published by the Free Software Foundation, either version 3 of the License,
+# or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT ANY WARRANTY;
+# without even the implied warranty of MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.
+# See the GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along with this program.
+# If not, see <http://www.gnu.org/licenses/>.
+#
+
+"""
+Persistent GDB session that loads the firmware onto the boards via the GDB/MI interface.
+"""
+
+import re
+import time
+import queue
+import logging
+import binascii
+import threading
+import subprocess
+import contextvars
+
+
+logger = logging.getLogger(__name__)
+
+
+class GDBSession:
+    """
+    Long-lived GDB process controlled via the GDB/MI interface. The connection to the debugger is kept open
+    across boards, so that only scan/attach/load/compare-sections are executed per board.
+    The target is either a serial port of the debugger or a host:port address, e.g. of a local GDB stub server.
+    """
+
+    COMMAND_TIMEOUT = 60
+
+    def __init__(self, target, gdb='gdb', command_timeout=COMMAND_TIMEOUT):
+        self.target = target
+        self.gdb = gdb
+        self.command_timeout = command_timeout
+        self._process = None
+        self._lines = queue.Queue()
+        self._token = 0
+        self._loaded_elf = None
+        self.timings = []           # Durations of the phases of the last flashing, in seconds
+
+    def _start(self):
+        self._process = subprocess.Popen([self.gdb, '--interpreter=mi2', '-silent', '-nx'],
+                                         stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.STDOUT,
+                                         universal_newlines=True, bufsize=1)
+        self._lines = queue.Queue()
+        threading.Thread(target=contextvars.copy_context().run, args=(self._read_output, self._process.stdout,
+                                                                      self._lines),
+                         name='gdb-reader', daemon=True).start()
+        self._loaded_elf = None
+        self.command('-gdb-set confirm off')
+        self.command('-target-select extended-remote %s' % self.target)
+
+    @staticmethod
+    def _read_output(stdout, lines):
+        for line in iter(stdout.readline, ''):
+            lines.put(line)
+        lines.put(None)
+
+    @property
+    def running(self):
+        return self._process is not None and self._process.poll() is None
+
+    def close(self):
+        if self._process is not None:
+            try:
+                self._process.kill()
+                self._process.wait()
+            except OSError:
+                pass
+            self._process = None
+
+    def command(self, command, timeout=None):
+        """
+        Executes an MI command; returns the result record without the class (e.g. ',memory=[...]' for '^done'),
+        and the list of console stream outputs. Raises RuntimeError on error.
+        """
+        self._token += 1
+        token = str(self._token)
+        logger.debug('GDB <- %s', command)
+        self._process.stdin.write(token + command + '\n')
+        self._process.stdin.flush()
+
+        deadline = time.monotonic() + (self.command_timeout if timeout is None else timeout)
+        console = []
+        while True:
+            try:
+                line = self._lines.get(timeout=max(deadline - time.monotonic(), 0))
+            except queue.Empty:
+                raise RuntimeError('GDB command timed out: %r' % command) from None
+            if line is None:
+                raise RuntimeError('GDB has terminated unexpectedly')
+            line = line.rstrip('\n')
+            logger.debug('GDB -> %s', line)
+            if line.startswith('~'):
+                console.append(_unquote_mi_string(line[1:]))
+            elif line.startswith(token + '^'):
+                result = line[len(token) + 1:]
+                if result.startswith('error'):
+                    match = re.search(r'msg="((?:[^"\\]|\\.)*)"', result)
+                    raise RuntimeError('GDB command %r failed: %s' %
+                                       (command, _unquote_mi_string('"%s"' % match.group(1)) if match else result))
+                return result.partition(',')[2], console
+
+    def console(self, command, timeout=None):
+        return self.command('-interpreter-exec console "%s"' % command.replace('\\', '\\\\').replace('"', '\\"'),
+                            timeout=timeout)[1]
+
+    def read_memory(self, address, size):
+        result, _ = self.command('-data-read-memory-bytes 0x%x %d' % (address, size))
+        match = re.search(r'contents="([0-9a-fA-F]*)"', result)
+        if not match:
+            raise RuntimeError('Unexpected memory read response: %r' % result)
+        return binascii.unhexlify(match.group(1))
+
+    def flash(self, elf_path, skip_if_memory_matches=None):
+        """
+        Loads the ELF onto the board that is currently connected to the debugger and verifies it.
+        If skip_if_memory_matches is provided as a tuple (address, bytes), and the target memory at the address
+        contains these bytes, and the target flash matches the ELF, the board is detached and left running
+        without loading. Returns True if the firmware was loaded, False if loading was skipped.
+        Durations of the phases are stored in the attribute timings.
+        """
+        timings = self.timings = []
+
+        def phase(name, function, *a):
+            started_at = time.monotonic()
+            out = function(*a)
+            timings.append((name, time.monotonic() - started_at))
+            return out
+
+        try:
+            if not self.running:
+                phase('connect', self._start)
+            if self._loaded_elf != elf_path:
+                phase('file', self.command, '-file-exec-and-symbols %s' % elf_path)
+                self._loaded_elf = elf_path
+            phase('scan', self.console, 'monitor swdp_scan')
+            phase('attach', self.command, '-target-attach 1')
+
+            if skip_if_memory_matches:
+                address, expected = skip_if_memory_matches
+                if phase('probe', self.read_memory, address, len(expected)) == expected:
+                    out = phase('compare', self.console, 'compare-sections')
+                    if not any('MIS-MATCHED' in x for x in out):
+                        phase('detach', self.command, '-target-detach')
+                        logger.info('GDB phase timings: %s', ', '.join('%s %.2f sec' % x for x in timings))
+                        return False
+
+            phase('load', self.command, '-target-download')
+            out = phase('compare', self.console, 'compare-sections')
+            if any('MIS-MATCHED' in x for x in out):
+                raise RuntimeError('Firmware verification failed: %s' % ''.join(out).strip())
+            phase('kill', self.console, 'kill')
+        except Exception:
+            # The session is restarted from scratch for the next board
+            self.close()
+            raise
+
+        logger.info('GDB phase timings: %s', ', '.join('%s %.2f sec' % x for x in timings))
+        return True
+
+
+def _unquote_mi_string(s):
+    # MI strings are C strings; all escapes used by GDB are also valid in Python string literals
+    return s[1:-1].encode('latin-1').decode('unicode_escape') if s.startswith('"') else s
@@ -0,0 +1,221 @@
+#!/usr/bin/env python3
+#
+# Copyright (C) 2015 Zubax Robotics <info@zubax.com>
+#
+# This program is free software: you can redistribute it and/or modify it under the terms of the
+# GNU General Public License as published by the Free Software Foundation, either version 3 of the License,
+# or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT ANY WARRANTY;
+# without even the implied warranty of MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.
+# See the GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along with this program.
+# If not, see <http://www.gnu.org/licenses/>.
+#
+
+"""
+Statistical qualification of GNSS performance during the production test.
+
+The qualifier fits linear trends to the number of satellites reported by the board over a sliding window and
+extrapolates them, so that the test can be ended as soon as the outcome is known with the required confidence,
+rather than when the pessimistic timeout expires. The messages are published many times per second while the number
+of satellites changes rarely, so the samples are decimated to the changes of the value before fitting; otherwise the
+repeated samples would be counted as independent observations, and the confidence would be grossly overestimated.
+
+When executed as a script, the qualifier is replayed on the telemetry recorded by drwatson, which allows to tune
+the thresholds on real traces:
+
+    ./gnss_qualifier.py ~/.local/share/drwatson_zubax_gnss/telemetry/*/*
+"""
+
+import os
+import math
+import yaml
+import numpy
+import argparse
+from collections import namedtuple
+
+
+Verdict = namedtuple('Verdict', ['passed', 'confidence', 'reason'])
+Verdict.__doc__ = 'The field passed is True or False if the outcome is known, and None if it is not yet known.'
+
+
+class Thresholds:
+    """
+    Parameters of the qualifier. Times are in seconds, the position variance is in squared meters.
+    The observation time required for an early fail is counted from the first visible satellite, because the
+    receiver may not see any satellites for minutes after a cold start.
+    The sample interval is the navigation update period of the receiver; at most one sample per interval is used.
+    """
+
+    def __init__(self, min_sats=6, window=60, min_observation=120, pass_horizon=30, pass_confidence=0.95,
+                 fail_confidence=0.99, max_position_variance=25.0, noise_floor=0.5, sample_interval=1.0):
+        self.min_sats = min_sats
+        self.window = window
+        self.min_observation = min_observation
+        self.pass_horizon = pass_horizon
+        self.pass_confidence = pass_confidence
+        self.fail_confidence = fail_confidence
+        self.max_position_variance = max_position_variance
+        self.noise_floor = noise_floor
+        self.sample_interval = sample_interval
+
+    @staticmethod
+    def load(path, **defaults):
+        """
+        Reads the thresholds from a YAML mapping; missing values are taken from defaults.
+        """
+        with open(path) as f:
+            defaults.update(yaml.safe_load(f) or {})
+        return Thresholds(**defaults)
+
+    def __repr__(self):
+        return 'Thresholds(%s)' % ', '.join('%s=%r' % kv for kv in sorted(self.__dict__.items()))
+
+
+def normal_cdf(x):
+    return 0.5 * (1 + math.erf(x / math.sqrt(2)))
+
+
+class LinearTrend:
+    """
+    Least squares fit of a straight line to the samples; the residual deviation is not allowed to be lower than
+    noise_floor, because the number of satellites is an integer.
+    """
+
+    def __init__(self, t, y, noise_floor):
+        self.num_samples = len(t)
+        self.t_mean = t.mean()
+        self.y_mean = y.mean()
+        dt = t - self.t_mean
+        self.sxx = numpy.dot(dt, dt)
+        self.slope = numpy.dot(dt, y - self.y_mean) / self.sxx if self.sxx > 0 else 0.0
+        residuals = y - (self.y_mean + self.slope * dt)
+        dof = max(self.num_samples - 2, 1)
+        self.sigma = max(math.sqrt(numpy.dot(residuals, residuals) / dof), noise_floor)
+
+    def predict(self, t, min_slope=-math.inf):
+        """
+        Returns the predicted value and its standard error.
+        """
+        dt = t - self.t_mean
+        stderr = self.sigma * math.sqrt(1 / self.num_samples + (dt * dt / self.sxx if self.sxx > 0 else 0))
+        return self.y_mean + max(self.slope, min_slope) * dt, stderr
+
+
+def _window(columns, start, end):
+    t = columns['time']
+    selection = slice(numpy.searchsorted(t, start), numpy.searchsorted(t, end, side='right'))
+    return {name: values[selection] for name, values in columns.items()}
+
+
+def decimate(t, y, interval):
+    """
+    Keeps the last sample of every interval, and of these only the samples where the value has changed, plus the
+    last one, so that the time span of the samples is preserved.
+    """
+    if len(t) < 2:
+        return t, y
+    bins = numpy.floor(t / interval)
+    selection = numpy.append(bins[1:] != bins[:-1], True)
+    t, y = t[selection], y[selection]
+    selection = numpy.append(True, y[1:] != y[:-1])
+    selection[-1] = True
+    return t[selection], y[selection]
+
+
+def qualify(fix, aux, now, deadline, thresholds):
+    """
+    Evaluates the samples of the messages Fix and Auxiliary received up to the time now. The arguments fix and aux
+    are mappings of column names to arrays in the format of the drwatson telemetry recorder. Deadline is the time
+    when the test would time out.
+    """
+    th = thresholds
+    acquired = numpy.flatnonzero(aux['sats_visible'] > 0) if len(aux['time']) else []
+    acquired_since = aux['time'][acquired[0]] if len(acquired) else None
+    observed = _window(aux, acquired_since, now) if acquired_since is not None else None
+    fix = _window(fix, now - th.window, now)
+    aux = _window(aux, now - th.window, now)
+    with numpy.errstate(invalid='ignore'):
+        position_ok = not numpy.any(fix['position_variance'][-1:] > th.max_position_variance)
+
+    # The pass criterion of the test itself: 3D fix with enough satellites
+    if len(fix['time']) and fix['status'][-1] >= 3 and fix['sats_used'][-1] >= th.min_sats and position_ok:
+        return Verdict(True, 1.0, '3D fix with %d satellites' % fix['sats_used'][-1])
+
+    # Early pass: 3D fix, the receiver is already tracking enough satellites, and the number of used satellites is
+    # going to reach the minimum shortly. The extrapolation alone is not enough, a stalled receiver would pass.
+    tracking = len(aux['time']) > 0 and aux['sats_visible'][-1] >= th.min_sats
+    t, sats_used = decimate(fix['time'], fix['sats_used'], th.sample_interval)
+    if tracking and len(t) >= 3 and fix['status'][-1] >= 3 and position_ok:
+        trend = LinearTrend(t, sats_used, th.noise_floor)
+        predicted, stderr = trend.predict(now + th.pass_horizon)
+        confidence = normal_cdf((predicted - (th.min_sats - 0.5)) / stderr)
+        if confidence >= th.pass_confidence:
+            return Verdict(True, confidence, '%.1f satellites expected in %d s' % (predicted, th.pass_horizon))
+
+    # Early fail: the number of visible satellites is not going to reach the minimum before the deadline.
+    # A falling trend is not extrapolated, so that a temporary loss of satellites does not fail the board.
+    # A board that has not acquired any satellites yet is never failed early, it may be still cold starting.
+    # The deadline is far away, so the trend is fitted to the whole observation rather than to the window.
+    if acquired_since is not None and now - acquired_since >= th.min_observation:
+        t, sats_visible = decimate(observed['time'], observed['sats_visible'], th.sample_interval)
+        if len(t) >= 3:
+            trend = LinearTrend(t, sats_visible, th.noise_floor)
+            predicted, stderr = trend.predict(max(deadline, now), min_slope=0)
+            confidence = normal_cdf(((th.min_sats - 0.5) - predicted) / stderr)
+            if confidence >= th.fail_confidence:
+                return Verdict(False, confidence, 'only %.1f visible satellites expected by the deadline' % predicted)
+
+    return Verdict(None, 0.0, 'undecided')
+
+
+def load_trace(directory):
+    """
+    Loads the columns of the messages Fix and Auxiliary recorded by drwatson.
+    """
+    def load(channel):
+        prefix = channel + '.'
+        return {n[len(prefix):-4]: numpy.load(os.path.join(directory, n), mmap_mode='r')
+                for n in os.listdir(directory) if n.startswith(prefix) and n.endswith('.npy')}
+
+    return load('fix'), load('aux')
+
+
+def replay(directory, thresholds, timeout, step=1.0):
+    """
+    Re-runs the qualifier on a recorded trace every step seconds, like drwatson does during the test.
+    Returns the first decisive verdict and the time it was made, or the last verdict if there was none.
+    """
+    fix, aux = load_trace(directory)
+    times = numpy.concatenate((fix['time'], aux['time']))
+    if not len(times):
+        return Verdict(None, 0.0, 'empty trace'), None
+    start = times.min()
+    verdict = None
+    for now in numpy.arange(start + step, max(times.max(), start + step) + step, step):
+        verdict = qualify(fix, aux, now, start + timeout, thresholds)
+        if verdict.passed is not None:
+            return verdict, now - start
+    return verdict, times.max() - start
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Replays the GNSS qualifier on traces recorded by drwatson')
+    parser.add_argument('traces', nargs='+', help='directories with recorded telemetry')
+    parser.add_argument('--thresholds', help='YAML file with the thresholds of the qualifier')
+    parser.add_argument('--timeout', type=float, default=60 * 25, help='test timeout, seconds')
+    args = parser.parse_args()
+
+    thresholds = Thresholds.load(args.thresholds) if args.thresholds else Thresholds()
+    print(thresholds)
+    for directory in args.traces:
+        verdict, decided_at = replay(directory, thresholds, args.timeout)
+        outcome = {True: 'PASS', False: 'FAIL', None: 'UNDECIDED'}[verdict.passed]
+        print('%-9s %6.0f s  confidence %5.1f%%  %s  %s' % (outcome, decided_at or 0, verdict.confidence * 100,
+                                                           verdict.reason, directory))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,157 @@
+#
+# Copyright (C) 2015 Zubax Robotics <info@zubax.com>
+#
+# This program is free software: you can redistribute it and/or modify it under the terms of the
+# GNU General Public License as published by the Free Software Foundation, either version 3 of the License,
+# or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT ANY WARRANTY;
+# without even the implied warranty of MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.
+# See the GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along with this program.
+# If not, see <http://www.gnu.org/licenses/>.
+#
+
+"""
+Background generation of device signatures by the licensing server.
+"""
+
+import time
+import queue
+import logging
+import binascii
+import threading
+import contextvars
+from contextlib import contextmanager
+from concurrent.futures import Future
+
+
+logger = logging.getLogger(__name__)
+
+
+class SignaturePrefetcher:
+    """
+    Requests device signatures from the licensing server in a background thread, so that the network round trip
+    overlaps with the tests. All licensing requests are made from this thread, one at a time.
+    If the API offers generate_signatures(unique_ids, product_name), which returns the responses in the order of
+    the unique IDs, the requests that are pending at the same time (e.g. from several fixtures) are made as one
+    batch; otherwise they are made one by one. Failed requests are retried with exponential backoff.
+    A failed request is forgotten, so that the next request for the same unique ID is made anew.
+    """
+
+    def __init__(self, api, product_name, attempts=5, retry_base_delay=1):
+        self._api = api
+        self._product_name = product_name
+        self.attempts = attempts
+        self.retry_base_delay = retry_base_delay
+        self._lock = threading.Lock()
+        self._futures = {}
+        self._queue = queue.Queue()
+        self._board = contextvars.ContextVar('signature_prefetcher_board', default=None)
+        threading.Thread(target=self._run, name='signature_prefetcher', daemon=True).start()
+
+    def prefetch(self, unique_id):
+        """
+        Returns the future of the response of generate_signature() for the unique ID.
+        """
+        with self._lock:
+            if unique_id not in self._futures:
+                future = self._futures[unique_id] = Future()
+                # The request is logged in the context of the fixture that has made it
+                self._queue.put((unique_id, future, contextvars.copy_context()))
+            board = self._board.get()
+            if board is not None:
+                board.add(unique_id)
+            return self._futures[unique_id]
+
+    def get(self, unique_id):
+        """
+        Returns the prefetched response, waiting for it if necessary. If nothing has been prefetched for this
+        unique ID, the request is made now.
+        """
+        future = self.prefetch(unique_id)
+        try:
+            return future.result()
+        finally:
+            self.discard(unique_id)
+
+    def discard(self, unique_id):
+        """
+        Forgets the request for the unique ID; it is cancelled if it has not been started yet.
+        """
+        with self._lock:
+            future = self._futures.pop(unique_id, None)
+        if future is not None:
+            future.cancel()
+
+    @contextmanager
+    def board(self):
+        """
+        The requests that are made within this context and are not claimed with get() by its end, e.g. because
+        the board has failed the test, are discarded.
+        """
+        unique_ids = set()
+        token = self._board.set(unique_ids)
+        try:
+            yield
+        finally:
+            self._board.reset(token)
+            for unique_id in unique_ids:
+                self.discard(unique_id)
+
+    def _call(self, function, *args):
+        for attempt in range(self.attempts):
+            try:
+                return function(*args)
+            except Exception:
+                if attempt + 1 >= self.attempts:
+                    raise
+                delay = self.retry_base_delay * 2 ** attempt
+                logger.warning('Signature request has failed, retrying in %.1f sec', delay, exc_info=True)
+                time.sleep(delay)
+
+    def _complete(self, unique_id, future, result=None, exception=None):
+        if exception is None:
+            future.set_result(result)
+            return
+        with self._lock:
+            if self._futures.get(unique_id) is future:
+                del self._futures[unique_id]
+        future.set_exception(exception)
+
+    def _run(self):
+        batch_generate = getattr(self._api, 'generate_signatures', None)
+        while True:
+            pending = [self._queue.get()]
+            while not self._queue.empty():
+                pending.append(self._queue.get())
+            # Requests that were discarded while waiting in the queue are not made
+            pending = [(u, f, c) for u, f, c in pending if f.set_running_or_notify_cancel()]
+            if not pending:
+                continue
+
+            if batch_generate is None or len(pending) == 1:
+                for unique_id, future, context in pending:
+                    context.run(logger.info, 'Requesting signature for %s', binascii.hexlify(unique_id).decode())
+                    try:
+                        response = context.run(self._call, self._api.generate_signature, unique_id,
+                                               self._product_name)
+                    except Exception as ex:
+                        self._complete(unique_id, future, exception=ex)
+                    else:
+                        self._complete(unique_id, future, response)
+                continue
+
+            unique_ids = [u for u, _, _ in pending]
+            logger.info('Requesting signatures for %s', ', '.join(binascii.hexlify(u).decode() for u in unique_ids))
+            try:
+                responses = self._call(batch_generate, unique_ids, self._product_name)
+                if len(responses) != len(unique_ids):
+                    raise ValueError('Expected %d signatures, got %d' % (len(unique_ids), len(responses)))
+            except Exception as ex:
+                for unique_id, future, _ in pending:
+                    self._complete(unique_id, future, exception=ex)
+            else:
+                for (unique_id, future, _), response in zip(pending, responses):
+                    self._complete(unique_id, future, response)
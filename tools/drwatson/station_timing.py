@@ -0,0 +1,176 @@
+#!/usr/bin/env python3
+#
+# Copyright (C) 2015 Zubax Robotics <info@zubax.com>
+#
+# This program is free software: you can redistribute it and/or modify it under the terms of the
+# GNU General Public License as published by the Free Software Foundation, either version 3 of the License,
+# or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT ANY WARRANTY;
+# without even the implied warranty of MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.
+# See the GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along with this program.
+# If not, see <http://www.gnu.org/licenses/>.
+#
+
+"""
+Timing instrumentation of the test station.
+
+Every tested board produces one record, which contains the spans of the stages that were executed while the board
+was being tested. The records are written as JSON lines, one line per board, and aggregated into a report.
+If the stages of several boards overlap, the record may contain the field busy, which is the time when the board was
+actually being tested rather than waiting for the station; it defaults to the duration of the board.
+
+When executed as a script, the report is generated from the JSON lines files, e.g. of the whole shift:
+
+    ./station_timing.py drwatson_timing.jsonl
+"""
+
+import json
+import time
+import numpy
+import argparse
+import threading
+from contextlib import contextmanager
+
+
+class StationTiming:
+    """
+    Spans are attributed to the board that is being tested in the current thread; spans recorded in a thread that
+    is not testing any board are ignored. Nested spans have a greater depth.
+    """
+
+    def __init__(self, log_path=None):
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        self._log_path = log_path
+        self.started_at = time.monotonic()
+        self.records = []
+
+    @contextmanager
+    def board(self, **fields):
+        record = dict(fields, started_at=time.time(), passed=False, spans=[])
+        self._local.board = record, time.monotonic()
+        self._local.depth = 0
+        try:
+            yield record
+            record['passed'] = True
+        finally:
+            record['duration'] = round(time.monotonic() - self._local.board[1], 4)
+            self._local.board = None
+            with self._lock:
+                self.records.append(record)
+                if self._log_path:
+                    with open(self._log_path, 'a') as f:
+                        f.write(json.dumps(record) + '\n')
+
+    def annotate(self, **fields):
+        current = getattr(self._local, 'board', None)
+        if current:
+            current[0].update(fields)
+
+    def record(self, name, started_at, ok=True):
+        """
+        Adds a span that has started at the specified monotonic time and ends now.
+        """
+        current = getattr(self._local, 'board', None)
+        if current:
+            record, board_started_at = current
+            record['spans'].append({
+                'name': name,
+                'start': round(started_at - board_started_at, 4),
+                'duration': round(time.monotonic() - started_at, 4),
+                'depth': self._local.depth,
+                'ok': ok
+            })
+
+    @contextmanager
+    def span(self, name):
+        started_at = time.monotonic()
+        ok = False
+        self._local.depth = getattr(self._local, 'depth', 0) + 1
+        try:
+            yield
+            ok = True
+        finally:
+            self._local.depth -= 1
+            self.record(name, started_at, ok)
+
+    def summary(self):
+        with self._lock:
+            return summarize(self.records, time.monotonic() - self.started_at)
+
+
+def summarize(records, elapsed=None):
+    """
+    Aggregates the board records. If the elapsed time is not provided, it is computed from the records.
+    """
+    durations = {}
+    top_level = set()
+    for r in records:
+        for s in r['spans']:
+            durations.setdefault(s['name'], []).append(s['duration'])
+            if s.get('depth', 0) == 0:
+                top_level.add(s['name'])
+
+    stages = {}
+    for name, values in durations.items():
+        values = numpy.array(values)
+        p50, p90, p99 = numpy.percentile(values, [50, 90, 99])
+        stages[name] = {
+            'count': len(values),
+            'total': float(values.sum()),
+            'p50': float(p50),
+            'p90': float(p90),
+            'p99': float(p99),
+            'max': float(values.max())
+        }
+
+    if elapsed is None:
+        elapsed = max([r['started_at'] + r['duration'] for r in records] or [0]) - \
+            min([r['started_at'] for r in records] or [0])
+
+    board_durations = numpy.array([r['duration'] for r in records] or [0.0])
+    serial_time = sum(r.get('busy', r['duration']) for r in records)
+    return {
+        'boards': len(records),
+        'passed': sum(1 for r in records if r['passed']),
+        'elapsed': elapsed,
+        'boards_per_hour': len(records) * 3600 / max(elapsed, 1e-3),
+        'serial_boards_per_hour': len(records) * 3600 / max(serial_time, 1e-3),
+        'board_p50': float(numpy.percentile(board_durations, 50)),
+        'board_p90': float(numpy.percentile(board_durations, 90)),
+        'slowest_stage': max(top_level, key=lambda n: stages[n]['total']) if top_level else None,
+        'stages': stages
+    }
+
+
+def format_report(summary):
+    lines = ['%d boards (%d passed) in %.1f hours, %.1f boards/hour (%.1f with serial execution); '
+             'board time p50 %.1f s, p90 %.1f s' %
+             (summary['boards'], summary['passed'], summary['elapsed'] / 3600, summary['boards_per_hour'],
+              summary['serial_boards_per_hour'], summary['board_p50'], summary['board_p90']),
+             '%-40s %7s %9s %8s %8s %8s %8s' % ('stage', 'count', 'total', 'p50', 'p90', 'p99', 'max')]
+    for name, st in sorted(summary['stages'].items(), key=lambda kv: -kv[1]['total']):
+        lines.append('%-40s %7d %9.1f %8.3f %8.3f %8.3f %8.3f' %
+                     (name, st['count'], st['total'], st['p50'], st['p90'], st['p99'], st['max']))
+    if summary['slowest_stage']:
+        lines.append('Slowest stage: %s' % summary['slowest_stage'])
+    return '\n'.join(lines)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Aggregates timing records of the test station')
+    parser.add_argument('logs', nargs='+', help='JSON lines files written by drwatson')
+    args = parser.parse_args()
+
+    records = []
+    for path in args.logs:
+        with open(path) as f:
+            records += [json.loads(line) for line in f if line.strip()]
+    print(format_report(summarize(records)))
+
+
+if __name__ == '__main__':
+    main()
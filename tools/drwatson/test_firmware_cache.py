@@ -0,0 +1,216 @@
+#!/usr/bin/env python3
+#
+# Tests of firmware_cache.py against a local HTTP server that stands in for the file server.
+# Run with "python3 -m unittest test_firmware_cache" or with pytest from this directory.
+#
+
+import os
+import sys
+import shutil
+import tempfile
+import unittest
+import threading
+import email.utils
+import urllib.error
+from http.server import HTTPServer, BaseHTTPRequestHandler
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from firmware_cache import FirmwareCache
+
+
+class FileServer(HTTPServer):
+    """
+    Serves the files from the dict files: name -> (contents, modification time), and the directory listing at /.
+    If status is set, all requests fail with this status code. The requests are recorded in the list requests.
+    """
+
+    def __init__(self):
+        self.files = {}
+        self.status = None
+        self.requests = []
+        super(FileServer, self).__init__(('127.0.0.1', 0), FileRequestHandler)
+        threading.Thread(target=self.serve_forever, name='file-server', daemon=True).start()
+
+    def url(self, name=''):
+        return 'http://127.0.0.1:%d/%s' % (self.server_port, name)
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+
+
+class FileRequestHandler(BaseHTTPRequestHandler):
+    def log_message(self, fmt, *a):
+        pass
+
+    def _respond(self, send_body):
+        self.server.requests.append((self.command, self.path, self.headers.get('If-None-Match')))
+        if self.server.status:
+            self.send_error(self.server.status)
+            return
+
+        name = self.path.lstrip('/')
+        if not name:
+            body = ''.join('<a href="%s">%s</a>\n' % (x, x) for x in sorted(self.server.files)).encode()
+            self.send_response(200)
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            if send_body:
+                self.wfile.write(body)
+            return
+
+        if name not in self.server.files:
+            self.send_error(404)
+            return
+
+        data, modified_at = self.server.files[name]
+        etag = '"%x-%d"' % (hash(data) & 0xFFFFFFFF, len(data))
+        if self.headers.get('If-None-Match') == etag:
+            self.send_response(304)
+            self.end_headers()
+            return
+        self.send_response(200)
+        self.send_header('ETag', etag)
+        self.send_header('Last-Modified', email.utils.formatdate(modified_at, usegmt=True))
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        if send_body:
+            self.wfile.write(data)
+
+    def do_GET(self):
+        self._respond(True)
+
+    def do_HEAD(self):
+        self._respond(False)
+
+
+class TestFirmwareCache(unittest.TestCase):
+    def setUp(self):
+        self.server = FileServer()
+        self.directory = tempfile.mkdtemp('-drwatson-test')
+        self.warnings = []
+
+    def tearDown(self):
+        self.server.stop()
+        shutil.rmtree(self.directory)
+
+    def make_cache(self):
+        # A new instance every time, like a new run of the station, so that the index is reloaded from the disk
+        return FirmwareCache(self.directory, timeout=5, warn=lambda fmt, *a: self.warnings.append(fmt % a))
+
+    def go_offline(self):
+        url = self.server.url()
+        self.server.stop()
+        return url
+
+    def test_download(self):
+        self.server.files['fw.bin'] = b'firmware', 1e9
+        self.assertEqual(self.make_cache().get(self.server.url('fw.bin')), b'firmware')
+        with open(self.make_cache().path_of(self.server.url('fw.bin')), 'rb') as f:
+            self.assertEqual(f.read(), b'firmware')
+
+    def test_not_modified(self):
+        self.server.files['fw.bin'] = b'firmware', 1e9
+        self.make_cache().get(self.server.url('fw.bin'))
+        self.assertEqual(self.make_cache().get(self.server.url('fw.bin')), b'firmware')
+        self.assertIsNotNone(self.server.requests[-1][2])     # If-None-Match was sent and answered with 304
+        self.assertEqual(self.warnings, [])
+
+        # The file has changed on the server
+        self.server.files['fw.bin'] = b'new firmware', 2e9
+        self.assertEqual(self.make_cache().get(self.server.url('fw.bin')), b'new firmware')
+
+    def test_server_error(self):
+        self.server.files['fw.bin'] = b'firmware', 1e9
+        self.make_cache().get(self.server.url('fw.bin'))
+        self.server.status = 503
+        self.assertEqual(self.make_cache().get(self.server.url('fw.bin')), b'firmware')
+        self.assertEqual(len(self.warnings), 1)
+        self.assertIn('503', self.warnings[0])
+
+    def test_server_error_without_cache(self):
+        self.server.status = 503
+        with self.assertRaises(urllib.error.HTTPError) as context:
+            self.make_cache().get(self.server.url('fw.bin'))
+        self.assertEqual(context.exception.code, 503)
+
+    def test_client_error(self):
+        self.server.files['fw.bin'] = b'firmware', 1e9
+        self.make_cache().get(self.server.url('fw.bin'))
+        for status in 403, 404:
+            self.server.status = status
+            with self.assertRaises(urllib.error.HTTPError) as context:
+                self.make_cache().get(self.server.url('fw.bin'))
+            self.assertEqual(context.exception.code, status)
+        self.assertEqual(self.warnings, [])
+
+    def test_offline(self):
+        self.server.files['fw.bin'] = b'firmware', 1e9
+        self.make_cache().get(self.server.url('fw.bin'))
+        url = self.go_offline() + 'fw.bin'
+        self.assertEqual(self.make_cache().get(url), b'firmware')
+        self.assertEqual(len(self.warnings), 1)
+        with self.assertRaises(urllib.error.URLError):
+            self.make_cache().get(url.replace('fw.bin', 'other.bin'))
+
+    def test_corrupted_cache(self):
+        self.server.files['fw.bin'] = b'firmware', 1e9
+        cache = self.make_cache()
+        cache.get(self.server.url('fw.bin'))
+        with open(cache.path_of(self.server.url('fw.bin')), 'wb') as f:
+            f.write(b'garbage')
+        self.assertEqual(self.make_cache().get(self.server.url('fw.bin')), b'firmware')
+        self.assertIsNone(self.server.requests[-1][2])        # Downloaded unconditionally
+
+    def test_resolve_newest_by_modification_time(self):
+        # The names end with git hashes, so the name order is unrelated to the release order
+        self.server.files['gnss-1.0-1.0.f00d.compound.bin'] = b'newest', 3e9
+        self.server.files['gnss-1.0-1.0.a5e4.compound.bin'] = b'older', 2e9
+        self.server.files['gnss-1.0-1.0.ffff.compound.bin'] = b'oldest', 1e9
+        self.server.files['gnss-1.0-1.0.ffff.bin'] = b'not compound', 4e9
+        url = self.make_cache().resolve_newest(self.server.url('*.compound.bin'))
+        self.assertEqual(url, self.server.url('gnss-1.0-1.0.f00d.compound.bin'))
+
+        self.server.files['gnss-1.0-1.0.0001.compound.bin'] = b'new release', 5e9
+        url = self.make_cache().resolve_newest(self.server.url('*.compound.bin'))
+        self.assertEqual(url, self.server.url('gnss-1.0-1.0.0001.compound.bin'))
+
+    def test_resolve_newest_no_match(self):
+        self.server.files['fw.bin'] = b'firmware', 1e9
+        with self.assertRaises(ValueError):
+            self.make_cache().resolve_newest(self.server.url('*.compound.bin'))
+
+    def test_resolve_newest_server_error(self):
+        self.server.files['a.compound.bin'] = b'a', 2e9
+        self.server.files['b.compound.bin'] = b'b', 1e9
+        self.make_cache().get(self.server.url('b.compound.bin'))
+        self.server.status = 502
+        url = self.make_cache().resolve_newest(self.server.url('*.compound.bin'))
+        self.assertEqual(url, self.server.url('b.compound.bin'))
+        self.assertIn('502', self.warnings[0])
+
+    def test_resolve_newest_client_error(self):
+        # E.g. a wrong product name or missing permissions must not be masked by the cache
+        self.server.files['a.compound.bin'] = b'a', 1e9
+        self.make_cache().get(self.server.url('a.compound.bin'))
+        for status in 403, 404:
+            self.server.status = status
+            with self.assertRaises(urllib.error.HTTPError) as context:
+                self.make_cache().resolve_newest(self.server.url('*.compound.bin'))
+            self.assertEqual(context.exception.code, status)
+        self.assertEqual(self.warnings, [])
+
+    def test_resolve_newest_offline(self):
+        self.server.files['a.compound.bin'] = b'a', 1e9
+        self.server.files['b.compound.bin'] = b'b', 2e9
+        self.make_cache().get(self.server.url('b.compound.bin'))
+        self.make_cache().get(self.server.url('a.compound.bin'))
+        glob_url = self.go_offline() + '*.compound.bin'
+        self.assertEqual(self.make_cache().resolve_newest(glob_url), glob_url.replace('*', 'a'))
+        with self.assertRaises(urllib.error.URLError):
+            self.make_cache().resolve_newest(glob_url.replace('compound', 'other'))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,184 @@
+#!/usr/bin/env python3
+#
+# Tests of gdb_session.py against a stub GDB, which speaks GDB/MI and emulates the debugger with a board attached.
+# The behavior of the stub is defined by a JSON scenario file; the commands it received are appended to a log file.
+# Run with "python3 -m unittest test_gdb_session" or with pytest from this directory.
+#
+
+import os
+import sys
+import json
+import shutil
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from gdb_session import GDBSession, _unquote_mi_string
+
+
+STUB_GDB = r'''
+import sys, json, time
+
+with open(%(scenario)r) as f:
+    scenario = json.load(f)
+
+
+def send(line):
+    sys.stdout.write(line + '\n')
+    sys.stdout.flush()
+
+
+def console(text):
+    send('~' + json.dumps(text))
+
+
+send('=thread-group-added,id="i1"')
+send('(gdb)')
+for line in iter(sys.stdin.readline, ''):
+    with open(%(log)r, 'a') as f:
+        f.write(line)
+    token = ''
+    while line[0].isdigit():
+        token, line = token + line[0], line[1:]
+    command = line.strip()
+    if any(command.startswith(x) for x in scenario.get('hang', [])):
+        time.sleep(3600)
+    failure = [msg for cmd, msg in scenario.get('fail', {}).items() if command.startswith(cmd)]
+    if failure:
+        send(token + '^error,msg=' + json.dumps(failure[0]))
+    elif command.startswith('-target-select'):
+        send(token + '^connected')
+    elif command == '-interpreter-exec console "monitor swdp_scan"':
+        console('Target voltage: 3.3V\n')
+        console('Available Targets:\n')
+        console('No. Att Driver\n')
+        console(' 1      STM32F10x medium density\n')
+        send(token + '^done')
+    elif command.startswith('-data-read-memory-bytes'):
+        send(token + '^done,memory=[{begin="0x8000000",offset="0x0",end="0x8000010",contents="%%s"}]' %%
+             scenario.get('memory', ''))
+    elif command == '-target-download':
+        send(token + '+download,{section=".text",section-size="4096",total-size="8192"}')
+        send(token + '^done,address="0x8000000",load-size="4096",transfer-rate="40960",write-rate="512"')
+    elif command == '-interpreter-exec console "compare-sections"':
+        result = 'MIS-MATCHED!' if scenario.get('mismatch') else 'matched.'
+        console('Section .text, range 0x8000000 -- 0x8001000: %%s\n' %% result)
+        send(token + '^done')
+    else:
+        send(token + '^done')
+    send('(gdb)')
+'''
+
+
+class TestGDBSession(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp('-drwatson-test')
+        self.scenario_path = os.path.join(self.tmpdir, 'scenario.json')
+        self.log_path = os.path.join(self.tmpdir, 'commands.log')
+        self.gdb_path = os.path.join(self.tmpdir, 'gdb')
+        with open(self.gdb_path, 'w') as f:
+            f.write('#!%s\n' % sys.executable)
+            f.write(STUB_GDB % {'scenario': self.scenario_path, 'log': self.log_path})
+        os.chmod(self.gdb_path, 0o755)
+        self.set_scenario()
+        self.session = GDBSession('localhost:2331', gdb=self.gdb_path, command_timeout=5)
+
+    def tearDown(self):
+        self.session.close()
+        shutil.rmtree(self.tmpdir)
+
+    def set_scenario(self, **scenario):
+        with open(self.scenario_path, 'w') as f:
+            json.dump(scenario, f)
+
+    def executed_commands(self):
+        if not os.path.exists(self.log_path):
+            return []
+        with open(self.log_path) as f:
+            return [line.strip().lstrip('0123456789') for line in f]
+
+    def phases(self):
+        return [name for name, _ in self.session.timings]
+
+    def test_load(self):
+        self.assertTrue(self.session.flash('/tmp/firmware.elf'))
+        self.assertEqual(self.phases(), ['connect', 'file', 'scan', 'attach', 'load', 'compare', 'kill'])
+        self.assertIn('-target-select extended-remote localhost:2331', self.executed_commands())
+        self.assertIn('-file-exec-and-symbols /tmp/firmware.elf', self.executed_commands())
+
+        # The connection and the symbols are reused for the next board
+        self.assertTrue(self.session.flash('/tmp/firmware.elf'))
+        self.assertEqual(self.phases(), ['scan', 'attach', 'load', 'compare', 'kill'])
+        self.assertEqual(self.executed_commands().count('-target-download'), 2)
+
+        # A different ELF is loaded into the same session
+        self.assertTrue(self.session.flash('/tmp/other.elf'))
+        self.assertEqual(self.phases(), ['file', 'scan', 'attach', 'load', 'compare', 'kill'])
+
+    def test_compare_sections_mismatch(self):
+        self.set_scenario(mismatch=True)
+        with self.assertRaises(RuntimeError) as context:
+            self.session.flash('/tmp/firmware.elf')
+        self.assertIn('Firmware verification failed', str(context.exception))
+        self.assertIn('MIS-MATCHED', str(context.exception))
+        self.assertFalse(self.session.running)
+
+    def test_skip_if_memory_matches(self):
+        self.set_scenario(memory='0123456789abcdef')
+        probe = (0x08000000, bytes.fromhex('0123456789abcdef'))
+        self.assertFalse(self.session.flash('/tmp/firmware.elf', skip_if_memory_matches=probe))
+        self.assertEqual(self.phases(), ['connect', 'file', 'scan', 'attach', 'probe', 'compare', 'detach'])
+        self.assertNotIn('-target-download', self.executed_commands())
+        self.assertIn('-data-read-memory-bytes 0x8000000 8', self.executed_commands())
+
+        # The descriptor in the flash is different, so the firmware is loaded
+        self.assertTrue(self.session.flash('/tmp/firmware.elf', skip_if_memory_matches=(0x08000000, b'\0' * 8)))
+        self.assertIn('load', self.phases())
+
+    def test_skip_if_memory_matches_with_flash_mismatch(self):
+        # The descriptor is intact but the flash is damaged elsewhere; loading is not skipped then
+        self.set_scenario(memory='0123456789abcdef', mismatch=True)
+        probe = (0x08000000, bytes.fromhex('0123456789abcdef'))
+        with self.assertRaises(RuntimeError):
+            self.session.flash('/tmp/firmware.elf', skip_if_memory_matches=probe)
+        self.assertIn('-target-download', self.executed_commands())
+
+    def test_command_error(self):
+        self.set_scenario(fail={'-target-attach': 'Attaching to "target" failed'})
+        with self.assertRaises(RuntimeError) as context:
+            self.session.flash('/tmp/firmware.elf')
+        self.assertIn('Attaching to "target" failed', str(context.exception))
+        self.assertFalse(self.session.running)
+
+    def test_timeout_and_restart(self):
+        self.session.command_timeout = 0.5
+        self.set_scenario(hang=['-target-download'])
+        with self.assertRaises(RuntimeError) as context:
+            self.session.flash('/tmp/firmware.elf')
+        self.assertIn('timed out', str(context.exception))
+        self.assertFalse(self.session.running)
+
+        # The next board starts a new GDB process, which connects and loads the symbols again
+        self.set_scenario()
+        self.assertTrue(self.session.flash('/tmp/firmware.elf'))
+        self.assertEqual(self.phases(), ['connect', 'file', 'scan', 'attach', 'load', 'compare', 'kill'])
+        self.assertEqual(self.executed_commands().count('-target-select extended-remote localhost:2331'), 2)
+
+    def test_restart_after_gdb_exit(self):
+        self.assertTrue(self.session.flash('/tmp/firmware.elf'))
+        self.session._process.kill()
+        self.session._process.wait()
+        self.assertTrue(self.session.flash('/tmp/firmware.elf'))
+        self.assertEqual(self.phases()[0], 'connect')
+
+
+class TestUnquoteMIString(unittest.TestCase):
+    def test_unquote(self):
+        self.assertEqual(_unquote_mi_string(r'"Target voltage: 3.3V\n"'), 'Target voltage: 3.3V\n')
+        self.assertEqual(_unquote_mi_string(r'"say \"hi\"\t"'), 'say "hi"\t')
+        self.assertEqual(_unquote_mi_string('done'), 'done')
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,150 @@
+#!/usr/bin/env python3
+#
+# Replay tests of gnss_qualifier.py on synthetic traces. Like the real receiver, the traces contain the message Fix
+# at 15 Hz and the message Auxiliary at 10 Hz, so that the decimation of the repeated samples is exercised.
+# Run with "python3 -m unittest test_gnss_qualifier" or with pytest from this directory.
+#
+
+import os
+import sys
+import math
+import numpy
+import shutil
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from gnss_qualifier import Thresholds, qualify, replay, decimate
+
+
+FIX_RATE = 15
+AUX_RATE = 10
+TIMEOUT = 60 * 25
+
+
+def sample(rate, duration, offset, **functions):
+    t = numpy.arange(offset, duration, 1 / rate)
+    columns = {name: numpy.array([f(x) for x in t], dtype=float) for name, f in functions.items()}
+    columns['time'] = t
+    return columns
+
+
+def make_trace(duration, sats_used, sats_visible, fix_after=None, position_variance=4.0):
+    """
+    The arguments sats_used and sats_visible are functions of time. The fix is 3D after the time fix_after,
+    or whenever at least 4 satellites are used if it is not specified.
+    """
+    def status(t):
+        if fix_after is None:
+            return 3 if sats_used(t) >= 4 else 0
+        return 3 if t >= fix_after else 0
+
+    fix = sample(FIX_RATE, duration, 0, status=status, sats_used=sats_used,
+                 position_variance=lambda t: position_variance if status(t) >= 3 else math.nan)
+    aux = sample(AUX_RATE, duration, 0.03, sats_visible=sats_visible, sats_used=sats_used)
+    return fix, aux
+
+
+def ramp(start, rate, limit):
+    return lambda t: min(max(0, math.floor((t - start) * rate)), limit)
+
+
+class TestDecimate(unittest.TestCase):
+    def test_decimate(self):
+        t = numpy.arange(0, 10, 0.1)
+        y = numpy.where(t < 4.05, 4.0, 5.0)
+        dt, dy = decimate(t, y, 1.0)
+        self.assertEqual(list(dy), [4, 5, 5])
+        self.assertAlmostEqual(dt[0], 0.9)
+        self.assertAlmostEqual(dt[1], 4.9)
+        self.assertAlmostEqual(dt[-1], 9.9)
+
+    def test_short(self):
+        self.assertEqual(len(decimate(numpy.array([]), numpy.array([]), 1.0)[0]), 0)
+        self.assertEqual(list(decimate(numpy.array([1.0]), numpy.array([3.0]), 1.0)[1]), [3])
+
+
+class TestQualifier(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp('-drwatson-test')
+        self.thresholds = Thresholds()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def replay(self, fix, aux):
+        # The trace is stored in the format of the drwatson telemetry recorder
+        for channel, columns in ('fix', fix), ('aux', aux):
+            for name, values in columns.items():
+                numpy.save(os.path.join(self.directory, '%s.%s.npy' % (channel, name)), values)
+        return replay(self.directory, self.thresholds, TIMEOUT)
+
+    def test_step(self):
+        # The number of used satellites has stepped from 4 to 5 once; that is not a trend
+        fix, aux = make_trace(60, lambda t: 4 if t < 40 else 5, lambda t: 8, fix_after=0)
+        verdict, _ = self.replay(fix, aux)
+        self.assertIsNone(verdict.passed)
+        verdict = qualify(fix, aux, 60, TIMEOUT, self.thresholds)
+        self.assertIsNone(verdict.passed)
+
+    def test_stalled_receiver(self):
+        # 3D fix, but the number of used satellites never reaches the minimum
+        fix, aux = make_trace(300, lambda t: 5, lambda t: 8, fix_after=10)
+        verdict, _ = self.replay(fix, aux)
+        self.assertIsNone(verdict.passed)
+
+    def test_not_tracking_enough_satellites(self):
+        # The used satellites are growing, but the receiver does not see enough satellites to ever reach the minimum
+        fix, aux = make_trace(100, ramp(0, 0.05, 5), lambda t: 5)
+        verdict, _ = self.replay(fix, aux)
+        self.assertIsNot(verdict.passed, True)
+
+    def test_normal_acquisition(self):
+        # The minimum is reached at 72 s; the board is passed earlier
+        used = ramp(0, 1 / 12, 10)
+        fix, aux = make_trace(300, used, lambda t: used(t) + 3, fix_after=40)
+        verdict, decided_at = self.replay(fix, aux)
+        self.assertTrue(verdict.passed)
+        self.assertLess(decided_at, 72)
+        self.assertGreaterEqual(verdict.confidence, self.thresholds.pass_confidence)
+
+    def test_position_variance(self):
+        fix, aux = make_trace(300, lambda t: 8, lambda t: 10, fix_after=10, position_variance=100.0)
+        verdict, _ = self.replay(fix, aux)
+        self.assertIsNone(verdict.passed)
+
+    def test_cold_start(self):
+        # Nothing is visible for minutes after a cold start; the board is not failed while it is acquiring
+        visible = ramp(300, 1 / 8, 12)
+        fix, aux = make_trace(600, lambda t: max(visible(t) - 2, 0), visible)
+        verdict, decided_at = self.replay(fix, aux)
+        self.assertTrue(verdict.passed)
+        self.assertGreater(decided_at, 300)
+
+    def test_dead_front_end(self):
+        # Nothing is ever visible; this is left for the timeout, because a cold start looks the same at first
+        fix, aux = make_trace(900, lambda t: 0, lambda t: 0)
+        verdict, _ = self.replay(fix, aux)
+        self.assertIsNone(verdict.passed)
+
+    def test_degraded_rf(self):
+        # A few satellites are visible, the number wanders between 1 and 3 and does not grow
+        fix, aux = make_trace(900, lambda t: 0, lambda t: (1, 2, 3, 2, 1, 1, 2)[int(t // 7) % 7] if t > 20 else 0)
+        verdict, decided_at = self.replay(fix, aux)
+        self.assertIs(verdict.passed, False)
+        self.assertGreaterEqual(decided_at, 20 + self.thresholds.min_observation)
+        self.assertLess(decided_at, 900)
+        self.assertGreaterEqual(verdict.confidence, self.thresholds.fail_confidence)
+
+    def test_temporary_loss(self):
+        # The satellites are lost for half a minute, e.g. because the antenna was shadowed
+        def visible(t):
+            return 2 if 150 < t < 180 else min(3 + int(t // 60), 5)
+        fix, aux = make_trace(400, lambda t: max(visible(t) - 1, 0), visible)
+        for now in range(10, 400, 10):
+            self.assertIsNot(qualify(fix, aux, now, TIMEOUT, self.thresholds).passed, False)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,285 @@
+#!/usr/bin/env python3
+#
+# Tests of signature_prefetcher.py with a fake licensing API, and with a client of a local HTTP server that stands in
+# for the licensing server. The stand-in client is a part of the test; it is not the API client of drwatson.
+# Run with "python3 -m unittest test_signature_prefetcher" or with pytest from this directory.
+#
+
+import os
+import sys
+import json
+import unittest
+import threading
+import urllib.request
+from collections import namedtuple
+from concurrent.futures import CancelledError
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from signature_prefetcher import SignaturePrefetcher
+
+
+PRODUCT_NAME = 'com.zubax.gnss'
+TIMEOUT = 5
+
+Response = namedtuple('Response', ['signature', 'new'])
+
+
+def make_signature(unique_id):
+    return bytes(reversed(unique_id)) * 4
+
+
+class FakeAPI:
+    """
+    Fails the first num_failures calls. Every call waits for the event proceed, which allows to hold the
+    prefetcher thread while more requests are queued.
+    """
+
+    def __init__(self, num_failures=0):
+        self.num_failures = num_failures
+        self.calls = []
+        self.proceed = threading.Event()
+        self.proceed.set()
+        self.called = threading.Event()
+
+    def generate_signature(self, unique_id, product_name):
+        self.calls.append(unique_id)
+        self.called.set()
+        assert product_name == PRODUCT_NAME
+        if not self.proceed.wait(TIMEOUT):
+            raise RuntimeError('The test has not released the API')
+        if self.num_failures > 0:
+            self.num_failures -= 1
+            raise IOError('Licensing server is not available')
+        return Response(make_signature(unique_id), True)
+
+
+class FakeBatchAPI(FakeAPI):
+    def __init__(self, num_batch_failures=0):
+        super(FakeBatchAPI, self).__init__()
+        self.num_batch_failures = num_batch_failures
+        self.batches = []
+
+    def generate_signatures(self, unique_ids, product_name):
+        self.batches.append(list(unique_ids))
+        if self.num_batch_failures > 0:
+            self.num_batch_failures -= 1
+            raise IOError('Licensing server is not available')
+        return [Response(make_signature(u), True) for u in unique_ids]
+
+
+class LicensingServer(ThreadingHTTPServer):
+    """
+    Serves POST /generate with {"unique_id": hex} and POST /generate_batch with {"unique_ids": [hex]}.
+    The first num_failures requests fail with 503. The received requests are recorded in the list requests.
+    Requests are answered once the event proceed is set.
+    """
+
+    def __init__(self, num_failures=0):
+        self.num_failures = num_failures
+        self.requests = []
+        self.signed = set()
+        self.proceed = threading.Event()
+        self.proceed.set()
+        self.received = threading.Event()
+        super(LicensingServer, self).__init__(('127.0.0.1', 0), LicensingRequestHandler)
+        threading.Thread(target=self.serve_forever, name='licensing-server', daemon=True).start()
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+
+
+class LicensingRequestHandler(BaseHTTPRequestHandler):
+    def log_message(self, fmt, *a):
+        pass
+
+    def _sign(self, unique_id_hex):
+        new = unique_id_hex not in self.server.signed
+        self.server.signed.add(unique_id_hex)
+        return {'signature': make_signature(bytes.fromhex(unique_id_hex)).hex(), 'new': new}
+
+    def do_POST(self):
+        body = json.loads(self.rfile.read(int(self.headers['Content-Length'])).decode())
+        self.server.requests.append((self.path, body))
+        self.server.received.set()
+        self.server.proceed.wait(TIMEOUT)
+        if self.server.num_failures > 0:
+            self.server.num_failures -= 1
+            self.send_error(503)
+            return
+        if body.get('product') != PRODUCT_NAME:
+            self.send_error(400)
+            return
+        if self.path == '/generate':
+            result = self._sign(body['unique_id'])
+        elif self.path == '/generate_batch':
+            result = [self._sign(x) for x in body['unique_ids']]
+        else:
+            self.send_error(404)
+            return
+        data = json.dumps(result).encode()
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+
+class StandInAPI:
+    def __init__(self, server):
+        self.url = 'http://127.0.0.1:%d/' % server.server_port
+
+    def _post(self, path, body):
+        request = urllib.request.Request(self.url + path, json.dumps(body).encode(),
+                                         {'Content-Type': 'application/json'})
+        with urllib.request.urlopen(request, timeout=TIMEOUT) as response:
+            return json.loads(response.read().decode())
+
+    @staticmethod
+    def _response(x):
+        return Response(bytes.fromhex(x['signature']), x['new'])
+
+    def generate_signature(self, unique_id, product_name):
+        return self._response(self._post('generate', {'unique_id': unique_id.hex(), 'product': product_name}))
+
+
+class StandInBatchAPI(StandInAPI):
+    def generate_signatures(self, unique_ids, product_name):
+        body = {'unique_ids': [u.hex() for u in unique_ids], 'product': product_name}
+        return [self._response(x) for x in self._post('generate_batch', body)]
+
+
+def unique_id(n):
+    return bytes([n]) * 16
+
+
+class TestSignaturePrefetcher(unittest.TestCase):
+    def make_prefetcher(self, api):
+        return SignaturePrefetcher(api, PRODUCT_NAME, attempts=3, retry_base_delay=0.01)
+
+    def test_prefetch(self):
+        api = FakeAPI()
+        prefetcher = self.make_prefetcher(api)
+        prefetcher.prefetch(unique_id(1))
+        prefetcher.prefetch(unique_id(1))
+        self.assertEqual(prefetcher.prefetch(unique_id(1)).result(TIMEOUT).signature, make_signature(unique_id(1)))
+        self.assertEqual(prefetcher.get(unique_id(1)).signature, make_signature(unique_id(1)))
+        self.assertEqual(api.calls, [unique_id(1)])
+
+    def test_get_without_prefetch(self):
+        api = FakeAPI()
+        prefetcher = self.make_prefetcher(api)
+        self.assertEqual(prefetcher.get(unique_id(2)).signature, make_signature(unique_id(2)))
+        self.assertEqual(api.calls, [unique_id(2)])
+
+    def test_retry(self):
+        api = FakeAPI(num_failures=2)
+        prefetcher = self.make_prefetcher(api)
+        self.assertEqual(prefetcher.get(unique_id(1)).signature, make_signature(unique_id(1)))
+        self.assertEqual(api.calls, [unique_id(1)] * 3)
+
+    def test_failure_is_not_cached(self):
+        api = FakeAPI(num_failures=3)
+        prefetcher = self.make_prefetcher(api)
+        future = prefetcher.prefetch(unique_id(1))
+        with self.assertRaises(IOError):
+            future.result(TIMEOUT)
+        # The board is retested once the server is back; the request is made again rather than failing at once
+        self.assertEqual(prefetcher.get(unique_id(1)).signature, make_signature(unique_id(1)))
+        self.assertEqual(len(api.calls), 4)
+
+    def test_unclaimed_requests_are_discarded(self):
+        api = FakeAPI()
+        api.proceed.clear()
+        prefetcher = self.make_prefetcher(api)
+
+        # The first board holds the prefetcher thread; the second board fails before its request is started
+        first = prefetcher.prefetch(unique_id(1))
+        self.assertTrue(api.called.wait(TIMEOUT))
+        with self.assertRaises(RuntimeError):
+            with prefetcher.board():
+                second = prefetcher.prefetch(unique_id(2))
+                raise RuntimeError('The board has failed the test')
+        self.assertTrue(second.cancelled())
+        api.proceed.set()
+        first.result(TIMEOUT)
+        with self.assertRaises(CancelledError):
+            second.result(TIMEOUT)
+
+        # Requests that were not claimed are forgotten, so a retested board makes a new request
+        with prefetcher.board():
+            prefetcher.prefetch(unique_id(3)).result(TIMEOUT)
+        self.assertEqual(prefetcher.get(unique_id(3)).signature, make_signature(unique_id(3)))
+        self.assertEqual(api.calls, [unique_id(1), unique_id(3), unique_id(3)])
+
+        with prefetcher.board():
+            prefetcher.prefetch(unique_id(4))
+            self.assertEqual(prefetcher.get(unique_id(4)).signature, make_signature(unique_id(4)))
+        self.assertEqual(prefetcher._futures, {unique_id(1): first})
+
+    def test_batch(self):
+        api = FakeBatchAPI()
+        api.proceed.clear()
+        prefetcher = self.make_prefetcher(api)
+
+        # The requests of several fixtures that are queued while the previous request is in progress are batched
+        prefetcher.prefetch(unique_id(1))
+        self.assertTrue(api.called.wait(TIMEOUT))
+        futures = [prefetcher.prefetch(unique_id(n)) for n in (2, 3, 4)]
+        api.proceed.set()
+        for n, future in zip((2, 3, 4), futures):
+            self.assertEqual(future.result(TIMEOUT).signature, make_signature(unique_id(n)))
+        self.assertEqual(api.calls, [unique_id(1)])
+        self.assertEqual(api.batches, [[unique_id(2), unique_id(3), unique_id(4)]])
+
+    def test_batch_failure(self):
+        api = FakeBatchAPI(num_batch_failures=1)
+        api.proceed.clear()
+        prefetcher = SignaturePrefetcher(api, PRODUCT_NAME, attempts=1)
+        prefetcher.prefetch(unique_id(1))
+        self.assertTrue(api.called.wait(TIMEOUT))
+        futures = [prefetcher.prefetch(unique_id(n)) for n in (2, 3)]
+        api.proceed.set()
+        for future in futures:
+            with self.assertRaises(IOError):
+                future.result(TIMEOUT)
+        self.assertEqual(prefetcher.get(unique_id(2)).signature, make_signature(unique_id(2)))
+
+
+class TestSignaturePrefetcherWithServer(unittest.TestCase):
+    def setUp(self):
+        self.server = LicensingServer(num_failures=2)
+
+    def tearDown(self):
+        self.server.stop()
+
+    def test_single(self):
+        prefetcher = SignaturePrefetcher(StandInAPI(self.server), PRODUCT_NAME, attempts=3, retry_base_delay=0.01)
+        prefetcher.prefetch(unique_id(1))
+        response = prefetcher.get(unique_id(1))
+        self.assertEqual(response, Response(make_signature(unique_id(1)), True))
+        self.assertEqual(len(self.server.requests), 3)
+
+        # The device has been signed earlier
+        self.assertEqual(prefetcher.get(unique_id(1)), Response(make_signature(unique_id(1)), False))
+
+    def test_batch(self):
+        prefetcher = SignaturePrefetcher(StandInBatchAPI(self.server), PRODUCT_NAME, attempts=3,
+                                         retry_base_delay=0.01)
+        # The first request is in progress while the other fixtures queue their requests
+        self.server.proceed.clear()
+        prefetcher.prefetch(unique_id(1))
+        self.assertTrue(self.server.received.wait(TIMEOUT))
+        futures = [prefetcher.prefetch(unique_id(n)) for n in (2, 3)]
+        self.server.proceed.set()
+        for n in 1, 2, 3:
+            self.assertEqual(prefetcher.get(unique_id(n)).signature, make_signature(unique_id(n)))
+        self.assertTrue(all(f.done() for f in futures))
+        self.assertEqual([p for p, _ in self.server.requests], ['/generate'] * 3 + ['/generate_batch'])
+        self.assertEqual(self.server.requests[-1][1]['unique_ids'], [unique_id(2).hex(), unique_id(3).hex()])
+
+
+if __name__ == '__main__':
+    unittest.main()